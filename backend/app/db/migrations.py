@@ -0,0 +1,240 @@
+"""
+Lightweight schema migrations for existing databases.
+
+`Base.metadata.create_all` only creates missing tables, so indexes and columns added
+to models after a table already exists have to be applied here.
+"""
+import os
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+
+from app.db.database import Base
+
+
+def add_missing_columns(engine: Engine):
+    """ALTER TABLE ... ADD COLUMN for every model column missing from an existing table."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column_ddl}'))
+                print(f"Added column {table.name}.{column.name}")
+
+
+def create_missing_indexes(engine: Engine):
+    """Create every index declared on the models that does not exist yet."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def backfill_subscription_type_classification(engine: Engine):
+    """One-shot backfill of parking_lot_id / vehicle_class / consumes_space from the type names."""
+    from app.utils.occupancy import classify_subscription_types, initialize_occupancy, verify_occupancy
+
+    with Session(engine) as db:
+        classified = classify_subscription_types(db)
+        db.commit()
+        if classified:
+            print(f"Classified {classified} subscription types")
+            # Counters were computed with the name matching, recompute them once
+            initialize_occupancy(db)
+            verify_occupancy(db, fix=True)
+
+
+# Tables whose comma-separated documents column moved to the documents table:
+# (table, key column, documents reference column, upload directory)
+LEGACY_DOCUMENT_COLUMNS = [
+    ('owners', 'dni', 'owner_dni', 'uploads'),
+    ('vehicles', 'lisence_plate', 'vehicle_plate', 'vehicle_uploads'),
+    ('subscriptions', 'id', 'subscription_id', 'subscription_files'),
+    ('cancellations', 'id', 'cancellation_id', 'cancelled_subscription_files'),
+    # Keeps its column as a snapshot, its rows reference the cancellation it was approved from
+    ('approved_cancellations', 'cancellation_id', 'cancellation_id', 'cancelled_subscription_files'),
+]
+
+
+DOCUMENT_COLUMNS_MIGRATION = 'document_columns'
+
+
+def migration_applied(connection, name: str) -> bool:
+    return connection.execute(text("SELECT 1 FROM schema_migrations WHERE name = :name"), {'name': name}).first() \
+        is not None
+
+
+def record_migration(connection, name: str):
+    connection.execute(text("INSERT INTO schema_migrations (name, applied_at) VALUES (:name, :applied_at)"),
+                       {'name': name, 'applied_at': datetime.now()})
+
+
+def legacy_document_tables(engine: Engine) -> list:
+    """Tables of LEGACY_DOCUMENT_COLUMNS[:4] that still have their documents column"""
+    inspector = inspect(engine)
+    return [table for table, _, _, _ in LEGACY_DOCUMENT_COLUMNS[:4]
+            if 'documents' in {column['name'] for column in inspector.get_columns(table)}]
+
+
+def copy_document_columns(connection) -> int:
+    """documents rows for the names of the documents columns, returns the rows inserted"""
+    from app.utils.document_store import WORK_ORDER_FILENAME, document_checksum
+
+    copied = 0
+    for table, key, reference, directory in LEGACY_DOCUMENT_COLUMNS:
+        rows = connection.execute(text(
+            f"SELECT {key}, documents FROM {table} WHERE documents IS NOT NULL AND documents != ''"
+        )).all()
+        for key_value, documents in rows:
+            for name in documents.split(','):
+                filename = os.path.basename(name.strip())
+                if not filename:
+                    continue
+                path = os.path.join(directory, filename)
+                exists = os.path.exists(path)
+                # OR IGNORE: repeated names, unique per record
+                copied += connection.execute(text(
+                    f"INSERT OR IGNORE INTO documents ({reference}, filename, size, checksum, kind, created_at) "
+                    f"VALUES (:key, :filename, :size, :checksum, :kind, :created_at)"
+                ), {
+                    'key': key_value,
+                    'filename': filename,
+                    'size': os.path.getsize(path) if exists else None,
+                    'checksum': document_checksum(path) if exists else None,
+                    'kind': 'work_order' if WORK_ORDER_FILENAME.match(filename) else 'upload',
+                    'created_at': datetime.now(),
+                }).rowcount
+    return copied
+
+
+def migrate_document_columns(engine: Engine):
+    """
+    One-shot copy of the documents columns (comma-separated filenames, vehicles with their
+    directory) into one documents row per file. The columns are left as they are, no longer
+    mapped, so the previous release can still run on the database; drop them with
+    `python -m app.db.migrations drop-legacy-document-columns` once the copy is checked.
+    """
+    # A new database, or one whose columns were dropped, has nothing to copy
+    has_legacy_columns = 'owners' in legacy_document_tables(engine)
+    with engine.begin() as connection:
+        if migration_applied(connection, DOCUMENT_COLUMNS_MIGRATION):
+            return
+        copied = copy_document_columns(connection) if has_legacy_columns else 0
+        record_migration(connection, DOCUMENT_COLUMNS_MIGRATION)
+    if has_legacy_columns:
+        print(f"Copied {copied} documents to the documents table, the documents columns are kept")
+
+
+def drop_legacy_document_columns(engine: Engine) -> list:
+    """Drop the documents columns copied by migrate_document_columns, returns the tables changed"""
+    import sqlite3
+
+    tables = legacy_document_tables(engine)
+    if not tables:
+        return []
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        raise RuntimeError(f"DROP COLUMN needs SQLite 3.35 or later, this is {sqlite3.sqlite_version}")
+    with engine.begin() as connection:
+        if not migration_applied(connection, DOCUMENT_COLUMNS_MIGRATION):
+            raise RuntimeError("The documents columns have not been copied yet, start the application first")
+        for table in tables:
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN documents"))
+    return tables
+
+
+# Tables whose lisence_plate1/2/3 columns are mirrored in subscription_plates:
+# (table, key column, subscription_plates reference column)
+PLATE_TABLES = [
+    ('subscriptions', 'id', 'subscription_id'),
+    ('cancellations', 'id', 'cancellation_id'),
+    ('approved_cancellations', 'id', 'approved_cancellation_id'),
+    ('subscription_history', 'history_id', 'history_id'),
+]
+
+
+def plate_rows_query(table: str, key: str) -> str:
+    """(key, plate, position, subscription_type_id) of every plate of table, a plate repeated in a record once"""
+    plates = " UNION ALL ".join(
+        f"SELECT {key} AS key, lisence_plate{position} AS plate, {position} AS position, subscription_type_id "
+        f"FROM {table} WHERE lisence_plate{position} IS NOT NULL AND lisence_plate{position} != ''"
+        for position in (1, 2, 3)
+    )
+    return f"SELECT key, plate, MIN(position) AS position, subscription_type_id FROM ({plates}) GROUP BY key, plate"
+
+
+def duplicate_subscription_plates(connection) -> list:
+    """(subscription_type_id, plate, subscription ids) of the plates in more than one subscription of a type"""
+    return connection.execute(text(
+        f"SELECT subscription_type_id, plate, GROUP_CONCAT(key, ', ') "
+        f"FROM ({plate_rows_query('subscriptions', 'id')}) "
+        f"GROUP BY subscription_type_id, plate HAVING COUNT(*) > 1 ORDER BY subscription_type_id, plate"
+    )).all()
+
+
+def backfill_subscription_plates(engine: Engine):
+    """
+    Fill subscription_plates from the plate columns: every table once, while it is empty, and
+    then the subscriptions missing a row (from a backfill that skipped them). From then on the
+    rows are kept in sync on flush (queries/plate).
+
+    Subscriptions that repeat a plate of another subscription of the same type cannot get their
+    rows (ix_subscription_plates_active), and every plate lookup would miss them: startup stops
+    and lists them, to be fixed in the plate columns first.
+    """
+    with engine.begin() as connection:
+        duplicates = duplicate_subscription_plates(connection)
+        if duplicates:
+            listing = "\n".join(f"  type {subscription_type_id}, plate {plate}: subscriptions {subscription_ids}"
+                                 for subscription_type_id, plate, subscription_ids in duplicates)
+            raise RuntimeError(
+                f"{len(duplicates)} plates are in more than one subscription of the same type:\n{listing}\n"
+                f"Leave each plate in one subscription per type (lisence_plate1/2/3) and start again"
+            )
+
+        backfilled = PLATE_TABLES
+        if connection.execute(text("SELECT 1 FROM subscription_plates LIMIT 1")).first():
+            backfilled = PLATE_TABLES[:1]
+
+        filled = 0
+        for table, key, reference in backfilled:
+            filled += connection.execute(text(
+                f"INSERT INTO subscription_plates ({reference}, lisence_plate, position, subscription_type_id) "
+                f"SELECT key, plate, position, subscription_type_id FROM ({plate_rows_query(table, key)}) p "
+                f"WHERE NOT EXISTS (SELECT 1 FROM subscription_plates l "
+                f"WHERE l.{reference} = p.key AND l.lisence_plate = p.plate) ORDER BY key, position"
+            )).rowcount
+    if filled:
+        print(f"Filled subscription_plates with {filled} plates")
+
+
+def run_migrations(engine: Engine):
+    """Bring an existing database up to date with the current models."""
+    add_missing_columns(engine)
+    create_missing_indexes(engine)
+    migrate_document_columns(engine)
+    backfill_subscription_plates(engine)
+    backfill_subscription_type_classification(engine)
+    print("Database migrations applied")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from app.db.database import engine
+
+    parser = argparse.ArgumentParser(description="Explicit migration steps, not run at startup")
+    parser.add_argument('command', choices=['drop-legacy-document-columns'])
+    args = parser.parse_args()
+
+    dropped = drop_legacy_document_columns(engine)
+    print(f"Dropped the documents column of {', '.join(dropped)}" if dropped else "No documents columns left to drop")
@@ -1,29 +1,59 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from sqlalchemy.orm import Session
 from starlette.middleware.cors import CORSMiddleware
-from starlette.staticfiles import StaticFiles
+from starlette.responses import JSONResponse
 
 from app.db.database import engine
+from app.db.migrations import run_migrations
 from app.models.models import Base
 from app.queries.user import get_user_by_email, create_user
 from app.routes import user_routes, auth_routes, owner_routes, vehicle_routes, subscription_routes, \
     subscription_cancellation_route, subscription_history_route, vehicle_history_route, owner_history_route, \
-    parking_lot_routes, parking_stats
+    parking_lot_routes, parking_stats, export_job_routes, work_order_routes, document_routes, access_routes, \
+    gate_event_routes
 from app.routes import approve_cancellation
 from app.routes.owner_routes import UPLOAD_DIR
 from app.schemas.user import UserCreate
+from app.utils.access_index import initialize_access_index
+from app.utils.document_gc import start_document_gc
+from app.utils.export_jobs import fail_interrupted_export_jobs
+from app.utils.gate_events import stop_gate_event_writer
+from app.utils.occupancy import initialize_occupancy
+from app.utils.pdf_renderer import shutdown_pdf_executor, warm_up_pdf_workers
+from app.utils.presence import initialize_presence
+from app.utils.uploads import MAX_UPLOAD_REQUEST_SIZE, MB
+from app.utils.work_order_queue import resume_pending_work_orders
 
-# Initialize the FastAPI app
-app = FastAPI()
 
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the work order PDF workers and render once so the first real work order is not slow
+    await asyncio.get_running_loop().run_in_executor(None, warm_up_pdf_workers)
+    yield
+    # Let the work order PDF workers finish and exit
+    shutdown_pdf_executor()
+    # Write the gate events still buffered
+    stop_gate_event_writer()
 
-app.mount("/vehicle_uploads", StaticFiles(directory="vehicle_uploads"), name="vehicle_uploads")
 
-app.mount("/subscription_files", StaticFiles(directory="subscription_files"), name="subscription_files")
+# Initialize the FastAPI app
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def limit_request_size(request, call_next):
+    """Refuse oversized uploads from their Content-Length, before the body is read and spooled"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_REQUEST_SIZE:
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"Los archivos superan el tamaño máximo de {MAX_UPLOAD_REQUEST_SIZE // MB} MB por envío"},
+        )
+    return await call_next(request)
 
-app.mount("/cancelled_subscription_files", StaticFiles(directory="cancelled_subscription_files"), name="cancelled_subscription_files")
 
 # Add CORS middleware to allow all origins, methods, and headers
 app.add_middleware(
@@ -48,6 +78,12 @@ app.include_router(parking_lot_routes.router)
 app.include_router(parking_stats.router)
 
 app.include_router(approve_cancellation.router)
+app.include_router(export_job_routes.router)
+app.include_router(work_order_routes.router)
+# Uploaded documents (uploads, vehicle_uploads, subscription_files, cancelled_subscription_files)
+app.include_router(document_routes.router)
+app.include_router(access_routes.router)
+app.include_router(gate_event_routes.router)
 
 @app.get("/")
 def read_root():
@@ -81,9 +117,20 @@ if __name__ == '__main__':
     # Create all the database tables
     Base.metadata.create_all(bind=engine)
 
+    # Apply indexes and columns added after the tables were first created
+    run_migrations(engine)
+
     # Create default users
     with Session(engine) as db:
         create_default_users(db)
+        initialize_occupancy(db)
+        initialize_access_index(db)
+        initialize_presence(db)
+        fail_interrupted_export_jobs(db)
+        resume_pending_work_orders(db)
+
+    # Look for orphaned and dangling documents in the background
+    start_document_gc()
 
     # Run the FastAPI app with Uvicorn
     uvicorn.run(app, host='0.0.0.0', port=8000)
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Index, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.db.database import Base
@@ -35,7 +35,6 @@ class Owners(Base):
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
     email = Column(String, nullable=True)
-    documents = Column(String, nullable=True)  # Consider using a better structure for multiple documents
     observations = Column(String, nullable=True)
     bank_account_number = Column(String, nullable=False)
     sage_client_number = Column(String, nullable=True)
@@ -47,6 +46,8 @@ class Owners(Base):
     modified_by = Column(String, ForeignKey("users.email"), nullable=True)
     modification_time = Column(DateTime, nullable=True)
 
+    documents = relationship("Document", order_by="Document.id", lazy="selectin", cascade="all, delete-orphan")
+
 
 # Completed History Tables
 class Owners_history(Base):
@@ -77,13 +78,14 @@ class Vehicles(Base):
     model = Column(String, nullable=False)
     vehicle_type = Column(String, nullable=False)
     owner_id = Column(String, ForeignKey("owners.dni"), nullable=False)
-    documents = Column(String, nullable=True)
     observations = Column(String, nullable=True)
     registration_date = Column(DateTime, default=datetime.now, nullable=False)
     created_by = Column(String, ForeignKey("users.email"), nullable=False)
     modified_by = Column(String, ForeignKey("users.email"), nullable=True)
     modification_time = Column(DateTime, nullable=True)
 
+    documents = relationship("Document", order_by="Document.id", lazy="selectin", cascade="all, delete-orphan")
+
 
 class Vehicles_history(Base):
     __tablename__ = "vehicles_history"
@@ -110,6 +112,11 @@ class Subscription_types(Base):
     name = Column(String, nullable=False)
     price = Column(Integer, nullable=False)
     parking_code = Column(String, nullable=False)
+    parking_lot_id = Column(Integer, ForeignKey("parking_lot_config.id"), nullable=True, index=True)
+    vehicle_class = Column(String, nullable=True)  # 'car' or 'motorcycle'
+    consumes_space = Column(Boolean, default=False, server_default='0', nullable=False)  # Takes a space in the lot (24H)
+
+    parking_lot = relationship("ParkingLot")
 
     # Add this line to create a relationship with Subscriptions
     subscriptions = relationship("Subscriptions", back_populates="subscription_type")
@@ -121,14 +128,13 @@ class Subscriptions(Base):
     __tablename__ = "subscriptions"
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(String, ForeignKey("owners.dni"), nullable=False)
-    subscription_type_id = Column(Integer, ForeignKey("subscription_types.id"), nullable=False)
+    subscription_type_id = Column(Integer, ForeignKey("subscription_types.id"), nullable=False, index=True)
     access_card = Column(String, nullable=True)
     tique_x_park = Column(String, nullable=True)
     remote_control_number = Column(String, nullable=True)
     lisence_plate1 = Column(String, ForeignKey("vehicles.lisence_plate"), nullable=False)
     lisence_plate2 = Column(String, ForeignKey("vehicles.lisence_plate"), nullable=True)
     lisence_plate3 = Column(String, ForeignKey("vehicles.lisence_plate"), nullable=True)
-    documents = Column(String, nullable=True)
     observations = Column(String, nullable=True)
     effective_date = Column(DateTime, default=datetime.now(), nullable=True)
     large_family_expiration = Column(DateTime, nullable=True)
@@ -141,6 +147,8 @@ class Subscriptions(Base):
 
     # Add this line to create a relationship with Subscription_types
     subscription_type = relationship("Subscription_types", back_populates="subscriptions")
+    documents = relationship("Document", order_by="Document.id", lazy="selectin", cascade="all, delete-orphan")
+    plates = relationship("SubscriptionPlate", order_by="SubscriptionPlate.position", cascade="all, delete-orphan")
 
 
 class Subscription_history(Base):
@@ -166,6 +174,8 @@ class Subscription_history(Base):
     created_by = Column(String, ForeignKey("users.email"), nullable=False)
     modified_by = Column(String, ForeignKey("users.email"), nullable=True)
 
+    plates = relationship("SubscriptionPlate", order_by="SubscriptionPlate.position", cascade="all, delete-orphan")
+
 
 class Cancellations(Base):
     __tablename__ = "cancellations"
@@ -173,13 +183,12 @@ class Cancellations(Base):
     owner_id = Column(String, ForeignKey("owners.dni"), nullable=False)
     subscription_id = Column(Integer, ForeignKey("subscriptions.id"),
                              nullable=False)  # Reference to the canceled subscription
-    subscription_type_id = Column(Integer, ForeignKey("subscription_types.id"), nullable=False)
+    subscription_type_id = Column(Integer, ForeignKey("subscription_types.id"), nullable=False, index=True)
     access_card = Column(String, nullable=True)
     lisence_plate1 = Column(String, ForeignKey("vehicles.lisence_plate"), nullable=True)
     lisence_plate2 = Column(String, ForeignKey("vehicles.lisence_plate"), nullable=True)
     lisence_plate3 = Column(String, ForeignKey("vehicles.lisence_plate"), nullable=True)
     tique_x_park = Column(String, ForeignKey("subscriptions.tique_x_park"), nullable=True)
-    documents = Column(String, nullable=True)
     remote_control_number = Column(String, ForeignKey("subscriptions.remote_control_number"), nullable=True)
     observations = Column(String, nullable=True)
     registration_date = Column(DateTime, nullable=False)
@@ -192,6 +201,10 @@ class Cancellations(Base):
     modified_by = Column(String, ForeignKey("users.email"), nullable=True)
 
     subscription_type = relationship("Subscription_types", back_populates="cancellations")
+    # Not deleted with the cancellation: an approved cancellation keeps them (ApprovedCancellations.cancellation_id)
+    documents = relationship("Document", primaryjoin="Cancellations.id == foreign(Document.cancellation_id)",
+                             order_by="Document.id", lazy="selectin", passive_deletes='all')
+    plates = relationship("SubscriptionPlate", order_by="SubscriptionPlate.position", cascade="all, delete-orphan")
 
 class ApprovedCancellations(Base):
     __tablename__ = "approved_cancellations"
@@ -217,6 +230,8 @@ class ApprovedCancellations(Base):
     created_by = Column(String, ForeignKey("users.email"), nullable=False)
     modified_by = Column(String, ForeignKey("users.email"), nullable=True)
 
+    plates = relationship("SubscriptionPlate", order_by="SubscriptionPlate.position", cascade="all, delete-orphan")
+
 
 
 class ParkingLot(Base):
@@ -238,3 +253,178 @@ class WorkOrderCounter(Base):
     counter_type = Column(String(50), unique=True, nullable=False)
     current_number = Column(Integer, default=0, nullable=False)
     year = Column(Integer, nullable=False)
+
+
+class ParkingLotOccupancy(Base):
+    """Per parking lot space counters, kept up to date by the subscription and cancellation endpoints"""
+    __tablename__ = 'parking_lot_occupancy'
+
+    parking_lot_id = Column(Integer, ForeignKey("parking_lot_config.id"), primary_key=True)
+    occupied_car_spaces = Column(Integer, default=0, nullable=False)
+    occupied_motorcycle_spaces = Column(Integer, default=0, nullable=False)
+    cancelled_car_spaces = Column(Integer, default=0, nullable=False)
+    cancelled_motorcycle_spaces = Column(Integer, default=0, nullable=False)
+    cancellation_count = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=True)
+
+
+class ExportJob(Base):
+    """Background export of a table to a file; finished files are reused for identical requests"""
+    __tablename__ = 'export_jobs'
+
+    id = Column(String, primary_key=True)  # uuid4 hex
+    dataset = Column(String, nullable=False)
+    export_format = Column(String, nullable=False)
+    parameters = Column(String, nullable=False)  # JSON with the requested fields and ids
+    cache_key = Column(String, nullable=False, index=True)
+    status = Column(String, nullable=False, default='pending')  # pending, running, done, failed, expired
+    file_path = Column(String, nullable=True)
+    row_count = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    created_by = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class PendingWorkOrder(Base):
+    """Work order PDF rendered after the request that created it has been committed (deferred mode)"""
+    __tablename__ = 'pending_work_orders'
+    __table_args__ = (Index('ix_pending_work_orders_target', 'target_type', 'target_id'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    target_type = Column(String, nullable=False)  # 'subscription' or 'cancellation'
+    target_id = Column(Integer, nullable=False)
+    template_name = Column(String, nullable=False)
+    template_data = Column(String, nullable=False)  # JSON
+    file_path = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending, ready, failed
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class WorkOrder(Base):
+    """Numbered work order with the data printed on it, so it can be reprinted without re-rendering"""
+    __tablename__ = 'work_orders'
+    __table_args__ = (Index('ix_work_orders_target', 'target_type', 'target_id'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    target_type = Column(String, nullable=False)  # 'subscription' or 'cancellation'
+    target_id = Column(Integer, nullable=False)
+    order_no = Column(String, nullable=False)  # e.g. "1/25"
+    template_name = Column(String, nullable=False)
+    template_data = Column(String, nullable=False)  # JSON
+    input_hash = Column(String, nullable=False)  # template and data when it was issued, names the cached PDF
+    content_hash = Column(String, nullable=False)  # subscription data on the work order, without number and date
+    file_path = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+
+class DocumentBlob(Base):
+    """Stored content of uploaded documents, one row per distinct file (see utils/document_store)"""
+    __tablename__ = 'document_blobs'
+
+    checksum = Column(String, primary_key=True)  # sha256 hex, also the blob filename
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)  # Document names pointing at the blob
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+
+class Document(Base):
+    """
+    File attached to an owner, vehicle, subscription or cancellation, one row per file (these
+    used to be comma-separated filenames in a documents column). Exactly one reference is set.
+    """
+    __tablename__ = 'documents'
+    __table_args__ = (
+        Index('ix_documents_owner', 'owner_dni', 'filename', unique=True, sqlite_where=text('owner_dni IS NOT NULL')),
+        Index('ix_documents_vehicle', 'vehicle_plate', 'filename', unique=True,
+              sqlite_where=text('vehicle_plate IS NOT NULL')),
+        Index('ix_documents_subscription', 'subscription_id', 'filename', unique=True,
+              sqlite_where=text('subscription_id IS NOT NULL')),
+        Index('ix_documents_cancellation', 'cancellation_id', 'filename', unique=True,
+              sqlite_where=text('cancellation_id IS NOT NULL')),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    owner_dni = Column(String, ForeignKey("owners.dni"), nullable=True)
+    vehicle_plate = Column(String, ForeignKey("vehicles.lisence_plate"), nullable=True)
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=True)
+    cancellation_id = Column(Integer, nullable=True)  # No foreign key, outlives the approved cancellation
+    filename = Column(String, nullable=False, index=True)  # Name in the upload directory of the record type
+    size = Column(Integer, nullable=True)
+    checksum = Column(String, nullable=True, index=True)  # sha256, names the blob in utils/document_store
+    kind = Column(String, nullable=False, default='upload')  # 'upload' or 'work_order'
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+
+class SubscriptionPlate(Base):
+    """
+    License plate of a subscription, cancellation, approved cancellation or subscription history
+    row, one row per plate. Mirrors their lisence_plate1/2/3 columns (kept in sync on flush, see
+    queries/plate) so plate lookups use one index. Exactly one reference is set.
+    """
+    __tablename__ = 'subscription_plates'
+    __table_args__ = (
+        # A plate is in one subscription per subscription type
+        Index('ix_subscription_plates_active', 'subscription_type_id', 'lisence_plate', unique=True,
+              sqlite_where=text('subscription_id IS NOT NULL')),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id"), nullable=True, index=True)
+    cancellation_id = Column(Integer, ForeignKey("cancellations.id"), nullable=True, index=True)
+    approved_cancellation_id = Column(Integer, ForeignKey("approved_cancellations.id"), nullable=True, index=True)
+    history_id = Column(Integer, ForeignKey("subscription_history.history_id"), nullable=True, index=True)
+    lisence_plate = Column(String, nullable=False, index=True)
+    position = Column(Integer, nullable=False)  # 1, 2 or 3: the lisence_plate column it mirrors
+    subscription_type_id = Column(Integer, nullable=False)
+
+
+class GateEvent(Base):
+    """
+    Entry or exit of a credential at a gate of a parking lot. Append-only: rows are inserted in
+    batches by utils/gate_events and never updated or deleted.
+    """
+    __tablename__ = 'gate_events'
+    __table_args__ = (Index('ix_gate_events_lot_time', 'parking_lot_id', 'occurred_at'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    parking_lot_id = Column(Integer, ForeignKey("parking_lot_config.id"), nullable=False)
+    gate = Column(String, nullable=False)
+    direction = Column(String, nullable=False)  # 'entry' or 'exit'
+    credential_kind = Column(String, nullable=False)  # plate, access_card, remote_control_number or tique_x_park
+    credential = Column(String, nullable=False)  # Normalized as in utils/access_index
+    subscription_id = Column(Integer, nullable=True)  # No foreign key, outlives the subscription. None: not subscribed
+    vehicle_class = Column(String, nullable=True)  # 'car' or 'motorcycle' (see utils/presence)
+    occurred_at = Column(DateTime, nullable=False)  # When the gate saw it
+    received_at = Column(DateTime, nullable=False)
+
+
+class GatePresence(Base):
+    """Vehicle inside a parking lot when the presence snapshot was taken, one row per vehicle (see utils/presence)"""
+    __tablename__ = 'gate_presence'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    subscription_id = Column(Integer, nullable=True)  # Set for subscriptions, the credential for visitors
+    credential_kind = Column(String, nullable=True)
+    credential = Column(String, nullable=True)
+    parking_lot_id = Column(Integer, nullable=False)
+    vehicle_class = Column(String, nullable=False)
+
+
+class GatePresenceCheckpoint(Base):
+    """Last gate event included in the gate_presence snapshot (single row)"""
+    __tablename__ = 'gate_presence_checkpoint'
+
+    id = Column(Integer, primary_key=True)
+    last_event_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+
+class SchemaMigration(Base):
+    """One-shot data migration already applied to this database (db/migrations), by name"""
+    __tablename__ = 'schema_migrations'
+
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.now, nullable=False)
@@ -0,0 +1,138 @@
+#  For the documents attached to owners, vehicles, subscriptions and cancellations
+import os
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import or_, select
+from sqlalchemy.orm import Session
+
+from app.models.models import Document, Vehicles, Subscriptions, Cancellations, ApprovedCancellations
+from app.utils.document_store import WORK_ORDER_FILENAME, document_checksum
+
+# Reference column of each record type and the directory its files are stored in
+DOCUMENT_DIRECTORIES = {
+    'owner_dni': 'uploads',
+    'vehicle_plate': 'vehicle_uploads',
+    'subscription_id': 'subscription_files',
+    'cancellation_id': 'cancelled_subscription_files',
+}
+
+
+def document_names(documents: List[Document]) -> List[str]:
+    return [document.filename for document in documents]
+
+
+def document_list(documents: List[Document]) -> Optional[str]:
+    """Comma-separated filenames, as kept in the history tables"""
+    filenames = document_names(documents)
+    return ','.join(filenames) if filenames else None
+
+
+def find_document(documents: List[Document], filename: str) -> Optional[Document]:
+    return next((document for document in documents if document.filename == filename), None)
+
+
+def add_document(documents: List[Document], filename: str, size: Optional[int] = None,
+                 checksum: Optional[str] = None, kind: str = 'upload', path=None) -> Document:
+    """
+    Attach a file to a record's documents (its `documents` relationship). A file already
+    attached under that name keeps its row with the new size and checksum. Without size and
+    checksum they are read from path, when given.
+    """
+    if path is not None and size is None and os.path.exists(path):
+        size = os.path.getsize(path)
+        checksum = document_checksum(path)
+
+    document = find_document(documents, filename)
+    if document is None:
+        document = Document(filename=filename, kind=kind, created_at=datetime.now())
+        documents.append(document)
+    document.size = size
+    document.checksum = checksum
+    return document
+
+
+def remove_document(db: Session, documents: List[Document], filename: str) -> bool:
+    """Detach a file from a record's documents, returns False if it was not attached"""
+    document = find_document(documents, filename)
+    if document is None:
+        return False
+    documents.remove(document)
+    db.delete(document)
+    # Delete now, so the same name can be attached again in this transaction (unique per record)
+    db.flush()
+    return True
+
+
+def set_documents(db: Session, documents: List[Document], filenames: List[str], path_for: Callable[[str], str],
+                  sources: List[Document] = ()):
+    """
+    Make a record's documents exactly filenames, keeping the rows of unchanged ones. A new name
+    found in sources (the documents of the record it comes from) is copied with its kind, size
+    and checksum; otherwise they are read from the file at path_for(filename).
+    """
+    for document in list(documents):
+        if document.filename not in filenames:
+            remove_document(db, documents, document.filename)
+    for filename in filenames:
+        if find_document(documents, filename) is not None:
+            continue
+        source = find_document(sources, filename)
+        if source is not None:
+            add_document(documents, filename, source.size, source.checksum, kind=source.kind)
+        else:
+            kind = 'work_order' if WORK_ORDER_FILENAME.match(filename) else 'upload'
+            add_document(documents, filename, kind=kind, path=path_for(filename))
+
+
+def cancellation_document_path(filename: str) -> str:
+    """File of a cancellation; the ones carried over from the subscription may only be in subscription_files"""
+    path = os.path.join(DOCUMENT_DIRECTORIES['cancellation_id'], filename)
+    if not os.path.lexists(path):
+        path = os.path.join(DOCUMENT_DIRECTORIES['subscription_id'], filename)
+    return path
+
+
+def document_references(db: Session, filename: str, reference: Optional[str] = None) -> List[Document]:
+    """
+    Rows naming filename (by the filename index), optionally only those of one record type
+    (a reference column of DOCUMENT_DIRECTORIES).
+    """
+    query = db.query(Document).filter(Document.filename == filename)
+    if reference:
+        query = query.filter(getattr(Document, reference).isnot(None))
+    return query.order_by(Document.id).all()
+
+
+def owner_document_files(db: Session, dni: str) -> List[Tuple[str, str]]:
+    """
+    Files of an owner, their vehicles, subscriptions (work orders included) and cancellations,
+    pending or approved, in one query. Returns (path on disk, name in a ZIP) pairs, grouped by record.
+    """
+    cancellation_ids = select(Cancellations.id).where(Cancellations.owner_id == dni).union(
+        select(ApprovedCancellations.cancellation_id).where(ApprovedCancellations.owner_id == dni)
+    )
+    documents = db.query(Document).filter(or_(
+        Document.owner_dni == dni,
+        Document.vehicle_plate.in_(select(Vehicles.lisence_plate).where(Vehicles.owner_id == dni)),
+        Document.subscription_id.in_(select(Subscriptions.id).where(Subscriptions.owner_id == dni)),
+        Document.cancellation_id.in_(cancellation_ids),
+    )).order_by(Document.owner_dni.is_(None), Document.vehicle_plate.is_(None), Document.subscription_id.is_(None),
+                Document.vehicle_plate, Document.subscription_id, Document.cancellation_id, Document.id).all()
+
+    files = []
+    for document in documents:
+        if document.owner_dni is not None:
+            folder = "propietario"
+            path = os.path.join(DOCUMENT_DIRECTORIES['owner_dni'], document.filename)
+        elif document.vehicle_plate is not None:
+            folder = f"vehiculos/{document.vehicle_plate}"
+            path = os.path.join(DOCUMENT_DIRECTORIES['vehicle_plate'], document.filename)
+        elif document.subscription_id is not None:
+            folder = f"abonos/{document.subscription_id}"
+            path = os.path.join(DOCUMENT_DIRECTORIES['subscription_id'], document.filename)
+        else:
+            folder = f"bajas/{document.cancellation_id}"
+            path = cancellation_document_path(document.filename)
+        files.append((path, f"{folder}/{document.filename}"))
+    return files
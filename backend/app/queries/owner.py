@@ -1,23 +1,25 @@
 #  For Owners
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 from dns.resolver import resolve_at
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 
-from app.models.models import Owners
+from app.models.models import Owners, Vehicles, Document
+from app.queries.document import document_names
 from app.schemas.user import OwnersCreate, OwnersResponse
+from app.utils.pagination import filter_by_date_range
 
 
-def create_owner(db: Session, owner: OwnersCreate, document_filenames: List[str]):
+def create_owner(db: Session, owner: OwnersCreate, documents: List[Document]):
     new_owner = Owners(
         dni=owner.dni,
         first_name=owner.first_name,
         last_name=owner.last_name,
         email=owner.email,
-        documents=",".join(document_filenames),
+        documents=documents,
         observations=owner.observations,
         bank_account_number=owner.bank_account_number,
         sage_client_number=owner.sage_client_number,
@@ -34,39 +36,51 @@ def create_owner(db: Session, owner: OwnersCreate, document_filenames: List[str]
 
     return new_owner
 
+def owner_to_response(owner) -> OwnersResponse:
+    return OwnersResponse(
+        dni=owner.dni,
+        first_name=owner.first_name,
+        last_name=owner.last_name,
+        email=owner.email,
+        documents=document_names(owner.documents),
+        observations=owner.observations,
+        bank_account_number=owner.bank_account_number,
+        sage_client_number=owner.sage_client_number,
+        phone_number=owner.phone_number,
+        registration_date=owner.registration_date,
+        reduced_mobility_expiration=owner.reduced_mobility_expiration,
+        created_by=owner.created_by,
+        modified_by=owner.modified_by,
+        modification_time=owner.modification_time,
+
+    )
+
+
 # Sample logic to fetch and construct OwnersResponse
 def get_all_owners(db):
     owners_data = db.query(Owners).all()
-    owner_responses = []
-
-    for owner in owners_data:
-        # Wrap single document in a list if it's not already a list
-        documents = owner.documents if isinstance(owner.documents, list) else [owner.documents] if owner.documents else []
-
-        owner_response = OwnersResponse(
-            dni=owner.dni,
-            first_name=owner.first_name,
-            last_name=owner.last_name,
-            email=owner.email,
-            documents=documents,  # This should now be a list of strings
-            observations=owner.observations,
-            bank_account_number=owner.bank_account_number,
-            sage_client_number=owner.sage_client_number,
-            phone_number=owner.phone_number,
-            registration_date=owner.registration_date,
-            reduced_mobility_expiration=owner.reduced_mobility_expiration,
-            created_by=owner.created_by,
-            modified_by=owner.modified_by,
-            modification_time=owner.modification_time,
+    return [owner_to_response(owner) for owner in owners_data]
 
-        )
-        owner_responses.append(owner_response)
 
-    return owner_responses
+def filter_owners_query(
+        db: Session,
+        dni: Optional[str] = None,
+        plate: Optional[str] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+):
+    query = db.query(Owners)
+    if dni:
+        query = query.filter(Owners.dni == dni)
+    if plate:
+        query = query.filter(Owners.dni.in_(
+            db.query(Vehicles.owner_id).filter(Vehicles.lisence_plate == plate)
+        ))
+    return filter_by_date_range(query, Owners.registration_date, date_from, date_to)
 
 def get_owner_by_dni(db:Session, owner_dni: str):
     sql = text("""
-    SELECT dni, first_name, last_name, email, documents, observations, bank_account_number,sage_client_number,phone_number, registration_date, reduced_mobility_expiration, created_by, modified_by, modification_time
+    SELECT dni, first_name, last_name, email, observations, bank_account_number,sage_client_number,phone_number, registration_date, reduced_mobility_expiration, created_by, modified_by, modification_time
     FROM owners
     WHERE dni = :owner_dni
     """)
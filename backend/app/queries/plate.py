@@ -0,0 +1,76 @@
+#  For the subscription_plates link table (the lisence_plate1/2/3 columns, one row per plate)
+from typing import Optional
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from app.models.models import SubscriptionPlate, Subscriptions, Cancellations, ApprovedCancellations, \
+    Subscription_history
+
+PLATE_COLUMNS = ['lisence_plate1', 'lisence_plate2', 'lisence_plate3']
+
+# Model with plate columns -> (its key column, reference column in subscription_plates)
+PLATE_REFERENCES = {
+    Subscriptions: ('id', 'subscription_id'),
+    Cancellations: ('id', 'cancellation_id'),
+    ApprovedCancellations: ('id', 'approved_cancellation_id'),
+    Subscription_history: ('history_id', 'history_id'),
+}
+
+
+def plate_filter(model, plate: str):
+    """Criterion for the rows of model with plate in any of their three plate columns"""
+    key, reference = PLATE_REFERENCES[model]
+    return getattr(model, key).in_(
+        select(getattr(SubscriptionPlate, reference)).where(SubscriptionPlate.lisence_plate == plate)
+    )
+
+
+def plate_registered(db: Session, plate: str, subscription_type_id: int,
+                     exclude_subscription_id: Optional[int] = None) -> bool:
+    """Whether another subscription of the type has the plate (ix_subscription_plates_active)"""
+    query = db.query(SubscriptionPlate.id).filter(
+        SubscriptionPlate.subscription_type_id == subscription_type_id,
+        SubscriptionPlate.lisence_plate == plate,
+        SubscriptionPlate.subscription_id.isnot(None),
+    )
+    if exclude_subscription_id is not None:
+        query = query.filter(SubscriptionPlate.subscription_id != exclude_subscription_id)
+    return query.first() is not None
+
+
+def sync_plates(record):
+    """Make record.plates match its plate columns"""
+    wanted = {}
+    for position, column in enumerate(PLATE_COLUMNS, 1):
+        plate = getattr(record, column)
+        if plate and plate not in wanted:
+            wanted[plate] = position
+
+    # Matched by plate, not position: swapping two plates only updates positions, so it never
+    # collides with the unique index (deletes are flushed after inserts)
+    for link in list(record.plates):
+        if link.lisence_plate in wanted:
+            link.position = wanted.pop(link.lisence_plate)
+            link.subscription_type_id = record.subscription_type_id
+        else:
+            record.plates.remove(link)
+    for plate, position in wanted.items():
+        record.plates.append(SubscriptionPlate(lisence_plate=plate, position=position,
+                                               subscription_type_id=record.subscription_type_id))
+
+
+def plates_changed(record) -> bool:
+    state = inspect(record)
+    return any(state.attrs[name].history.has_changes() for name in PLATE_COLUMNS + ['subscription_type_id'])
+
+
+@event.listens_for(Session, 'before_flush')
+def sync_subscription_plates(session, flush_context, instances):
+    for instance in session.new:
+        if type(instance) in PLATE_REFERENCES:
+            sync_plates(instance)
+    # Only records whose plates or type changed, the others would load their plates for nothing
+    for instance in session.dirty:
+        if type(instance) in PLATE_REFERENCES and instance not in session.deleted and plates_changed(instance):
+            sync_plates(instance)
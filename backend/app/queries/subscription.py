@@ -1,7 +1,11 @@
+from datetime import datetime
+from typing import Optional
+
 from sqlalchemy.orm import Session
 
 from app.models.models import Subscription_types, Subscriptions
 from app.schemas.subscription import Subscription_Types_Create, SubscriptionCreate
+from app.utils.pagination import filter_by_plate, filter_by_date_range
 
 
 # CRUD for Subscription Types
@@ -36,6 +40,22 @@ def create_subscription_query(db: Session, subscription: SubscriptionCreate):
 def get_subscriptions_query(db: Session):
     return db.query(Subscriptions).all()  # Remove trailing comma
 
+def filter_subscriptions_query(
+        db: Session,
+        owner_dni: Optional[str] = None,
+        plate: Optional[str] = None,
+        subscription_type_id: Optional[int] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+):
+    query = db.query(Subscriptions)
+    if owner_dni:
+        query = query.filter(Subscriptions.owner_id == owner_dni)
+    if subscription_type_id is not None:
+        query = query.filter(Subscriptions.subscription_type_id == subscription_type_id)
+    query = filter_by_plate(query, Subscriptions, plate)
+    return filter_by_date_range(query, Subscriptions.registration_date, date_from, date_to)
+
 def get_subscription_by_id_query(db: Session, id: int):
     subscription = db.query(Subscriptions).filter(Subscriptions.id == id).first()
     return subscription
@@ -1,14 +1,16 @@
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 from sqlalchemy import text
 
 from sqlalchemy.orm import Session
 
-from app.models.models import Vehicles
+from app.models.models import Vehicles, Document
+from app.queries.document import document_names
 from app.schemas.vehicle import VehicleCreate, VehicleResponse
+from app.utils.pagination import filter_by_date_range
 
 
-def add_vehicle(db: Session, vehicle: VehicleCreate, document_filenames: List[str]):
+def add_vehicle(db: Session, vehicle: VehicleCreate, documents: List[Document]):
     # Creating an instance of Vehicle model using the data from vehicle
     new_vehicle = Vehicles(
         lisence_plate=vehicle.lisence_plate,
@@ -16,7 +18,7 @@ def add_vehicle(db: Session, vehicle: VehicleCreate, document_filenames: List[st
         model=vehicle.model,
         vehicle_type=vehicle.vehicle_type,
         owner_id=vehicle.owner_id,
-        documents=",".join(document_filenames),
+        documents=documents,
         observations=vehicle.observations,
         registration_date=datetime.now(),
         created_by=vehicle.created_by,
@@ -35,37 +37,46 @@ def add_vehicle(db: Session, vehicle: VehicleCreate, document_filenames: List[st
     return new_vehicle
 
 
-def get_all_vehicles(db):
-    vehicles_data = db.query(Vehicles).all()
-    vehicles_responses = []
+def vehicle_to_response(vehicle) -> VehicleResponse:
+    return VehicleResponse(
+        lisence_plate=vehicle.lisence_plate,
+        brand=vehicle.brand,
+        model=vehicle.model,
+        vehicle_type=vehicle.vehicle_type,
+        owner_id=vehicle.owner_id,
+        documents=document_names(vehicle.documents),
+        observations=vehicle.observations,
+        registration_date=datetime.now(),
+        created_by=vehicle.created_by,
+        modified_by=vehicle.modified_by,
+        modification_time=vehicle.modification_time,
 
-    for vehicle in vehicles_data:
-        # Wrap single document in a list if it's not already a list
-        documents = vehicle.documents if isinstance(vehicle.documents, list) else [
-            vehicle.documents] if vehicle.documents else []
+    )
 
-        vehicle_response = VehicleResponse(
-            lisence_plate=vehicle.lisence_plate,
-            brand=vehicle.brand,
-            model=vehicle.model,
-            vehicle_type=vehicle.vehicle_type,
-            owner_id=vehicle.owner_id,
-            documents=documents,
-            observations=vehicle.observations,
-            registration_date=datetime.now(),
-            created_by=vehicle.created_by,
-            modified_by=vehicle.modified_by,
-            modification_time=vehicle.modification_time,
 
-        )
-        vehicles_responses.append(vehicle_response)
+def get_all_vehicles(db):
+    vehicles_data = db.query(Vehicles).all()
+    return [vehicle_to_response(vehicle) for vehicle in vehicles_data]
+
 
-    return vehicles_responses
+def filter_vehicles_query(
+        db: Session,
+        owner_dni: Optional[str] = None,
+        plate: Optional[str] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+):
+    query = db.query(Vehicles)
+    if owner_dni:
+        query = query.filter(Vehicles.owner_id == owner_dni)
+    if plate:
+        query = query.filter(Vehicles.lisence_plate == plate)
+    return filter_by_date_range(query, Vehicles.registration_date, date_from, date_to)
 
 
 def get_vehicle(db: Session, lisence_plate: str):
     sql = text("""
-    SELECT lisence_plate, brand, model, vehicle_type, owner_id, documents, observations, registration_date, created_by, modified_by, modification_time
+    SELECT lisence_plate, brand, model, vehicle_type, owner_id, observations, registration_date, created_by, modified_by, modification_time
     FROM vehicles
     WHERE lisence_plate = :lisence_plate
     """)
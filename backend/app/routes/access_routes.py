@@ -0,0 +1,51 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException
+
+from app.schemas.access import AccessBatch, AccessResult
+from app.utils.access_index import CREDENTIAL_COLUMNS, lookup_credential
+from app.utils.gate_events import DIRECTIONS
+from app.utils.presence import ANTI_PASSBACK, subscription_inside
+
+router = APIRouter()
+
+
+def check_credential(kind: str, value: str, direction: Optional[str] = None,
+                     parking_lot_id: Optional[int] = None) -> AccessResult:
+    if kind not in CREDENTIAL_COLUMNS:
+        raise HTTPException(status_code=400,
+                            detail="kind debe ser plate, access_card, remote_control_number o tique_x_park")
+    if direction is not None and direction not in DIRECTIONS:
+        raise HTTPException(status_code=400, detail="direction debe ser entry o exit")
+    authorization = lookup_credential(kind, value, parking_lot_id)
+    if authorization is None:
+        other_lot = lookup_credential(kind, value) if parking_lot_id is not None else None
+        if other_lot is not None:
+            # Subscribed, but in another parking lot
+            return AccessResult(kind=kind, value=value, authorized=False, reason="wrong_parking_lot",
+                                **other_lot._asdict())
+        return AccessResult(kind=kind, value=value, authorized=False, reason="not_subscribed")
+    if direction == 'entry' and ANTI_PASSBACK:
+        # Another plate or card of the subscription is inside (see app/utils/presence.py)
+        inside_parking_lot_id = subscription_inside(authorization.subscription_id)
+        if inside_parking_lot_id is not None:
+            return AccessResult(kind=kind, value=value, authorized=False, reason="anti_passback",
+                                inside_parking_lot_id=inside_parking_lot_id, **authorization._asdict())
+    return AccessResult(kind=kind, value=value, authorized=True, **authorization._asdict())
+
+
+# async: lookups only read the in-memory index and presence, no need for a worker thread
+@router.get("/access/{kind}/{value}", response_model=AccessResult)
+async def check_access(kind: str, value: str, direction: Optional[str] = None, parking_lot_id: Optional[int] = None):
+    """
+    Whether a plate, access card, remote control or tique x park belongs to a subscription (gate
+    cameras), of the gate's parking lot when parking_lot_id is given
+    """
+    return check_credential(kind, value, direction, parking_lot_id)
+
+
+@router.post("/access/check", response_model=List[AccessResult])
+async def check_access_batch(batch: AccessBatch):
+    """Several credentials at once, results in the same order"""
+    return [check_credential(check.kind, check.value, check.direction, check.parking_lot_id)
+            for check in batch.checks]
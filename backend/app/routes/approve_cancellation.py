@@ -1,10 +1,14 @@
 from datetime import datetime
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 
 from app.db.database import get_db
 from app.models.models import Cancellations, ApprovedCancellations, Subscription_history
+from app.queries.document import document_list
+from app.utils.occupancy import apply_occupancy_change
+from app.utils.pagination import PageParams, paginate_query, filter_by_plate, filter_by_date_range
 
 router = APIRouter()
 
@@ -31,7 +35,7 @@ async def approve_cancellation(
         lisence_plate1=cancellation.lisence_plate1,
         lisence_plate2=cancellation.lisence_plate2,
         lisence_plate3=cancellation.lisence_plate3,
-        documents=cancellation.documents,
+        documents=document_list(cancellation.documents),
         tique_x_park=cancellation.tique_x_park,
         remote_control_number=cancellation.remote_control_number,
         observations=cancellation.observations,
@@ -55,7 +59,7 @@ async def approve_cancellation(
         lisence_plate2=cancellation.lisence_plate2,
         lisence_plate3=cancellation.lisence_plate3,
         tique_x_park=cancellation.tique_x_park,
-        documents=cancellation.documents,
+        documents=document_list(cancellation.documents),
         remote_control_number=cancellation.remote_control_number,
         observations=cancellation.observations,
         registration_date=cancellation.registration_date,
@@ -73,6 +77,7 @@ async def approve_cancellation(
         db.add(approved_cancellation)
 
         # Delete the original cancellation record
+        apply_occupancy_change(db, cancellation.subscription_type_id, cancellations=-1)
         db.delete(cancellation)
 
         # Commit all changes
@@ -89,14 +94,38 @@ async def approve_cancellation(
 
 @router.get("/api/approved-cancellations")
 async def get_approved_cancellations(
+        owner_dni: Optional[str] = Query(None),
+        plate: Optional[str] = Query(None),
+        subscription_type_id: Optional[int] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Effective cancellation date from"),
+        date_to: Optional[datetime] = Query(None, description="Effective cancellation date to"),
+        page: PageParams = Depends(),
         db: Session = Depends(get_db)
 ):
     """
-    Get all approved cancellations.
+    Get approved cancellations, one keyset page at a time (or all of them with ?all=true).
     """
+    query = db.query(ApprovedCancellations)
+    if owner_dni:
+        query = query.filter(ApprovedCancellations.owner_id == owner_dni)
+    if subscription_type_id is not None:
+        query = query.filter(ApprovedCancellations.subscription_type_id == subscription_type_id)
+    query = filter_by_plate(query, ApprovedCancellations, plate)
+    query = filter_by_date_range(query, ApprovedCancellations.effective_cancellation_date, date_from, date_to)
+
     try:
-        approved_cancellations = db.query(ApprovedCancellations).all()
-        return {"approved_cancellations": approved_cancellations}
+        if page.unpaginated:
+            approved_cancellations = query.order_by(ApprovedCancellations.id).all()
+            return {"approved_cancellations": approved_cancellations}
+
+        approved_cancellations, next_cursor = paginate_query(query, ApprovedCancellations.id, page.cursor, page.limit)
+        return {
+            "approved_cancellations": approved_cancellations,
+            "next_cursor": next_cursor,
+            "limit": page.limit,
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching approved cancellations: {str(e)}")
 
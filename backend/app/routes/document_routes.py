@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Request
+
+from app.utils.document_serving import document_response
+
+router = APIRouter()
+
+
+@router.get("/uploads/{filename}")
+@router.head("/uploads/{filename}")
+def get_owner_file(filename: str, request: Request):
+    return document_response(request, "uploads", filename)
+
+
+@router.get("/vehicle_uploads/{filename}")
+@router.head("/vehicle_uploads/{filename}")
+def get_vehicle_file(filename: str, request: Request):
+    return document_response(request, "vehicle_uploads", filename)
+
+
+@router.get("/subscription_files/{filename}")
+@router.head("/subscription_files/{filename}")
+def get_subscription_file(filename: str, request: Request):
+    return document_response(request, "subscription_files", filename)
+
+
+@router.get("/cancelled_subscription_files/{filename}")
+@router.head("/cancelled_subscription_files/{filename}")
+def get_cancelled_subscription_file(filename: str, request: Request):
+    return document_response(request, "cancelled_subscription_files", filename)
@@ -0,0 +1,59 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from starlette.responses import FileResponse
+
+from app.db.database import get_db
+from app.models.models import ExportJob
+from app.schemas.export_job import ExportJobCreate, ExportJobResponse
+from app.utils.export_helper import EXPORT_MEDIA_TYPES, get_export_dataset
+from app.utils.export_jobs import submit_export_job, export_file_exists
+
+router = APIRouter()
+
+
+def export_job_to_response(job: ExportJob, cached: bool = False) -> ExportJobResponse:
+    response = ExportJobResponse.from_orm(job)
+    response.cached = cached
+    if job.status == 'done':
+        response.download_url = f"/export-jobs/{job.id}/download"
+    return response
+
+
+def get_export_job_or_404(db: Session, job_id: str) -> ExportJob:
+    job = db.query(ExportJob).filter(ExportJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return job
+
+
+@router.post("/export-jobs/", response_model=ExportJobResponse, status_code=202)
+def create_export_job(job_request: ExportJobCreate, db: Session = Depends(get_db)):
+    """
+    Queue an export of subscriptions, owners, vehicles, cancellations or a history table.
+    Returns at once; poll GET /export-jobs/{id} until the status is 'done' and download the file.
+    """
+    try:
+        job, cached = submit_export_job(db, job_request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return export_job_to_response(job, cached)
+
+
+@router.get("/export-jobs/{job_id}", response_model=ExportJobResponse)
+def get_export_job(job_id: str, db: Session = Depends(get_db)):
+    return export_job_to_response(get_export_job_or_404(db, job_id))
+
+
+@router.get("/export-jobs/{job_id}/download")
+def download_export_job(job_id: str, db: Session = Depends(get_db)):
+    job = get_export_job_or_404(db, job_id)
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"Export job is {job.status}")
+    if not export_file_exists(job):
+        raise HTTPException(status_code=410, detail="Export file has expired, submit the export again")
+
+    if job.dataset == 'work_orders':
+        filename = f"ordenes_de_trabajo_{job.created_at:%Y%m%d_%H%M%S}.zip"
+    else:
+        filename = f"{get_export_dataset(job.dataset)['title']}_export.{job.export_format}"
+    return FileResponse(job.file_path, media_type=EXPORT_MEDIA_TYPES[job.export_format], filename=filename)
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+
+from app.db.database import get_db
+from app.models.models import ParkingLot
+from app.schemas.gate_event import GateEventBatch, GateEventBatchResult
+from app.utils.access_index import CREDENTIAL_COLUMNS, lookup_credential, normalize_credential
+from app.utils.gate_events import DIRECTIONS, enqueue_gate_events, pending_gate_events
+from app.utils.presence import vehicle_class_for
+
+router = APIRouter()
+
+
+def local_time(value: datetime) -> datetime:
+    """Naive local time like the other timestamps, for times sent with a UTC offset"""
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+
+
+@router.post("/gate-events", response_model=GateEventBatchResult, status_code=202)
+def ingest_gate_events(batch: GateEventBatch, db: Session = Depends(get_db)):
+    """
+    Entry and exit events of the gates, written to gate_events in the background. The batch is
+    accepted or refused as a whole: 400 for an invalid event, 429 when the buffer is full.
+    """
+    lot_ids = {event.parking_lot_id for event in batch.events}
+    known_lots = {row.id for row in db.query(ParkingLot.id).filter(ParkingLot.id.in_(lot_ids))}
+
+    received_at = datetime.now()
+    rows = []
+    for position, event in enumerate(batch.events):
+        if event.parking_lot_id not in known_lots:
+            raise HTTPException(status_code=400,
+                                detail=f"Evento {position}: parking {event.parking_lot_id} no encontrado")
+        if event.direction not in DIRECTIONS:
+            raise HTTPException(status_code=400, detail=f"Evento {position}: direction debe ser entry o exit")
+        if event.kind not in CREDENTIAL_COLUMNS:
+            raise HTTPException(status_code=400,
+                                detail=f"Evento {position}: kind debe ser plate, access_card, "
+                                       f"remote_control_number o tique_x_park")
+        credential = normalize_credential(event.kind, event.value)
+        if not credential:
+            raise HTTPException(status_code=400, detail=f"Evento {position}: value vacío")
+        # The subscription of this lot, if the credential has several; one of another lot still
+        # tracks the vehicle by its subscription
+        authorization = lookup_credential(event.kind, credential, event.parking_lot_id) \
+            or lookup_credential(event.kind, credential)
+        rows.append(dict(
+            parking_lot_id=event.parking_lot_id,
+            gate=event.gate,
+            direction=event.direction,
+            credential_kind=event.kind,
+            credential=credential,
+            subscription_id=authorization.subscription_id if authorization else None,
+            vehicle_class=vehicle_class_for(db, authorization.subscription_type_id if authorization else None),
+            occurred_at=local_time(event.occurred_at) if event.occurred_at else received_at,
+            received_at=received_at,
+        ))
+
+    enqueue_gate_events(rows)
+    return GateEventBatchResult(accepted=len(rows), pending=pending_gate_events())
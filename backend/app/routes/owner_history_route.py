@@ -1,21 +1,60 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional, Union
 
-from fastapi import Depends, HTTPException, APIRouter
+from fastapi import Depends, HTTPException, APIRouter, Query, Request
 from sqlalchemy.orm import Session
 
 from app.db.database import get_db
 from app.models.models import Owners_history
 from app.schemas.owner_history import OwnerHistoryResponse
-
+from app.schemas.pagination import Page
+from app.utils.pagination import PageParams, paginate_query, filter_by_date_range
+from app.utils.streaming import wants_ndjson, ndjson_response
 
 router = APIRouter()
 
-@router.get("/owner_histories/", response_model=List[OwnerHistoryResponse])
-async def get_all_owner_histories(db: Session = Depends(get_db)):
-    owner_histories = db.query(Owners_history).all()  # Get all records
 
-    # Convert SQLAlchemy objects to dictionaries or Pydantic models
-    return [OwnerHistoryResponse(**history.__dict__) for history in owner_histories]
+def filter_owner_histories_query(
+        db: Session,
+        dni: Optional[str] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+):
+    query = db.query(Owners_history)
+    if dni:
+        query = query.filter(Owners_history.dni == dni)
+    return filter_by_date_range(query, Owners_history.modification_time, date_from, date_to)
+
+
+@router.get("/owner_histories/", response_model=Union[Page[OwnerHistoryResponse], List[OwnerHistoryResponse]])
+async def get_all_owner_histories(
+        request: Request,
+        dni: Optional[str] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Modification time from"),
+        date_to: Optional[datetime] = Query(None, description="Modification time to"),
+        page: PageParams = Depends(),
+        db: Session = Depends(get_db)
+):
+    if wants_ndjson(request):
+        return ndjson_response(
+            lambda session: filter_owner_histories_query(session, dni, date_from, date_to),
+            Owners_history.history_id,
+            lambda history: OwnerHistoryResponse(**history.__dict__),
+        )
+
+    query = filter_owner_histories_query(db, dni, date_from, date_to)
+
+    if page.unpaginated:
+        owner_histories = query.order_by(Owners_history.history_id).all()  # Get all records
+        # Convert SQLAlchemy objects to dictionaries or Pydantic models
+        return [OwnerHistoryResponse(**history.__dict__) for history in owner_histories]
+
+    owner_histories, next_cursor = paginate_query(query, Owners_history.history_id, page.cursor, page.limit)
+    return Page[OwnerHistoryResponse](
+        items=[OwnerHistoryResponse(**history.__dict__) for history in owner_histories],
+        next_cursor=next_cursor,
+        limit=page.limit,
+    )
 
 # Get owner history by ID
 @router.get("/owner_histories/{history_id}", response_model=OwnerHistoryResponse)
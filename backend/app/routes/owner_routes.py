@@ -1,18 +1,28 @@
 import os
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Union
 
 from pydantic import EmailStr
 from sqlalchemy import column
 from sqlalchemy.orm import Session
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Query, Request
 from fastapi.params import Depends
+from fastapi.responses import StreamingResponse
 from starlette.staticfiles import StaticFiles
 
 from app.db.database import get_db
 from app.models.models import Owners, Subscriptions, Vehicles, Owners_history
 from app.schemas.user import OwnersCreate, OwnersResponse
-from app.queries.owner import create_owner, get_all_owners, get_owner_by_dni
+from app.queries.owner import create_owner, filter_owners_query, owner_to_response
+from app.queries.document import add_document, remove_document, document_names, document_list, owner_document_files
+from app.schemas.pagination import Page
+from app.utils.pagination import PageParams, paginate_query
+from app.utils.streaming import wants_ndjson, ndjson_response
+from app.utils.occupancy import apply_occupancy_change
+from app.utils.uploads import check_upload_sizes
+from app.utils.document_store import stage_documents, store_staged_document, discard_staged_documents, \
+    release_document
+from app.utils.zip_stream import iter_zip, ZIP_MEDIA_TYPE
 
 router = APIRouter()
 
@@ -49,13 +59,18 @@ async def create_owner_endpoint(
         created_by: str = Form(...),
         db: Session = Depends(get_db)
 ):
-    document_filenames = []
-    for document in documents:
-        filename = f"{dni}_{document.filename}"
-        file_location = os.path.join(UPLOAD_DIR, filename)
-        with open(file_location, "wb+") as file_object:
-            file_object.write(await document.read())
-        document_filenames.append(filename)
+    check_upload_sizes(documents)
+    # Every upload is read before the first write, see stage_documents
+    staged_documents = await stage_documents(documents)
+    try:
+        owner_documents = []
+        for document, staged in zip(documents, staged_documents):
+            filename = f"{dni}_{document.filename}"
+            file_location = os.path.join(UPLOAD_DIR, filename)
+            size, checksum = store_staged_document(db, staged, file_location)
+            add_document(owner_documents, filename, size, checksum)
+    finally:
+        discard_staged_documents(staged_documents)
 
     reduced_mobility_expiration_date = convert_str_to_datetime(reduced_mobility_expiration)
 
@@ -73,7 +88,7 @@ async def create_owner_endpoint(
         created_by=created_by,
     )
 
-    new_owner = create_owner(db, owner_data, document_filenames)
+    new_owner = create_owner(db, owner_data, owner_documents)
 
     # Track the history upon creation
     history_entry = Owners_history(
@@ -81,7 +96,7 @@ async def create_owner_endpoint(
         first_name=new_owner.first_name,
         last_name=new_owner.last_name,
         email=new_owner.email,
-        documents=','.join(document_filenames),
+        documents=document_list(new_owner.documents),
         observations=new_owner.observations,
         bank_account_number=new_owner.bank_account_number,
         sage_client_number=new_owner.sage_client_number,
@@ -99,7 +114,7 @@ async def create_owner_endpoint(
         first_name=new_owner.first_name,
         last_name=new_owner.last_name,
         email=new_owner.email,
-        documents=document_filenames,
+        documents=document_names(new_owner.documents),
         observations=new_owner.observations,
         bank_account_number=new_owner.bank_account_number,
         sage_client_number=new_owner.sage_client_number,
@@ -111,35 +126,30 @@ async def create_owner_endpoint(
     )
 
 
-async def handle_document_updates(owner, new_documents: List[UploadFile], remove_documents: List[str]):
-    # Get current documents
-    current_documents = owner.documents.split(',') if owner.documents else []
-
-    # Handle document removal
-    updated_documents = []
-    for doc in current_documents:
-        if doc not in remove_documents:
-            updated_documents.append(doc)
-        else:
-            # Delete the file from the server
-            file_path = os.path.join(UPLOAD_DIR, doc)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-    # Handle new document uploads
-    for document in new_documents:
-        filename = f"{owner.dni}_{document.filename}"  # Prefix with DNI to avoid conflicts
-        file_location = os.path.join(UPLOAD_DIR, filename)
-        try:
-            with open(file_location, "wb") as file:
-                content = await document.read()
-                file.write(content)
-            updated_documents.append(filename)
-        except IOError:
-            raise HTTPException(status_code=500, detail=f"Could not write file: {filename}")
-
-    # Update the owner's documents
-    owner.documents = ','.join(updated_documents) if updated_documents else None
+async def handle_document_updates(owner, new_documents: List[UploadFile], remove_documents: List[str], db: Session):
+    check_upload_sizes(new_documents)
+    # Every upload is read before the first write, see stage_documents
+    staged_documents = await stage_documents(new_documents)
+    try:
+        # Handle document removal
+        for filename in remove_documents:
+            if remove_document(db, owner.documents, filename):
+                # Delete the file from the server
+                file_path = os.path.join(UPLOAD_DIR, filename)
+                release_document(db, file_path)
+
+        # Handle new document uploads
+        for document, staged in zip(new_documents, staged_documents):
+            filename = f"{owner.dni}_{document.filename}"  # Prefix with DNI to avoid conflicts
+            file_location = os.path.join(UPLOAD_DIR, filename)
+            try:
+                size, checksum = store_staged_document(db, staged, file_location)
+                add_document(owner.documents, filename, size, checksum)
+            except IOError:
+                raise HTTPException(status_code=500, detail=f"Could not write file: {filename}")
+    finally:
+        discard_staged_documents(staged_documents)
+
     return owner
 
 
@@ -211,10 +221,10 @@ async def edit_owner_endpoint(
         update_field('modification_time', datetime.now())
 
     # Handle document updates
-    old_documents = owner.documents
-    owner = await handle_document_updates(owner, new_documents, remove_documents)
-    if old_documents != owner.documents:
-        changes.append(('documents', old_documents, owner.documents))
+    old_documents = document_list(owner.documents)
+    owner = await handle_document_updates(owner, new_documents, remove_documents, db)
+    if old_documents != document_list(owner.documents):
+        changes.append(('documents', old_documents, document_list(owner.documents)))
 
     # If there are valid changes, log them in Owners_history
     if changes:
@@ -223,7 +233,7 @@ async def edit_owner_endpoint(
             first_name=owner.first_name,
             last_name=owner.last_name,
             email=owner.email,
-            documents=owner.documents,
+            documents=document_list(owner.documents),
             observations=owner.observations,
             bank_account_number=owner.bank_account_number,
             sage_client_number=owner.sage_client_number,
@@ -248,7 +258,7 @@ async def edit_owner_endpoint(
         first_name=owner.first_name,
         last_name=owner.last_name,
         email=owner.email,
-        documents=owner.documents.split(',') if owner.documents else [],
+        documents=document_names(owner.documents),
         observations=owner.observations,
         bank_account_number=owner.bank_account_number,
         sage_client_number=owner.sage_client_number,
@@ -262,36 +272,56 @@ async def edit_owner_endpoint(
 
 @router.get("/owner/{dni}", response_model=OwnersResponse)
 def get_owner_endpoint(owner_dni: str, db: Session = Depends(get_db)):
-    owner = get_owner_by_dni(db=db, owner_dni=owner_dni)
+    owner = db.query(Owners).filter(Owners.dni == owner_dni).first()
 
     if owner is None:
         raise HTTPException(status_code=404, detail="Owner not found")
 
-    # Build owner_data from the result of the raw SQL query
-    owner_data = {
-        'dni': owner.dni,
-        'first_name': owner.first_name,
-        'last_name': owner.last_name,
-        'email': owner.email,
-        'documents': owner.documents.split(',') if owner.documents else [],
-        'observations': owner.observations,
-        'bank_account_number': owner.bank_account_number,
-        'sage_client_number': owner.sage_client_number,
-        'phone_number': owner.phone_number,
-        'registration_date': owner.registration_date,
-        'reduced_mobility_expiration': owner.reduced_mobility_expiration,
-        'created_by': owner.created_by,
-        'modified_by': owner.modified_by,
-        'modification_time':owner.modification_time,
-    }
-
-    return OwnersResponse(**owner_data)
-
-
-@router.get("/owners/", response_model=list[OwnersResponse])
-def get_owners_endpoint(db: Session = Depends(get_db)):
-    owners = get_all_owners(db)
-    return owners
+    return owner_to_response(owner)
+
+
+@router.get("/owner/{dni}/documents/zip")
+def download_owner_documents(dni: str, db: Session = Depends(get_db)):
+    """Every document of the owner, their vehicles, subscriptions and cancellations as a ZIP streamed as it is built"""
+    if not db.query(Owners.dni).filter(Owners.dni == dni).first():
+        raise HTTPException(status_code=404, detail="Owner not found")
+
+    files = owner_document_files(db, dni)
+    if not files:
+        raise HTTPException(status_code=404, detail="El propietario no tiene documentos")
+
+    return StreamingResponse(iter_zip(files), media_type=ZIP_MEDIA_TYPE,
+                             headers={'Content-Disposition': f'attachment; filename="documentos_{dni}.zip"'})
+
+
+@router.get("/owners/", response_model=Union[Page[OwnersResponse], list[OwnersResponse]])
+def get_owners_endpoint(
+        request: Request,
+        dni: Optional[str] = Query(None),
+        plate: Optional[str] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Registration date from"),
+        date_to: Optional[datetime] = Query(None, description="Registration date to"),
+        page: PageParams = Depends(),
+        db: Session = Depends(get_db)
+):
+    if wants_ndjson(request):
+        return ndjson_response(
+            lambda session: filter_owners_query(session, dni, plate, date_from, date_to),
+            Owners.dni,
+            owner_to_response,
+        )
+
+    query = filter_owners_query(db, dni, plate, date_from, date_to)
+
+    if page.unpaginated:
+        return [owner_to_response(owner) for owner in query.order_by(Owners.dni).all()]
+
+    owners, next_cursor = paginate_query(query, Owners.dni, page.cursor, page.limit)
+    return Page[OwnersResponse](
+        items=[owner_to_response(owner) for owner in owners],
+        next_cursor=next_cursor,
+        limit=page.limit,
+    )
 
 
 @router.delete("/owner/{dni}/", response_model=dict)
@@ -309,7 +339,7 @@ async def delete_owner_endpoint(dni: str, deleted_by: str = "system", db: Sessio
         first_name=owner.first_name,
         last_name=owner.last_name,
         email=owner.email,
-        documents=owner.documents,
+        documents=document_list(owner.documents),
         observations=f"DELETED: {owner.observations or ''}" if owner.observations else "DELETED",
         bank_account_number=owner.bank_account_number,
         sage_client_number=owner.sage_client_number,
@@ -322,13 +352,12 @@ async def delete_owner_endpoint(dni: str, deleted_by: str = "system", db: Sessio
     )
     db.add(deletion_history_entry)
     
-    # Remove associated documents
-    if owner.documents:
-        for doc in owner.documents.split(','):
-            file_path = os.path.join(UPLOAD_DIR, doc.split('/')[-1])  # Get the filename
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"Removed file: {file_path}")
+    # Remove associated documents (their rows are deleted with the owner)
+    for filename in document_names(owner.documents):
+        file_path = os.path.join(UPLOAD_DIR, filename)
+        if os.path.lexists(file_path):
+            release_document(db, file_path)
+            print(f"Removed file: {file_path}")
 
     # Delete associated vehicles
     vehicles = db.query(Vehicles).filter(Vehicles.owner_id == owner.dni).all()
@@ -339,6 +368,7 @@ async def delete_owner_endpoint(dni: str, deleted_by: str = "system", db: Sessio
     # Delete associated subscriptions
     subscriptions = db.query(Subscriptions).filter(Subscriptions.owner_id == owner.dni).all()
     for subscription in subscriptions:
+        apply_occupancy_change(db, subscription.subscription_type_id, subscriptions=-1)
         db.delete(subscription)
         print(f"Deleted subscription: {subscription}")
 
@@ -364,7 +394,7 @@ def get_reduced_mobility_owners(db: Session = Depends(get_db)):
             'first_name': owner.first_name,
             'last_name': owner.last_name,
             'email': owner.email,
-            'documents': owner.documents.split(',') if owner.documents else [],  # Convert string to list or empty list
+            'documents': document_names(owner.documents),
             'observations': owner.observations,
             'bank_account_number': owner.bank_account_number,
             'sage_client_number': owner.sage_client_number,
@@ -3,12 +3,14 @@ from sqlalchemy.orm import Session
 from typing import List, Dict
 from app.db.database import get_db
 
-from app.models.models import ParkingLot, Subscription_types, Subscriptions, Cancellations
+from app.models.models import ParkingLot, Subscription_types, Subscriptions, Cancellations, ParkingLotOccupancy
 from app.schemas.subscription import Subscription_Types_Response
 from app.queries.subscription import get_subscriptions_query
 
 from app.schemas.parking_lot_config import ParkingLotCreate, ParkingLotResponse, \
-    ParkingLotStatsResponse, ParkingLotStats
+    ParkingLotStatsResponse, ParkingLotStats, ParkingLotLiveOccupancy, VehicleInside
+from app.utils.occupancy import rebuild_lot_occupancy, classify_subscription_types
+from app.utils.presence import lot_presence, vehicles_inside
 
 router = APIRouter()
 
@@ -20,6 +22,10 @@ async def create_parking_lot_config(config: ParkingLotCreate, db: Session = Depe
     """
     db_config = ParkingLot(**config.dict())
     db.add(db_config)
+    db.flush()
+    # Attach existing subscription types named after the new lot
+    classify_subscription_types(db)
+    rebuild_lot_occupancy(db, db_config)
     db.commit()
     db.refresh(db_config)
     return db_config
@@ -30,15 +36,14 @@ def update_parking_lot_spaces(db: Session, subscription_type_id: int, change: in
     if not subscription_type:
         raise HTTPException(status_code=400, detail=f"Subscription type with ID {subscription_type_id} does not exist.")
 
-    parking_lot_name = subscription_type.name.split()[0]  # Assumes the parking lot name is the first word in the subscription type name
-    parking_lot = db.query(ParkingLot).filter(ParkingLot.name == parking_lot_name).first()
+    parking_lot = subscription_type.parking_lot
     if not parking_lot:
-        raise HTTPException(status_code=400, detail=f"Parking lot {parking_lot_name} does not exist.")
+        raise HTTPException(status_code=400, detail=f"Subscription type '{subscription_type.name}' is not assigned to a parking lot.")
 
-    if "24H" in subscription_type.name.upper() and "MOTOS" not in subscription_type.name.upper():
+    if subscription_type.consumes_space and subscription_type.vehicle_class == 'car':
         parking_lot.total_car_spaces += change
         print(f"Updated 24H car spaces for {parking_lot.name}: {parking_lot.total_car_spaces}")
-    elif "24H MOTOS" in subscription_type.name.upper():
+    elif subscription_type.consumes_space and subscription_type.vehicle_class == 'motorcycle':
         parking_lot.total_motorcycle_spaces += change
         print(f"Updated 24H motorcycle spaces for {parking_lot.name}: {parking_lot.total_motorcycle_spaces}")
     else:
@@ -49,38 +54,23 @@ def update_parking_lot_spaces(db: Session, subscription_type_id: int, change: in
 
 @router.get("/parking-lot-stats", response_model=Dict[str, ParkingLotStats])
 def get_parking_lot_stats(db: Session = Depends(get_db)):
-    parking_lots = db.query(ParkingLot).all()
-    if not parking_lots:
+    # One read of the incrementally maintained counters, see app/utils/occupancy.py
+    rows = db.query(ParkingLot, ParkingLotOccupancy).outerjoin(
+        ParkingLotOccupancy, ParkingLotOccupancy.parking_lot_id == ParkingLot.id
+    ).all()
+    if not rows:
         raise HTTPException(status_code=404, detail="No parking lot configurations found")
 
     stats = {}
-    for parking_lot in parking_lots:
-        # Filter subscription types based on parking lot name
-        subscription_types = db.query(Subscription_types).filter(
-            Subscription_types.name.startswith(parking_lot.name)
-        ).all()
-
-        # Get subscriptions that belong to the parking lot
-        subscriptions = db.query(Subscriptions).join(Subscription_types).filter(
-            Subscription_types.name.startswith(parking_lot.name)
-        ).all()
-
-        # Get cancellations related to the parking lot
-        cancellations = db.query(Cancellations).join(Subscription_types, Cancellations.subscription_type_id == Subscription_types.id).filter(
-            Subscription_types.name.startswith(parking_lot.name)
-        ).all()
-
-        # Count occupied car spaces based on subscriptions
-        occupied_car_spaces = sum(1 for sub in subscriptions if "24H" in sub.subscription_type.name.upper() and "MOTOS" not in sub.subscription_type.name.upper())
-        occupied_motorcycle_spaces = sum(1 for sub in subscriptions if "24H MOTOS" in sub.subscription_type.name.upper())
-
-        # Count cancellation-related car spaces based on cancellations
-        cancelled_car_spaces = sum(1 for cancel in cancellations if "24H" in cancel.subscription_type.name.upper() and "MOTOS" not in cancel.subscription_type.name.upper())
-        cancelled_motorcycle_spaces = sum(1 for cancel in cancellations if "24H MOTOS" in cancel.subscription_type.name.upper())
+    for parking_lot, occupancy in rows:
+        if occupancy is None:
+            # Counters not initialized yet for this lot
+            occupancy = rebuild_lot_occupancy(db, parking_lot)
+            db.commit()
 
         # Calculate available spaces
-        free_car_spaces = parking_lot.total_car_spaces - occupied_car_spaces - cancelled_car_spaces
-        free_motorcycle_spaces = parking_lot.total_motorcycle_spaces - occupied_motorcycle_spaces - cancelled_motorcycle_spaces
+        free_car_spaces = parking_lot.total_car_spaces - occupancy.occupied_car_spaces - occupancy.cancelled_car_spaces
+        free_motorcycle_spaces = parking_lot.total_motorcycle_spaces - occupancy.occupied_motorcycle_spaces - occupancy.cancelled_motorcycle_spaces
 
         # Determine the status based on available spaces
         if free_car_spaces < parking_lot.min_car_spaces or free_motorcycle_spaces < parking_lot.min_motorcycle_spaces:
@@ -96,9 +86,9 @@ def get_parking_lot_stats(db: Session = Depends(get_db)):
             total_motorcycle_spaces=parking_lot.total_motorcycle_spaces,
             free_car_spaces=free_car_spaces,
             free_motorcycle_spaces=free_motorcycle_spaces,
-            cancellation_count=len(cancellations),
-            cancelled_car_spaces=cancelled_car_spaces,
-            cancelled_motorcycle_spaces=cancelled_motorcycle_spaces,
+            cancellation_count=occupancy.cancellation_count,
+            cancelled_car_spaces=occupancy.cancelled_car_spaces,
+            cancelled_motorcycle_spaces=occupancy.cancelled_motorcycle_spaces,
             status=status
         )
 
@@ -107,6 +97,48 @@ def get_parking_lot_stats(db: Session = Depends(get_db)):
 
 
 
+def live_occupancy(parking_lot: ParkingLot) -> ParkingLotLiveOccupancy:
+    presence = lot_presence(parking_lot.id)
+    return ParkingLotLiveOccupancy(
+        parking_lot_id=parking_lot.id,
+        cars_inside=presence['car'],
+        total_car_spaces=parking_lot.total_car_spaces,
+        free_car_spaces=parking_lot.total_car_spaces - presence['car'],
+        motorcycles_inside=presence['motorcycle'],
+        total_motorcycle_spaces=parking_lot.total_motorcycle_spaces,
+        free_motorcycle_spaces=parking_lot.total_motorcycle_spaces - presence['motorcycle'],
+    )
+
+
+@router.get("/parking-lot-occupancy", response_model=Dict[str, ParkingLotLiveOccupancy])
+def get_parking_lot_occupancy(db: Session = Depends(get_db)):
+    """Vehicles inside each parking lot right now, from the gate events (see app/utils/presence.py)"""
+    parking_lots = db.query(ParkingLot).all()
+    if not parking_lots:
+        raise HTTPException(status_code=404, detail="No parking lot configurations found")
+    return {parking_lot.name: live_occupancy(parking_lot) for parking_lot in parking_lots}
+
+
+@router.get("/parking-lot-occupancy/{parking_lot_id}", response_model=ParkingLotLiveOccupancy)
+def get_lot_occupancy(parking_lot_id: int, db: Session = Depends(get_db)):
+    parking_lot = db.query(ParkingLot).filter(ParkingLot.id == parking_lot_id).first()
+    if not parking_lot:
+        raise HTTPException(status_code=404, detail="Parking lot configuration not found")
+    return live_occupancy(parking_lot)
+
+
+@router.get("/parking-lot-occupancy/{parking_lot_id}/vehicles", response_model=List[VehicleInside])
+def get_vehicles_inside(parking_lot_id: int):
+    """Subscriptions and visitors inside a parking lot right now"""
+    vehicles = []
+    for key, vehicle_class in vehicles_inside(parking_lot_id):
+        if isinstance(key, tuple):
+            vehicles.append(VehicleInside(kind=key[0], value=key[1], vehicle_class=vehicle_class))
+        else:
+            vehicles.append(VehicleInside(subscription_id=key, vehicle_class=vehicle_class))
+    return vehicles
+
+
 @router.get("/parking-lot-config", response_model=List[ParkingLotResponse])
 def get_all_parking_lots(db: Session = Depends(get_db)):
     db_parking_lots = db.query(ParkingLot).all()
@@ -115,7 +147,7 @@ def get_all_parking_lots(db: Session = Depends(get_db)):
 
 @router.get("/subscription-types", response_model=List[Subscription_Types_Response])
 def get_subscription_types(db: Session = Depends(get_db)):
-    subscription_types = db.query(Subscription_types).filter(Subscription_types.name.contains("24H")).all()
+    subscription_types = db.query(Subscription_types).filter(Subscription_types.consumes_space.is_(True)).all()
     return [Subscription_Types_Response.from_orm(st) for st in subscription_types]
 
 
@@ -163,14 +195,9 @@ async def delete_parking_lot_config(config_id: int, db: Session = Depends(get_db
         raise HTTPException(status_code=404, detail="Parking lot configuration not found")
     
     # Check if there are any active subscriptions for this parking lot
-    subscription_types = db.query(Subscription_types).filter(
-        Subscription_types.name.startswith(db_config.name)
-    ).all()
-    
-    subscription_type_ids = [st.id for st in subscription_types]
-    active_subscriptions = db.query(Subscriptions).filter(
-        Subscriptions.subscription_type_id.in_(subscription_type_ids)
-    ).count()
+    active_subscriptions = db.query(Subscriptions).join(
+        Subscription_types, Subscriptions.subscription_type_id == Subscription_types.id
+    ).filter(Subscription_types.parking_lot_id == db_config.id).count()
     
     if active_subscriptions > 0:
         raise HTTPException(
@@ -178,6 +205,10 @@ async def delete_parking_lot_config(config_id: int, db: Session = Depends(get_db
             detail=f"Cannot delete parking lot '{db_config.name}' because it has {active_subscriptions} active subscriptions"
         )
     
+    db.query(ParkingLotOccupancy).filter(ParkingLotOccupancy.parking_lot_id == db_config.id).delete()
+    db.query(Subscription_types).filter(Subscription_types.parking_lot_id == db_config.id).update(
+        {Subscription_types.parking_lot_id: None}, synchronize_session=False
+    )
     db.delete(db_config)
     db.commit()
     return {"message": f"Parking lot '{db_config.name}' deleted successfully"}
@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
+from sqlalchemy import func, select, union_all
 from sqlalchemy.orm import Session
 from typing import List, Dict
 from app.db.database import get_db
@@ -13,56 +14,60 @@ class ParkingLotStat(BaseModel):
     total_expected_billing: float  # New field for total billing
     subscription_breakdown: List[dict]  # [{name: str, count: int, percentage: float, total_billing: float}]
 
-@router.get("/parking-lot-statistics", response_model=Dict[str, ParkingLotStat])
-def get_parking_lot_stats(db: Session = Depends(get_db)):
-    parking_lots = db.query(ParkingLot).all()
-    if not parking_lots:
-        raise HTTPException(status_code=404, detail="No parking lot configurations found")
-
-    stats = {}
-    for parking_lot in parking_lots:
-        # First get all subscription types for this parking lot
-        subscription_types = (
-            db.query(Subscription_types)
-            .filter(Subscription_types.name.startswith(parking_lot.name))
-            .all()
-        )
-
-        # Initialize counts and billing for all subscription types
-        subscription_data = {st.name: {"count": 0, "price": st.price} for st in subscription_types}
 
-        # Count active subscriptions
-        subscriptions = (
-            db.query(Subscriptions)
-            .join(Subscription_types)
-            .filter(Subscription_types.name.startswith(parking_lot.name))
-            .all()
+def get_subscription_type_counts_query():
+    """
+    Build a single grouped query returning one row per (parking lot, subscription type)
+    with the number of active subscriptions plus pending cancellations of that type.
+    """
+    # Subscriptions and cancellations both count towards the lot totals
+    usage = union_all(
+        select(Subscriptions.subscription_type_id.label("subscription_type_id")),
+        select(Cancellations.subscription_type_id.label("subscription_type_id")),
+    ).subquery()
+
+    type_counts = (
+        select(usage.c.subscription_type_id, func.count().label("count"))
+        .group_by(usage.c.subscription_type_id)
+        .subquery()
+    )
+
+    return (
+        select(
+            ParkingLot.id.label("parking_lot_id"),
+            ParkingLot.name.label("parking_lot_name"),
+            Subscription_types.name.label("subscription_type_name"),
+            Subscription_types.price.label("price"),
+            func.coalesce(type_counts.c.count, 0).label("count"),
         )
+        .select_from(ParkingLot)
+        .outerjoin(Subscription_types, Subscription_types.parking_lot_id == ParkingLot.id)
+        .outerjoin(type_counts, type_counts.c.subscription_type_id == Subscription_types.id)
+        .order_by(ParkingLot.id, Subscription_types.id)
+    )
 
-        # Count cancellations for each subscription type
-        cancellations = (
-            db.query(Cancellations)
-            .join(Subscription_types)
-            .filter(Subscription_types.name.startswith(parking_lot.name))
-            .all()
-        )
-
-        total = len(subscriptions) + len(cancellations)
-        total_billing = 0
-
-        # Count subscriptions by type and calculate billing
-        for sub in subscriptions:
-            sub_name = sub.subscription_type.name
-            subscription_data[sub_name]["count"] += 1
-            total_billing += subscription_data[sub_name]["price"]
 
+@router.get("/parking-lot-statistics", response_model=Dict[str, ParkingLotStat])
+def get_parking_lot_stats(db: Session = Depends(get_db)):
+    rows = db.execute(get_subscription_type_counts_query()).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="No parking lot configurations found")
 
+    # Group the rows per parking lot, keeping the subscription types keyed by name
+    subscription_data_by_lot = {}
+    for row in rows:
+        subscription_data = subscription_data_by_lot.setdefault(row.parking_lot_name, {})
+        if row.subscription_type_name is None:
+            # Parking lot without any subscription type
+            continue
+        data = subscription_data.setdefault(row.subscription_type_name, {"count": 0, "price": row.price})
+        data["count"] += row.count
+        data["price"] = row.price
 
-        # Now handle cancellations by adjusting the counts and total billing
-        for cancel in cancellations:
-            cancel_name = cancel.subscription_type.name
-            subscription_data[cancel_name]["count"] += 1
-            total_billing += subscription_data[cancel_name]["price"]
+    stats = {}
+    for parking_lot_name, subscription_data in subscription_data_by_lot.items():
+        total = sum(data["count"] for data in subscription_data.values())
+        total_billing = sum(data["count"] * data["price"] for data in subscription_data.values())
 
         # Calculate percentages and create breakdown
         breakdown = [
@@ -78,7 +83,7 @@ def get_parking_lot_stats(db: Session = Depends(get_db)):
         # Sort breakdown by count (descending)
         breakdown.sort(key=lambda x: x["count"], reverse=True)
 
-        stats[parking_lot.name] = ParkingLotStat(
+        stats[parking_lot_name] = ParkingLotStat(
             total_subscriptions=total,
             total_expected_billing=total_billing,
             subscription_breakdown=breakdown
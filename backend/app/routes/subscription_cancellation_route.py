@@ -1,25 +1,31 @@
 import os
-import shutil
 from bdb import effective
 from datetime import datetime
 from pathlib import PosixPath
-from typing import List
+from typing import List, Optional, Union
 
 
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Query, BackgroundTasks
 from fastapi.logger import logger
 from sqlalchemy.orm import Session
-from starlette.responses import JSONResponse
-from weasyprint import CSS, HTML
+from starlette.responses import JSONResponse, FileResponse
 
 from app.db.database import get_db
 from app.models.models import Subscriptions, Subscription_history, Cancellations, Owners, Vehicles, \
     Subscription_types
 from app.queries.owner import get_owner_by_dni
 from app.queries.vehicle import get_vehicle
-from app.routes.subscription_routes import env
+from app.queries.document import set_documents, cancellation_document_path, document_names, document_list
+from app.schemas.pagination import Page
 from app.schemas.subscription_cancellation import CancellationResponse, CancellationCreate
-from app.utils.work_order_helper import get_next_work_order_number, generate_work_order_filename
+from app.utils.occupancy import apply_occupancy_change
+from app.utils.pagination import PageParams, paginate_query, filter_by_plate, filter_by_date_range
+from app.utils.uploads import check_upload_sizes
+from app.utils.document_store import save_document
+from app.utils.work_order_queue import queue_work_order, schedule_work_order, get_work_order_status, \
+    get_work_order_statuses
+from app.utils.work_order_helper import get_next_work_order_number, generate_work_order_filename, \
+    record_work_order, latest_work_order, restore_work_order_file
 
 router = APIRouter()
 
@@ -28,8 +34,11 @@ UPLOAD_DIR = PosixPath(base_path) / "cancelled_subscription_files"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 
-async def generate_cancellation_work_order_pdf(cancelled_subscription: Cancellations, db: Session):
-    """Generate cancellation work order PDF with unique sequential numbering"""
+def build_cancellation_work_order(cancelled_subscription: Cancellations, db: Session) -> tuple[str, dict, str]:
+    """
+    Number a cancellation work order and collect its template data.
+    Returns (template_name, template_data, filename)
+    """
 
     # Get next work order number FIRST - using 'cancellation' counter type
     work_order_num, work_order_formatted = get_next_work_order_number(db, counter_type='cancellation')
@@ -81,46 +90,25 @@ async def generate_cancellation_work_order_pdf(cancelled_subscription: Cancellat
     print(
         f"Generating cancellation work order #{work_order_formatted} for Subscription ID: {safe_get(cancelled_subscription, 'id', 'N/A')}")
 
-    # Render HTML template
-    template = env.get_template('cancellation_work_order_template.html')
-    html_content = template.render(template_data)
-
-    # Generate PDF
-    css = CSS(string='''
-        @page {
-            size: letter;
-            margin: 1cm;
-        }
-        body {
-            font-family: Helvetica, Arial, sans-serif;
-        }
-        h1 {
-            text-align: center;
-        }
-        .checkbox {
-            display: inline-block;
-            width: 10px;
-            height: 10px;
-            border: 1px solid black;
-            margin-right: 5px;
-        }
-        .checked {
-            background-color: black;
-        }
-    ''')
-    pdf = HTML(string=html_content).write_pdf(stylesheets=[css])
-
     # Generate unique filename using "ODTBaja" prefix and work order number
     filename = generate_work_order_filename(work_order_num, order_type='cancellation')
-    file_path = UPLOAD_DIR / filename
+    record_work_order(db, 'cancellation', cancelled_subscription.id, 'cancellation_work_order_template.html',
+                      template_data, UPLOAD_DIR / filename)
+    return 'cancellation_work_order_template.html', template_data, filename
 
-    with open(file_path, "wb") as f:
-        f.write(pdf)
 
-    return filename
+def add_cancellation_work_order(cancelled_subscription: Cancellations, db: Session):
+    """
+    Queue the cancellation work order, committed with the cancellation; the filename is added to
+    the documents once rendered. Returns the PendingWorkOrder to schedule after the commit.
+    """
+    template_name, template_data, filename = build_cancellation_work_order(cancelled_subscription, db)
+    return queue_work_order(db, 'cancellation', cancelled_subscription.id, template_name, template_data,
+                            UPLOAD_DIR / filename)
 
 @router.post("/subscriptions/cancel", response_model=CancellationResponse)
-async def cancel_subscription(request: CancellationCreate, db: Session = Depends(get_db)):
+async def cancel_subscription(request: CancellationCreate, background_tasks: BackgroundTasks,
+                              db: Session = Depends(get_db)):
     # Validate owner exists
     owner = db.query(Owners).filter(Owners.dni == request.owner_id).first()
     if not owner:
@@ -158,8 +146,8 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
     else:
         documents = []
 
-    # Clean up document paths
-    documents = [doc.strip() for doc in documents if doc.strip()]
+    # Clean up document paths, the documents table keeps the filenames
+    documents = [os.path.basename(doc.strip()) for doc in documents if doc.strip()]
 
     # Create cancellation record
     cancelled_subscription = Cancellations(
@@ -174,7 +162,6 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
         lisence_plate2=request.lisence_plate2,
         lisence_plate3=request.lisence_plate3,
         tique_x_park=request.tique_x_park,
-        documents=','.join(documents) if documents else None,
         remote_control_number=request.remote_control_number,
         observations=request.observations,
         registration_date=subscription.registration_date,
@@ -186,6 +173,9 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
 
     db.add(cancelled_subscription)
     db.flush()  # This should populate the ID
+    # Files of the subscription keep their rows' kind, size and checksum
+    set_documents(db, cancelled_subscription.documents, documents, cancellation_document_path, subscription.documents)
+    apply_occupancy_change(db, cancelled_subscription.subscription_type_id, cancellations=1)
 
     # Create subscription history entry
     subscription_history_entry = Subscription_history(
@@ -196,7 +186,7 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
         lisence_plate1=subscription.lisence_plate1,
         lisence_plate2=subscription.lisence_plate2,
         lisence_plate3=subscription.lisence_plate3,
-        documents=subscription.documents,
+        documents=document_list(subscription.documents),
         tique_x_park=subscription.tique_x_park,
         remote_control_number=subscription.remote_control_number,
         observations=subscription.observations,
@@ -219,25 +209,24 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
 
     # Delete subscription if all plates are canceled
     if not any([subscription.lisence_plate1, subscription.lisence_plate2, subscription.lisence_plate3]):
+        apply_occupancy_change(db, subscription.subscription_type_id, subscriptions=-1)
         db.delete(subscription)
 
     try:
-        # Generate cancellation work order
-        cancellation_work_order_filename = await generate_cancellation_work_order_pdf(cancelled_subscription, db)
-        if cancelled_subscription.documents:
-            document_filenames = cancelled_subscription.documents.split(",")
-            if cancellation_work_order_filename not in document_filenames:
-                document_filenames.append(cancellation_work_order_filename)
-                cancelled_subscription.documents = ','.join(document_filenames)
-        else:
-            cancelled_subscription.documents = cancellation_work_order_filename
+        # Rendered once committed, see app/utils/work_order_queue.py
+        pending_work_order = add_cancellation_work_order(cancelled_subscription, db)
 
         # Commit changes
         db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+    await schedule_work_order(background_tasks, pending_work_order.id)
+
     return CancellationResponse(
         id=cancelled_subscription.id,
         owner_id=cancelled_subscription.owner_id,
@@ -246,7 +235,7 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
         lisence_plate1=cancelled_subscription.lisence_plate1,
         lisence_plate2=cancelled_subscription.lisence_plate2,
         lisence_plate3=cancelled_subscription.lisence_plate3,
-        documents=cancelled_subscription.documents.split(',') if cancelled_subscription.documents else [],
+        documents=document_names(cancelled_subscription.documents),
         tique_x_park=cancelled_subscription.tique_x_park,
         remote_control_number=cancelled_subscription.remote_control_number,
         observations=cancelled_subscription.observations,
@@ -257,7 +246,8 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
         parking_spot=cancelled_subscription.parking_spot,
         modification_time=cancelled_subscription.modification_time,
         created_by=cancelled_subscription.created_by,
-        modified_by=cancelled_subscription.modified_by
+        modified_by=cancelled_subscription.modified_by,
+        work_order_status=get_work_order_status(db, 'cancellation', cancelled_subscription.id)
     )
 
 
@@ -265,6 +255,7 @@ async def cancel_subscription(request: CancellationCreate, db: Session = Depends
 async def update_cancellation(
     cancellation_id: int,
     request: CancellationCreate,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
 ):
     # Retrieve the existing cancellation
@@ -290,7 +281,7 @@ async def update_cancellation(
         documents = request.documents
     else:
         documents = []
-    documents = [doc.strip() for doc in documents if doc.strip()]
+    documents = [os.path.basename(doc.strip()) for doc in documents if doc.strip()]
 
     try:
         # Create a history entry before making changes
@@ -302,7 +293,7 @@ async def update_cancellation(
             lisence_plate1=cancelled_subscription.lisence_plate1,
             lisence_plate2=cancelled_subscription.lisence_plate2,
             lisence_plate3=cancelled_subscription.lisence_plate3,
-            documents=cancelled_subscription.documents,
+            documents=document_list(cancelled_subscription.documents),
             tique_x_park=cancelled_subscription.tique_x_park,
             remote_control_number=cancelled_subscription.remote_control_number,
             observations=cancelled_subscription.observations,
@@ -317,26 +308,28 @@ async def update_cancellation(
         )
         db.add(subscription_history_entry)
 
+        old_subscription_type_id = cancelled_subscription.subscription_type_id
+
         # Update the cancellation record
         for field, value in request.dict(exclude_unset=True).items():
             if field == 'documents':
-                setattr(cancelled_subscription, 'documents', ','.join(documents) if documents else None)
+                subscription = db.get(Subscriptions, cancelled_subscription.subscription_id)
+                set_documents(db, cancelled_subscription.documents, documents, cancellation_document_path,
+                              subscription.documents if subscription else [])
             else:
                 setattr(cancelled_subscription, field, value)
 
         # Always update modification time
         cancelled_subscription.modification_time = current_time
 
+        if old_subscription_type_id != cancelled_subscription.subscription_type_id:
+            apply_occupancy_change(db, old_subscription_type_id, cancellations=-1)
+            apply_occupancy_change(db, cancelled_subscription.subscription_type_id, cancellations=1)
+
         # Generate new cancellation work order if needed
+        pending_work_order = None
         try:
-            cancellation_work_order_filename = await generate_cancellation_work_order_pdf(cancelled_subscription, db)
-            if cancelled_subscription.documents:
-                document_filenames = cancelled_subscription.documents.split(",")
-                if cancellation_work_order_filename not in document_filenames:
-                    document_filenames.append(cancellation_work_order_filename)
-                    cancelled_subscription.documents = ','.join(document_filenames)
-            else:
-                cancelled_subscription.documents = cancellation_work_order_filename
+            pending_work_order = add_cancellation_work_order(cancelled_subscription, db)
         except Exception as e:
             logger.error(f"Error generating work order: {str(e)}")
             # Continue with the update even if work order generation fails
@@ -344,6 +337,8 @@ async def update_cancellation(
 
         # Commit changes
         db.commit()
+        if pending_work_order:
+            await schedule_work_order(background_tasks, pending_work_order.id)
         db.refresh(cancelled_subscription)
 
         # Return updated cancellation response
@@ -355,7 +350,7 @@ async def update_cancellation(
             lisence_plate1=cancelled_subscription.lisence_plate1,
             lisence_plate2=cancelled_subscription.lisence_plate2,
             lisence_plate3=cancelled_subscription.lisence_plate3,
-            documents=cancelled_subscription.documents.split(',') if cancelled_subscription.documents else [],
+            documents=document_names(cancelled_subscription.documents),
             tique_x_park=cancelled_subscription.tique_x_park,
             remote_control_number=cancelled_subscription.remote_control_number,
             observations=cancelled_subscription.observations,
@@ -366,7 +361,8 @@ async def update_cancellation(
             parking_spot=cancelled_subscription.parking_spot,
             modification_time=cancelled_subscription.modification_time,
             created_by=cancelled_subscription.created_by,
-            modified_by=cancelled_subscription.modified_by
+            modified_by=cancelled_subscription.modified_by,
+            work_order_status=get_work_order_status(db, 'cancellation', cancelled_subscription.id)
         )
 
     except Exception as e:
@@ -376,7 +372,7 @@ async def update_cancellation(
 
 
 @router.post("/api/upload-document")
-async def upload_document(file: UploadFile = File(...)):
+async def upload_document(file: UploadFile = File(...), db: Session = Depends(get_db)):
     try:
         # Create a more readable unique filename
         timestamp = datetime.now().strftime("%Y-%m-%d")
@@ -389,44 +385,89 @@ async def upload_document(file: UploadFile = File(...)):
 
         file_path = os.path.join(save_path, filename)
 
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        check_upload_sizes([file])
+        await save_document(db, file, file_path)
+        db.commit()
 
         return JSONResponse(content={"filename": filename}, status_code=200)
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(
             content={"error": f"Failed to upload file: {str(e)}"},
             status_code=500
         )
-@router.get("/subscriptions/cancellations/", response_model=List[CancellationResponse])
-def get_all_cancellations(db: Session = Depends(get_db)):
-    cancellations = db.query(Cancellations).all()  # Fetch all cancellation records
-
-    # Map each cancellation to the CancellationResponse schema
-    return [
-        CancellationResponse(
-            id=cancellation.id,
-            owner_id=cancellation.owner_id,
-            subscription_type_id=cancellation.subscription_type_id,
-            access_card=cancellation.access_card,
-            lisence_plate1=cancellation.lisence_plate1,
-            lisence_plate2=cancellation.lisence_plate2,
-            lisence_plate3=cancellation.lisence_plate3,
-            tique_x_park=cancellation.tique_x_park,
-            remote_control_number=cancellation.remote_control_number,
-            documents=cancellation.documents,
-            observations=cancellation.observations,
-            registration_date=cancellation.registration_date,
-            effective_date=cancellation.effective_date,
-            effective_cancellation_date=cancellation.effective_cancellation_date,
-            large_family_expiration=cancellation.large_family_expiration,
-            parking_spot=cancellation.parking_spot,
-            created_by=cancellation.created_by,
-            modified_by=cancellation.modified_by,
-            modification_time=cancellation.modification_time  # Include this field if required
-        )
-        for cancellation in cancellations
-    ]
+def cancellation_to_response(cancellation, work_order_status: Optional[str] = None) -> CancellationResponse:
+    return CancellationResponse(
+        id=cancellation.id,
+        owner_id=cancellation.owner_id,
+        subscription_type_id=cancellation.subscription_type_id,
+        access_card=cancellation.access_card,
+        lisence_plate1=cancellation.lisence_plate1,
+        lisence_plate2=cancellation.lisence_plate2,
+        lisence_plate3=cancellation.lisence_plate3,
+        tique_x_park=cancellation.tique_x_park,
+        remote_control_number=cancellation.remote_control_number,
+        documents=document_list(cancellation.documents),
+        observations=cancellation.observations,
+        registration_date=cancellation.registration_date,
+        effective_date=cancellation.effective_date,
+        effective_cancellation_date=cancellation.effective_cancellation_date,
+        large_family_expiration=cancellation.large_family_expiration,
+        parking_spot=cancellation.parking_spot,
+        created_by=cancellation.created_by,
+        modified_by=cancellation.modified_by,
+        modification_time=cancellation.modification_time,  # Include this field if required
+        work_order_status=work_order_status
+    )
+
+
+def cancellations_to_response(db: Session, cancellations: List[Cancellations]) -> List[CancellationResponse]:
+    """Response items of a list page, with the work order statuses read in one query"""
+    statuses = get_work_order_statuses(db, 'cancellation', [cancellation.id for cancellation in cancellations])
+    return [cancellation_to_response(cancellation, statuses.get(cancellation.id)) for cancellation in cancellations]
+
+
+def filter_cancellations_query(
+        db: Session,
+        owner_dni: Optional[str] = None,
+        plate: Optional[str] = None,
+        subscription_type_id: Optional[int] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+):
+    query = db.query(Cancellations)
+    if owner_dni:
+        query = query.filter(Cancellations.owner_id == owner_dni)
+    if subscription_type_id is not None:
+        query = query.filter(Cancellations.subscription_type_id == subscription_type_id)
+    query = filter_by_plate(query, Cancellations, plate)
+    return filter_by_date_range(query, Cancellations.effective_cancellation_date, date_from, date_to)
+
+
+@router.get("/subscriptions/cancellations/",
+            response_model=Union[Page[CancellationResponse], List[CancellationResponse]])
+def get_all_cancellations(
+        owner_dni: Optional[str] = Query(None),
+        plate: Optional[str] = Query(None),
+        subscription_type_id: Optional[int] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Effective cancellation date from"),
+        date_to: Optional[datetime] = Query(None, description="Effective cancellation date to"),
+        page: PageParams = Depends(),
+        db: Session = Depends(get_db)
+):
+    query = filter_cancellations_query(db, owner_dni, plate, subscription_type_id, date_from, date_to)
+
+    if page.unpaginated:
+        cancellations = query.order_by(Cancellations.id).all()  # Fetch all cancellation records
+        return cancellations_to_response(db, cancellations)
+
+    cancellations, next_cursor = paginate_query(query, Cancellations.id, page.cursor, page.limit)
+    return Page[CancellationResponse](
+        items=cancellations_to_response(db, cancellations),
+        next_cursor=next_cursor,
+        limit=page.limit,
+    )
 
 
 @router.get("/cancellations/{cancellation_id}", response_model=CancellationResponse)
@@ -435,10 +476,6 @@ def get_cancellation(cancellation_id: int, db: Session = Depends(get_db)):
     if not cancellation:
         raise HTTPException(status_code=404, detail="Cancellation not found")
 
-    # Clean up and process documents
-    documents = cancellation.documents.split(',') if cancellation.documents else []
-    documents = [doc.strip() for doc in documents if doc.strip()]
-
     return CancellationResponse(
         id=cancellation.id,
         owner_id=cancellation.owner_id,
@@ -449,7 +486,7 @@ def get_cancellation(cancellation_id: int, db: Session = Depends(get_db)):
         lisence_plate3=cancellation.lisence_plate3,
         tique_x_park=cancellation.tique_x_park,
         remote_control_number=cancellation.remote_control_number,
-        documents=documents,  # Use the processed documents list
+        documents=document_names(cancellation.documents),
         observations=cancellation.observations,
         registration_date=cancellation.registration_date,
         effective_date=cancellation.effective_date,
@@ -458,9 +495,23 @@ def get_cancellation(cancellation_id: int, db: Session = Depends(get_db)):
         parking_spot=cancellation.parking_spot,
         created_by=cancellation.created_by,
         modified_by=cancellation.modified_by,
-        modification_time=cancellation.modification_time
+        modification_time=cancellation.modification_time,
+        work_order_status=get_work_order_status(db, 'cancellation', cancellation.id)
     )
 
+
+@router.get("/cancellations/{cancellation_id}/work-order")
+async def reprint_cancellation_work_order(cancellation_id: int, db: Session = Depends(get_db)):
+    """Latest work order PDF of the cancellation, served from disk without rendering it again"""
+    work_order = latest_work_order(db, 'cancellation', cancellation_id)
+    if not work_order:
+        raise HTTPException(status_code=404, detail="Work order not found")
+    if get_work_order_status(db, 'cancellation', cancellation_id) == 'pending':
+        raise HTTPException(status_code=409, detail="The work order is still being generated")
+
+    file_path = await restore_work_order_file(work_order)
+    return FileResponse(file_path, media_type="application/pdf", filename=file_path.name)
+
 @router.delete("/cancellations/{cancellation_id}/", response_model=dict)
 def delete_cancellation(cancellation_id: int, db: Session = Depends(get_db)):
     # Query the cancellation by ID
@@ -470,7 +521,10 @@ def delete_cancellation(cancellation_id: int, db: Session = Depends(get_db)):
     if cancellation is None:
         raise HTTPException(status_code=404, detail="Cancellation not found")
 
-    # Delete the cancellation
+    # Delete the cancellation and its document rows (not cascaded, see Cancellations.documents)
+    apply_occupancy_change(db, cancellation.subscription_type_id, cancellations=-1)
+    for document in cancellation.documents:
+        db.delete(document)
     db.delete(cancellation)
     db.commit()
 
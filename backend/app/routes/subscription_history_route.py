@@ -1,20 +1,63 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional, Union
 
-from fastapi import Depends, HTTPException, APIRouter
+from fastapi import Depends, HTTPException, APIRouter, Query, Request
 from sqlalchemy.orm import Session
 
 from app.db.database import get_db
 from app.models.models import Subscription_history
 from app.schemas.subscription_history import SubscriptionHistoryResponse
+from app.schemas.pagination import Page
+from app.utils.pagination import PageParams, paginate_query, filter_by_plate, filter_by_date_range
+from app.utils.streaming import wants_ndjson, ndjson_response
 
 router = APIRouter()
 
-@router.get("/subscription_histories/", response_model=List[SubscriptionHistoryResponse])
-async def get_all_subscription_histories(db: Session = Depends(get_db)):
-    subscription_histories = db.query(Subscription_history).all()  # Get all records
 
-    # Convert SQLAlchemy objects to dictionaries or Pydantic models
-    return [SubscriptionHistoryResponse(**history.__dict__) for history in subscription_histories]
+def filter_subscription_histories_query(
+        db: Session,
+        owner_dni: Optional[str] = None,
+        plate: Optional[str] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+):
+    query = db.query(Subscription_history)
+    if owner_dni:
+        query = query.filter(Subscription_history.owner_id == owner_dni)
+    query = filter_by_plate(query, Subscription_history, plate)
+    return filter_by_date_range(query, Subscription_history.modification_time, date_from, date_to)
+
+
+@router.get("/subscription_histories/", response_model=Union[Page[SubscriptionHistoryResponse], List[SubscriptionHistoryResponse]])
+async def get_all_subscription_histories(
+        request: Request,
+        owner_dni: Optional[str] = Query(None),
+        plate: Optional[str] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Modification time from"),
+        date_to: Optional[datetime] = Query(None, description="Modification time to"),
+        page: PageParams = Depends(),
+        db: Session = Depends(get_db)
+):
+    if wants_ndjson(request):
+        return ndjson_response(
+            lambda session: filter_subscription_histories_query(session, owner_dni, plate, date_from, date_to),
+            Subscription_history.history_id,
+            lambda history: SubscriptionHistoryResponse(**history.__dict__),
+        )
+
+    query = filter_subscription_histories_query(db, owner_dni, plate, date_from, date_to)
+
+    if page.unpaginated:
+        subscription_histories = query.order_by(Subscription_history.history_id).all()  # Get all records
+        # Convert SQLAlchemy objects to dictionaries or Pydantic models
+        return [SubscriptionHistoryResponse(**history.__dict__) for history in subscription_histories]
+
+    subscription_histories, next_cursor = paginate_query(query, Subscription_history.history_id, page.cursor, page.limit)
+    return Page[SubscriptionHistoryResponse](
+        items=[SubscriptionHistoryResponse(**history.__dict__) for history in subscription_histories],
+        next_cursor=next_cursor,
+        limit=page.limit,
+    )
 
 # Get subscription history by ID
 @router.get("/subscription_histories/{history_id}", response_model=SubscriptionHistoryResponse)
@@ -4,36 +4,50 @@ from bdb import effective
 from datetime import datetime
 from os import remove
 from pathlib import PosixPath
-from typing import List, Optional
+from typing import List, Optional, Union
 from urllib.parse import urljoin
 
 from starlette.responses import FileResponse
 from sympy.printing.dot import template
-from weasyprint import HTML, CSS
-from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, File, Query
+from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, File, Query, Request, BackgroundTasks
 from sqlalchemy import func
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 from sqlalchemy.testing import db
 from jinja2 import Environment, FileSystemLoader
 
-from io import BytesIO
-import pandas as pd
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
 from app.db.database import get_db
 from app.models.models import Subscription_types, Subscriptions, Subscription_history, Owners, Vehicles, \
     ParkingLot
 from app.queries.owner import get_owner_by_dni
 from app.queries.vehicle import get_vehicle
+from app.queries.document import add_document, remove_document, document_names, document_list
+from app.queries.plate import plate_registered
 from app.routes.owner_routes import UPLOAD_DIR
 
 from app.schemas.subscription import Subscription_Types_Response, Subscription_Types_Create, SubscriptionCreate, \
     SubscriptionResponse
 from app.queries.subscription import create_subscription_type_query, get_subscription_types_query, \
     get_subscription_type_by_id_query, create_subscription_query, get_subscription_by_id_query, get_subscriptions_query, \
-    get_subscription_by_id
-from app.utils.work_order_helper import get_next_work_order_number, generate_work_order_filename
+    filter_subscriptions_query
+from app.schemas.pagination import Page
+from app.utils.pagination import PageParams, paginate_query
+from app.utils.streaming import wants_ndjson, ndjson_response
+from app.utils.access_index import lookup_credential
+from app.utils.occupancy import apply_occupancy_change, rebuild_occupancy_for_parking_lot_ids, \
+    classify_subscription_type_name, find_parking_lot_for_subscription_type_name, VEHICLE_CLASSES
+from app.utils.export_helper import EXPORT_FORMATS, EXPORT_MEDIA_TYPES, parse_export_ids, select_export_fields, \
+    new_export_path, write_export_file, iter_csv_export, iter_file_chunks
+from app.utils.uploads import check_upload_sizes
+from app.utils.document_store import stage_documents, store_staged_document, discard_staged_documents, \
+    release_document
+from app.utils.work_order_queue import queue_work_order, schedule_work_order, get_work_order_status, \
+    get_work_order_statuses
+from app.utils.work_order_helper import get_next_work_order_number, generate_work_order_filename, \
+    record_work_order, work_order_unchanged, latest_work_order, restore_work_order_file
 
 
 
@@ -45,29 +59,57 @@ UPLOAD_DIR = PosixPath(base_path) / "subscription_files"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 
+def classify_subscription_type(
+        db: Session,
+        subscription_type: Subscription_types,
+        parking_lot_id: Optional[int],
+        vehicle_class: Optional[str],
+        consumes_space: Optional[bool],
+):
+    """Set the lot / vehicle class of a subscription type, deriving missing values from its name."""
+    if vehicle_class is not None and vehicle_class not in VEHICLE_CLASSES:
+        raise HTTPException(status_code=400, detail=f"vehicle_class must be one of {', '.join(VEHICLE_CLASSES)}")
+
+    derived_vehicle_class, derived_consumes_space = classify_subscription_type_name(subscription_type.name)
+    subscription_type.vehicle_class = vehicle_class or derived_vehicle_class
+    subscription_type.consumes_space = consumes_space if consumes_space is not None else derived_consumes_space
+
+    if parking_lot_id is not None:
+        if not db.query(ParkingLot).filter(ParkingLot.id == parking_lot_id).first():
+            raise HTTPException(status_code=400, detail=f"Parking lot with ID {parking_lot_id} does not exist.")
+        subscription_type.parking_lot_id = parking_lot_id
+    else:
+        parking_lot = find_parking_lot_for_subscription_type_name(db.query(ParkingLot).all(), subscription_type.name)
+        subscription_type.parking_lot_id = parking_lot.id if parking_lot else None
+
+
 # Create a new subscription type
 @router.post("/subscription_types/", response_model=Subscription_Types_Response)
 def create_subscription_type(
         name: str = Form(...),
         price: float = Form(...),
         parking_code: str = Form(...),
+        parking_lot_id: Optional[int] = Form(None),
+        vehicle_class: Optional[str] = Form(None),
+        consumes_space: Optional[bool] = Form(None),
         db: Session = Depends(get_db),
 ):
+    subscription_type = Subscription_types(name=name, price=price, parking_code=parking_code)
+    classify_subscription_type(db, subscription_type, parking_lot_id, vehicle_class, consumes_space)
+
     subscription_type_data = Subscription_Types_Create(
         name=name,
         price=price,
-        parking_code=parking_code
+        parking_code=parking_code,
+        parking_lot_id=subscription_type.parking_lot_id,
+        vehicle_class=subscription_type.vehicle_class,
+        consumes_space=subscription_type.consumes_space,
     )
 
     new_subscription_type = create_subscription_type_query(db, subscription_type_data)
 
     # Include the id field in the response
-    return Subscription_Types_Response(
-        id=new_subscription_type.id,  # Add the id here
-        name=new_subscription_type.name,
-        price=new_subscription_type.price,
-        parking_code=new_subscription_type.parking_code
-    )
+    return Subscription_Types_Response.from_orm(new_subscription_type)
 
 
 @router.put("/subscription_types/{id}/", response_model=Subscription_Types_Response)
@@ -76,6 +118,9 @@ async def edit_subscription_endpoint(
         name: Optional[str] = Form(None),
         price: Optional[float] = Form(None),
         parking_code: Optional[str] = Form(None),
+        parking_lot_id: Optional[int] = Form(None),
+        vehicle_class: Optional[str] = Form(None),
+        consumes_space: Optional[bool] = Form(None),
         db: Session = Depends(get_db),
 ):
     subscription_type = db.query(Subscription_types).filter(Subscription_types.id == id).first()
@@ -83,6 +128,10 @@ async def edit_subscription_endpoint(
     if not subscription_type:
         raise HTTPException(status_code=404, detail="Subscription type not found")
 
+    old_classification = (subscription_type.parking_lot_id, subscription_type.vehicle_class,
+                          subscription_type.consumes_space)
+    name_changed = bool(name) and name != subscription_type.name
+
     if name:
         subscription_type.name = name
     if price:
@@ -90,15 +139,25 @@ async def edit_subscription_endpoint(
     if parking_code:
         subscription_type.parking_code = parking_code
 
+    if name_changed or parking_lot_id is not None or vehicle_class is not None or consumes_space is not None:
+        # Values not sent keep following the name, as before the explicit classification existed
+        classify_subscription_type(
+            db,
+            subscription_type,
+            parking_lot_id if parking_lot_id is not None else (None if name_changed else subscription_type.parking_lot_id),
+            vehicle_class if vehicle_class is not None else (None if name_changed else subscription_type.vehicle_class),
+            consumes_space if consumes_space is not None else (None if name_changed else subscription_type.consumes_space),
+        )
+
+    new_classification = (subscription_type.parking_lot_id, subscription_type.vehicle_class,
+                          subscription_type.consumes_space)
+    if new_classification != old_classification:
+        rebuild_occupancy_for_parking_lot_ids(db, [old_classification[0], new_classification[0]])
+
     db.commit()
     db.refresh(subscription_type)
 
-    return Subscription_Types_Response(
-        id=subscription_type.id,  # Add the id here
-        name=subscription_type.name,
-        price=subscription_type.price,
-        parking_code=subscription_type.parking_code
-    )
+    return Subscription_Types_Response.from_orm(subscription_type)
 
 
 @router.get("/subscription_types/", response_model=List[Subscription_Types_Response])
@@ -122,61 +181,54 @@ async def handle_document_updates(
         subscription: Subscriptions,
         new_documents: List[UploadFile],
         remove_documents: List[str],
+        db: Session,
         is_work_order_added: bool = False,
         work_order_filename: Optional[str] = None
 ) -> (Subscriptions, List[str]):
-    current_documents = subscription.documents.split(',') if subscription.documents else []
-    updated_documents = []
-    history_documents = []
-
-    # Remove specified documents
-    for doc_path in current_documents:
-        doc_name = PosixPath(doc_path).name
-        if doc_name not in remove_documents:
-            updated_documents.append(doc_name)
-        else:
-            file_path = UPLOAD_DIR / doc_name
-            if file_path.exists():
-                file_path.unlink()
-                print(f"Removed file: {file_path}")
-            else:
-                print(f"File not found for removal: {file_path}")
-
-    # Add new documents
-    for document in new_documents:
-        unique_filename = f"{subscription.id}_{uuid.uuid4().hex}_{document.filename}"
-        file_path = UPLOAD_DIR / unique_filename
-        try:
-            with open(file_path, "wb") as file:
-                content = await document.read()
-                file.write(content)
-            updated_documents.append(unique_filename)
-            print(f"Added new file: {file_path}")
-        except IOError:
-            raise HTTPException(status_code=500, detail=f"Could not write file: {unique_filename}")
+    check_upload_sizes(new_documents)
+    # Every upload is read before the first write, see stage_documents
+    staged_documents = await stage_documents(new_documents)
+    try:
+        current_documents = document_names(subscription.documents)
+        history_documents = []
+
+        # Remove specified documents
+        for doc_name in current_documents:
+            if doc_name in remove_documents:
+                remove_document(db, subscription.documents, doc_name)
+                file_path = UPLOAD_DIR / doc_name
+                if file_path.exists():
+                    release_document(db, file_path)
+                    print(f"Removed file: {file_path}")
+                else:
+                    print(f"File not found for removal: {file_path}")
+
+        # Add new documents
+        for document, staged in zip(new_documents, staged_documents):
+            unique_filename = f"{subscription.id}_{uuid.uuid4().hex}_{document.filename}"
+            file_path = UPLOAD_DIR / unique_filename
+            try:
+                size, checksum = store_staged_document(db, staged, file_path)
+                add_document(subscription.documents, unique_filename, size, checksum)
+                print(f"Added new file: {file_path} ({size} bytes, sha256 {checksum})")
+            except IOError:
+                raise HTTPException(status_code=500, detail=f"Could not write file: {unique_filename}")
+    finally:
+        discard_staged_documents(staged_documents)
 
     # If a work order is generated, move existing documents to history
     if is_work_order_added and work_order_filename:
         history_documents = current_documents.copy()
-        updated_documents.append(work_order_filename)
+        add_document(subscription.documents, work_order_filename, kind='work_order',
+                     path=UPLOAD_DIR / work_order_filename)
         print(f"Work order added. Existing documents moved to history.")
 
-    # Update the subscription's documents field with only filenames
-    subscription.documents = ','.join(updated_documents) if updated_documents else None
-    print(f"Final updated documents: {subscription.documents}")
+    print(f"Final updated documents: {document_list(subscription.documents)}")
     print(f"Documents moved to history: {history_documents}")
 
     return subscription, history_documents
 
 
-@router.get("/subscription_files/{filename}")
-async def get_subscription_file(filename: str):
-    file_path = UPLOAD_DIR / filename
-    if not file_path.is_file():
-        raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path)
-
-
 def convert_str_to_datetime(date_str: Optional[str]) -> Optional[datetime]:
     """Convert string date to datetime object."""
     if not date_str:
@@ -193,6 +245,7 @@ def convert_str_to_datetime(date_str: Optional[str]) -> Optional[datetime]:
 
 @router.post("/subscription/", response_model=SubscriptionResponse)
 async def create_subscription_endpoint(
+        background_tasks: BackgroundTasks,
         owner_id: str = Form(...),
         subscription_type_id: int = Form(...),
         access_card: Optional[str] = Form(None),
@@ -211,9 +264,14 @@ async def create_subscription_endpoint(
         modification_time: Optional[str] = Form(None),
         db: Session = Depends(get_db),
 ):
+    staged_documents = []
     try:
         print(f"Received request to create subscription for owner_id: {owner_id}")
         print(f"Received {len(documents)} documents")
+        # Before the subscription is created, so an oversized upload changes nothing
+        check_upload_sizes(documents)
+        # Every upload is read before the first write, see stage_documents
+        staged_documents = await stage_documents(documents)
 
         print("LargeFamilyExpiration", large_family_expiration)
 
@@ -252,13 +310,7 @@ async def create_subscription_endpoint(
         # 4. Check for duplicate license plates
         def check_duplicate_license_plate(plate):
             if plate:
-                existing_subscription = db.query(Subscriptions).filter(
-                    Subscriptions.subscription_type_id == subscription_type_id,
-                    (Subscriptions.lisence_plate1 == plate) |
-                    (Subscriptions.lisence_plate2 == plate) |
-                    (Subscriptions.lisence_plate3 == plate)
-                ).first()
-                if existing_subscription:
+                if plate_registered(db, plate, subscription_type_id):
                     raise HTTPException(
                         status_code=400,
                         detail=f"License plate {plate} is already registered under subscription type {subscription_type_id}."
@@ -287,6 +339,8 @@ async def create_subscription_endpoint(
             modified_by=modified_by,
             modification_time=modification_time,
         )
+        # Count the new subscription in the lot occupancy, committed together with it
+        apply_occupancy_change(db, subscription_type_id, subscriptions=1)
         new_subscription = create_subscription_query(db, subscription_data)
 
         # 6. Update parking lot spaces
@@ -302,31 +356,29 @@ async def create_subscription_endpoint(
             'lisence_plate3': None
         }
 
-        # Generate work order PDF
-        work_order_filename = await generate_work_order_pdf(new_subscription, db, old_license_plates)
-
         # Handle document uploads
-        document_filenames = [work_order_filename]  # Start with work order filename only
-        for document in documents:
+        for document, staged in zip(documents, staged_documents):
             filename = f"{new_subscription.id}_{document.filename}"
             file_location = UPLOAD_DIR / filename
             try:
-                with open(file_location, "wb") as file:
-                    content = await document.read()
-                    file.write(content)
-                document_filenames.append(filename)  # Append only the filename
+                size, checksum = store_staged_document(db, staged, file_location)
+                add_document(new_subscription.documents, filename, size, checksum)
             except IOError as e:
                 # Rollback transaction and raise exception
                 db.rollback()
                 raise HTTPException(status_code=500, detail=f"Could not write file: {filename}. Error: {str(e)}")
 
-        # Update subscription with document information
-        new_subscription.documents = ','.join(document_filenames) if document_filenames else None
+        # Numbered with the subscription, rendered once committed; the filename is attached to the documents then
+        template_name, template_data, work_order_filename = build_work_order(new_subscription, db, old_license_plates)
+        pending_work_order = queue_work_order(db, 'subscription', new_subscription.id, template_name,
+                                              template_data, UPLOAD_DIR / work_order_filename)
         db.commit()
+        await schedule_work_order(background_tasks, pending_work_order.id)
+        db.refresh(new_subscription)
 
         # Construct the response model with URLs
         base_url = "http://157.180.31.108:8000/subscription_files/"  # Update as needed
-        document_urls = [urljoin(base_url, filename) for filename in document_filenames]
+        document_urls = [urljoin(base_url, filename) for filename in document_names(new_subscription.documents)]
 
         # history entry
         history_entry = Subscription_history(
@@ -369,7 +421,8 @@ async def create_subscription_endpoint(
             registration_date=new_subscription.registration_date,
             created_by=created_by,
             modified_by=modified_by,
-            modification_time=modification_time
+            modification_time=modification_time,
+            work_order_status=get_work_order_status(db, 'subscription', new_subscription.id)
         )
     except HTTPException as http_exc:
         # Re-raise HTTP exceptions as they are already properly formatted
@@ -379,6 +432,8 @@ async def create_subscription_endpoint(
         print(f"Error in create_subscription_endpoint: {str(e)}")
         # Raise a generic HTTP exception
         raise HTTPException(status_code=500, detail="An unexpected error occurred while processing the subscription.")
+    finally:
+        discard_staged_documents(staged_documents)
 
 
 def update_parking_lot_spaces(db: Session, subscription_type_id: int, change: int):
@@ -388,19 +443,16 @@ def update_parking_lot_spaces(db: Session, subscription_type_id: int, change: in
             raise HTTPException(status_code=400,
                                 detail=f"Subscription type with ID {subscription_type_id} does not exist.")
 
-        # Extract parking lot name (assuming it's before " - ")
-        parking_lot_name = subscription_type.name.split(" - ")[0].strip()
-        print(f"Extracted parking lot name: {parking_lot_name}")  # Debugging line
-
-        parking_lot = db.query(ParkingLot).filter(ParkingLot.name == parking_lot_name).first()
+        parking_lot = subscription_type.parking_lot
         if not parking_lot:
-            raise HTTPException(status_code=400, detail=f"Parking lot '{parking_lot_name}' does not exist.")
+            raise HTTPException(status_code=400,
+                                detail=f"Subscription type '{subscription_type.name}' is not assigned to a parking lot.")
 
-        # Check for 24H for cars or 24H MOTOS for motorcycles in the subscription type name
-        if "24H" in subscription_type.name.upper() and "MOTOS" not in subscription_type.name.upper():
+        # Only 24H subscription types take a car or motorcycle space
+        if subscription_type.consumes_space and subscription_type.vehicle_class == 'car':
             parking_lot.total_car_spaces += change
             print(f"Updated 24H car spaces for {parking_lot.name}: {parking_lot.total_car_spaces}")
-        elif "24H MOTOS" in subscription_type.name.upper():
+        elif subscription_type.consumes_space and subscription_type.vehicle_class == 'motorcycle':
             parking_lot.total_motorcycle_spaces += change
             print(f"Updated 24H motorcycle spaces for {parking_lot.name}: {parking_lot.total_motorcycle_spaces}")
         else:
@@ -413,53 +465,10 @@ def update_parking_lot_spaces(db: Session, subscription_type_id: int, change: in
         raise HTTPException(status_code=500, detail=f"An error occurred while updating parking lot spaces: {str(e)}")
 
 
-# Set up Jinja2 environment
-# template_dir = r'C:\Users\Doom\Desktop\APP APARCAMIENTOS\car_parking_system\backend\app\templates'
-
-# In your code, add these debug lines
-import os
-print(f"Current working directory in container: {os.getcwd()}")
-print(f"Files in current directory: {os.listdir('.')}")
-print(f"Files in app directory (if exists): {os.listdir('./app') if os.path.exists('./app') else 'No app directory'}")
-# For Docker setup
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-
-# Get the absolute path to the templates directory
-template_dir = os.path.join(os.getcwd(), "templates")
-if not os.path.exists(template_dir):
-    # Then try with app directory
-    template_dir = os.path.join(os.getcwd(), "app", "templates")
-    if not os.path.exists(template_dir):
-        # Finally try with backend/app
-        template_dir = os.path.join(os.getcwd(), "backend", "app", "templates")
-
-# Add these debug statements
-print(f"Final template directory path: {template_dir}")
-print(f"Template directory exists: {os.path.exists(template_dir)}")
-if os.path.exists(template_dir):
-    print(f"Files in template directory: {os.listdir(template_dir)}")
-    print(f"work_order_template.html exists: {os.path.exists(os.path.join(template_dir, 'work_order_template.html'))}")
-
-# Create the Jinja2 environment with explicit debug=True to get more information
-env = Environment(
-    loader=FileSystemLoader(template_dir),
-    autoescape=select_autoescape(['html', 'xml']),
-
-)
-
-# Test the template loading explicitly
-try:
-    template = env.get_template('work_order_template.html')
-    print("Successfully loaded the template!")
-except Exception as e:
-    print(f"Error loading template: {e}")
-    # List all available templates
-    if hasattr(env.loader, 'list_templates'):
-        print(f"Available templates: {env.loader.list_templates()}")
-
 @router.put("/subscription/{id}", response_model=SubscriptionResponse)
 async def edit_subscription_endpoint(
         id: int,
+        background_tasks: BackgroundTasks,
         owner_id: Optional[str] = Form(default=None),
         subscription_type_id: Optional[int] = Form(default=None),
         access_card: Optional[str] = Form(default=None),
@@ -480,7 +489,12 @@ async def edit_subscription_endpoint(
         existing_documents: Optional[List[str]] = Form(default=None),
         db: Session = Depends(get_db)
 ):
+    staged_documents = []
     try:
+        check_upload_sizes(new_documents)
+        # Every upload is read before the first write, see stage_documents
+        staged_documents = await stage_documents(new_documents)
+
         # Fetch the subscription record
         subscription = db.query(Subscriptions).filter(Subscriptions.id == id).first()
         if not subscription:
@@ -543,7 +557,7 @@ async def edit_subscription_endpoint(
         if existing_documents:
             existing_documents_set = set(existing_documents)
             if subscription.documents:
-                subscription_docs = set(subscription.documents.split(","))
+                subscription_docs = set(document_names(subscription.documents))
                 remove_documents = list(subscription_docs - existing_documents_set)
         else:
             remove_documents = []
@@ -562,7 +576,12 @@ async def edit_subscription_endpoint(
             if not subscription_type:
                 raise HTTPException(status_code=400,
                                     detail=f"Subscription type with ID {subscription_type_id} does not exist.")
+            old_subscription_type_id = subscription.subscription_type_id
             update_field('subscription_type_id', subscription_type_id)
+            if old_subscription_type_id != subscription.subscription_type_id:
+                # Move the subscription between the lot occupancy counters
+                apply_occupancy_change(db, old_subscription_type_id, subscriptions=-1)
+                apply_occupancy_change(db, subscription.subscription_type_id, subscriptions=1)
 
         # Handle modification_time
         if modification_time:
@@ -597,6 +616,19 @@ async def edit_subscription_endpoint(
         validate_license_plate(lisence_plate2, 'lisence_plate2')
         validate_license_plate(lisence_plate3, 'lisence_plate3')
 
+        # A plate can only be in one subscription of each type (ix_subscription_plates_active):
+        # checked for the plates this edit brings into the type, all of them if the type changed
+        added_plates = {subscription.lisence_plate1, subscription.lisence_plate2, subscription.lisence_plate3}
+        if 'subscription_type_id' not in {field_name for field_name, _, _ in changes}:
+            added_plates -= set(old_license_plates.values())
+        with db.no_autoflush:
+            for plate in added_plates:
+                if plate and plate_registered(db, plate, subscription.subscription_type_id, subscription.id):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"License plate {plate} is already registered under subscription type {subscription.subscription_type_id}."
+                    )
+
         # Update access_card
         if access_card is not None:
             update_field('access_card', access_card.strip() if access_card else None)
@@ -607,62 +639,53 @@ async def edit_subscription_endpoint(
                 file_path = UPLOAD_DIR / filename
                 if file_path.is_file():
                     try:
-                        file_path.unlink()
+                        release_document(db, file_path)
                     except Exception as e:
                         print(f"Error quitando archivo {filename}: {str(e)}")
                         continue
 
-                if subscription.documents:
-                    document_filenames = subscription.documents.split(",")
-                    if filename in document_filenames:
-                        document_filenames.remove(filename)
-                        subscription.documents = ','.join(document_filenames) if document_filenames else None
+                remove_document(db, subscription.documents, filename)
 
         # Handle new document uploads
-        document_filenames = subscription.documents.split(",") if subscription.documents else []
-        for document in new_documents:
+        for document, staged in zip(new_documents, staged_documents):
             filename = f"{subscription.id}_{document.filename}"
             file_location = UPLOAD_DIR / filename
             try:
-                content = await document.read()
-                with open(file_location, "wb") as file:
-                    file.write(content)
-                document_filenames.append(filename)
+                size, checksum = store_staged_document(db, staged, file_location)
+                add_document(subscription.documents, filename, size, checksum)
+            except HTTPException:
+                raise
             except Exception as e:
                 print(f"Error subiendo archivo {filename}: {str(e)}")
                 continue
 
-        if document_filenames:
-            subscription.documents = ','.join(document_filenames)
-
         # Generate work order only if there are actual field modifications
+        pending_work_order = None
         if changes and not (new_documents or remove_documents):
             try:
-                work_order_filename = await generate_work_order_modification_pdf(subscription, db, old_license_plates)
-                if subscription.documents:
-                    document_filenames = subscription.documents.split(",")
-                    if work_order_filename not in document_filenames:
-                        document_filenames.append(work_order_filename)
-                        subscription.documents = ','.join(document_filenames)
-                else:
-                    subscription.documents = work_order_filename
+                work_order = build_work_order_modification(subscription, db, old_license_plates)
+                if work_order:
+                    template_name, template_data, work_order_filename = work_order
+                    pending_work_order = queue_work_order(db, 'subscription', subscription.id, template_name,
+                                                          template_data, UPLOAD_DIR / work_order_filename)
             except Exception as e:
                 print(f"Error generando la orden de trabajo: {str(e)}")
 
         # Commit changes
         try:
             db.commit()
-            db.refresh(subscription)
         except Exception as e:
             db.rollback()
             raise HTTPException(status_code=500, detail=f"Error guardando cambios: {str(e)}")
+        if pending_work_order:
+            await schedule_work_order(background_tasks, pending_work_order.id)
+        db.refresh(subscription)
 
         # Construct the response
         base_url = "http://157.180.31.108:8000/subscription_files/"
         document_urls = []
         if subscription.documents:
-            document_filenames = subscription.documents.split(",")
-            document_urls = [urljoin(base_url, filename) for filename in document_filenames]
+            document_urls = [urljoin(base_url, filename) for filename in document_names(subscription.documents)]
 
             # If there are valid changes, log them in Subscription_history
             if changes or new_documents or remove_documents:
@@ -710,17 +733,23 @@ async def edit_subscription_endpoint(
             parking_spot=subscription.parking_spot,
             created_by=subscription.created_by,
             modified_by=subscription.modified_by,
-            modification_time=subscription.modification_time
+            modification_time=subscription.modification_time,
+            work_order_status=get_work_order_status(db, 'subscription', subscription.id)
         )
 
     except HTTPException as he:
         raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        discard_staged_documents(staged_documents)
 
 
-async def generate_work_order_pdf(subscription: Subscriptions, db: Session, old_license_plates: dict):
-    """Generate work order PDF with unique sequential numbering"""
+def build_work_order(subscription: Subscriptions, db: Session, old_license_plates: dict) -> tuple[str, dict, str]:
+    """
+    Number a new subscription work order and collect its template data.
+    Returns (template_name, template_data, filename)
+    """
 
     # Get next work order number FIRST (before any other operations)
     work_order_num, work_order_formatted = get_next_work_order_number(db, counter_type='subscription')
@@ -783,50 +812,20 @@ async def generate_work_order_pdf(subscription: Subscriptions, db: Session, old_
         'subscription_type_name': safe_get(subscription_type, 'name', ''),
     }
 
-    # Render HTML template
-    template = env.get_template('work_order_template.html')
-    html_content = template.render(template_data)
-
-    # Generate PDF
-    css = CSS(string='''
-        @page {
-            size: letter;
-            margin: 1cm;
-        }
-        body {
-            font-family: Helvetica, Arial, sans-serif;
-        }
-        h1 {
-            text-align: center;
-        }
-        .checkbox {
-            display: inline-block;
-            width: 10px;
-            height: 10px;
-            border: 1px solid black;
-            margin-right: 5px;
-        }
-        .checked {
-            background-color: black;
-        }
-    ''')
-    pdf = HTML(string=html_content).write_pdf(stylesheets=[css])
-
     # Generate unique filename using the work order number
     filename = generate_work_order_filename(work_order_num, order_type='subscription')
-    file_path = UPLOAD_DIR / filename
-
-    with open(file_path, "wb") as f:
-        f.write(pdf)
+    record_work_order(db, 'subscription', subscription.id, 'work_order_template.html', template_data,
+                      UPLOAD_DIR / filename)
+    return 'work_order_template.html', template_data, filename
 
-    return filename
 
-
-async def generate_work_order_modification_pdf(subscription: Subscriptions, db: Session, old_license_plates: dict):
-    """Generate modification work order PDF with unique sequential numbering"""
-
-    # Get next work order number FIRST
-    work_order_num, work_order_formatted = get_next_work_order_number(db, counter_type='subscription')
+def build_work_order_modification(subscription: Subscriptions, db: Session,
+                                  old_license_plates: dict) -> Optional[tuple[str, dict, str]]:
+    """
+    Number a modification work order and collect its template data.
+    Returns (template_name, template_data, filename), or None when the subscription data on the
+    work order is the same as on its last work order (nothing to print, no number is used).
+    """
 
     # Fetch owner information
     owner = get_owner_by_dni(db=db, owner_dni=subscription.owner_id)
@@ -864,9 +863,8 @@ async def generate_work_order_modification_pdf(subscription: Subscriptions, db:
             if new_value:
                 new_license_plate.append(new_value)
 
-    # Prepare data for the template - USE THE SEQUENTIAL WORK ORDER NUMBER
+    # Prepare data for the template, the sequential number is added below
     template_data = {
-        'order_no': work_order_formatted,  # Sequential number like "1/25", "2/25"
         'date': datetime.now().strftime('%d/%m/%Y'),
         'vehicle_type': safe_get(vehicle, 'vehicle_type', '').upper(),
         'effective_date': safe_get(subscription, 'effective_date', datetime.now()).strftime('%d/%m/%Y'),
@@ -891,47 +889,20 @@ async def generate_work_order_modification_pdf(subscription: Subscriptions, db:
         'subscription_type_name': safe_get(subscription_type, 'name', ''),
     }
 
-    # Render HTML template
-    template = env.get_template('modification_work_order_template.html')
-    html_content = template.render(template_data)
+    if work_order_unchanged(db, 'subscription', subscription.id, template_data):
+        print(f"Orden de trabajo sin cambios para el abono {subscription.id}, no se genera una nueva")
+        return None
 
-    # Generate PDF
-    css = CSS(string='''
-        @page {
-            size: letter;
-            margin: 1cm;
-        }
-        body {
-            font-family: Helvetica, Arial, sans-serif;
-        }
-        h1 {
-            text-align: center;
-        }
-        .checkbox {
-            display: inline-block;
-            width: 10px;
-            height: 10px;
-            border: 1px solid black;
-            margin-right: 5px;
-        }
-        .checked {
-            background-color: black;
-        }
-    ''')
-    pdf = HTML(string=html_content).write_pdf(stylesheets=[css])
+    # Get the next work order number only once there is something to print
+    work_order_num, work_order_formatted = get_next_work_order_number(db, counter_type='subscription')
+    template_data['order_no'] = work_order_formatted  # Sequential number like "1/25", "2/25"
 
     # Generate unique filename - NO LONGER uses timestamp, uses work order number
     filename = generate_work_order_filename(work_order_num, order_type='subscription')
-    file_path = UPLOAD_DIR / filename
-
-    # Ensure the directory exists
-    file_path.parent.mkdir(parents=True, exist_ok=True)
-
-    # Save the PDF
-    with open(file_path, "wb") as f:
-        f.write(pdf)
+    record_work_order(db, 'subscription', subscription.id, 'modification_work_order_template.html', template_data,
+                      UPLOAD_DIR / filename)
+    return 'modification_work_order_template.html', template_data, filename
 
-    return filename
 
 @router.get("/subscription/{subscription_id}", response_model=SubscriptionResponse)
 def get_subscription_endpoint(
@@ -951,7 +922,7 @@ def get_subscription_endpoint(
         'lisence_plate1': subscription.lisence_plate1,
         'lisence_plate2': subscription.lisence_plate2,
         'lisence_plate3': subscription.lisence_plate3,
-        'documents': subscription.documents.split(',') if subscription.documents else [],
+        'documents': document_names(subscription.documents),
         'tique_x_park': subscription.tique_x_park,
         'remote_control_number': subscription.remote_control_number,
         'observations': subscription.observations,
@@ -961,136 +932,108 @@ def get_subscription_endpoint(
         'registration_date': subscription.registration_date,
         'created_by': subscription.created_by,
         'modified_by': subscription.modified_by,
-        'modification_time': subscription.modification_time
+        'modification_time': subscription.modification_time,
+        'work_order_status': get_work_order_status(db, 'subscription', subscription.id)
     }
 
     return SubscriptionResponse(**subscription_data)
 
 
+@router.get("/subscription/{subscription_id}/work-order")
+async def reprint_subscription_work_order(subscription_id: int, db: Session = Depends(get_db)):
+    """Latest work order PDF of the subscription, served from disk without rendering it again"""
+    work_order = latest_work_order(db, 'subscription', subscription_id)
+    if not work_order:
+        raise HTTPException(status_code=404, detail="Orden de trabajo no encontrada")
+    if get_work_order_status(db, 'subscription', subscription_id) == 'pending':
+        raise HTTPException(status_code=409, detail="La orden de trabajo se está generando")
+
+    file_path = await restore_work_order_file(work_order)
+    return FileResponse(file_path, media_type="application/pdf", filename=file_path.name)
+
+
 @router.get("/subscriptions/export")
-async def export_subscriptions(
+def export_subscriptions(
         ids: str = Query(..., description="Comma-separated list of subscription IDs"),
         fields: str = Query(..., description="Comma-separated list of fields to export"),
-        export_format: str = Query(..., description="Export format (only 'xlsx' is supported)"),
+        export_format: str = Query(..., description="Export format: 'xlsx', 'csv' or 'parquet'"),
         db: Session = Depends(get_db)
 ):
-    print(f"[{datetime.now()}] Export endpoint hit.")
-    print(f"[{datetime.now()}] Received IDs: {ids}")
-    print(f"[{datetime.now()}] Received Fields: {fields}")
-    print(f"[{datetime.now()}] Export format: {export_format}")
+    print(f"[{datetime.now()}] Export endpoint hit. Format: {export_format}")
 
-    if export_format != 'xlsx':
+    if export_format not in EXPORT_FORMATS:
         print(f"[{datetime.now()}] Invalid format: {export_format}")
-        raise HTTPException(status_code=400, detail="Only 'xlsx' export format is supported")
+        raise HTTPException(status_code=400, detail="Export format must be one of: " + ", ".join(EXPORT_FORMATS))
 
     try:
-        id_list = [int(id_str.strip()) for id_str in ids.split(',')]
-        field_list = [field.strip() for field in fields.split(',')]
-        print(f"[{datetime.now()}] Processed ID list: {id_list}")
-        print(f"[{datetime.now()}] Processed Field list: {field_list}")
-
-        subscriptions = get_subscription_by_id(db, id_list)
-        if not subscriptions:
-            print(f"[{datetime.now()}] No subscriptions found for IDs: {id_list}")
-            # You might want to return an empty Excel or a 204 No Content here
-            # For now, let's proceed to see if it generates an empty Excel
-            # raise HTTPException(status_code=404, detail="No subscriptions found for the given IDs.")
-        print(f"[{datetime.now()}] Fetched {len(subscriptions)} subscriptions.")
-
-        data = []
-        heading_translation = {
-            'id': 'ID',
-            'owner_id': 'DNI',
-            'access_card': 'Tarjeta de Acceso',
-            'lisence_plate1': 'Matrícula 1',
-            'lisence_plate2': 'Matrícula 2',
-            'lisence_plate3': 'Matrícula 3',
-            'documents': 'Documentos',
-            'tique_x_park': 'TiqueXPark',
-            'remote_control_number': 'Número del mando',
-            'observations': 'Observaciones',
-            'parking_spot': 'Plaza de aparcamiento',
-            'registration_date': 'Fecha de Registro',
-            'effective_date': 'Fecha de Efecto',
-            'created_by': 'Creado Por',
-            'modified_by': 'Modificado Por',
-            'modification_time': 'Hora de Modificación',
-            'owner_email': 'Correo Electrónico del Propietario',
-            'owner_phone_number': 'Número de Teléfono del Propietario',
-            'subscription_type_name': 'Tipo de Suscripción',
-            'subscription_type_parking_code': 'Código',
-            'large_family_expiration': 'Vencimiento familia numerosa' # Corrected key
-        }
-
-        for subscription in subscriptions:
-            # Fetch subscription type information
-            subscription_type = db.query(Subscription_types).filter(
-                Subscription_types.id == subscription.subscription_type_id).first()
-            print(f"[{datetime.now()}] Processing subscription ID: {subscription.id}, Type ID: {subscription.subscription_type_id}")
-
-            # Get the owner's info using the owner_id from the subscription
-            owner = get_owner_by_dni(db, subscription.owner_id)
-            print(f"[{datetime.now()}] Fetched owner for DNI: {subscription.owner_id}")
-            owner_email = owner.email if owner else None
-            owner_phone_number = owner.phone_number if owner else None
-
-            subscription_data = {
-                'id': subscription.id,
-                'owner_id': subscription.owner_id,
-                'access_card': subscription.access_card,
-                'lisence_plate1': subscription.lisence_plate1,
-                'lisence_plate2': subscription.lisence_plate2,
-                'lisence_plate3': subscription.lisence_plate3,
-                'documents': ','.join(subscription.documents.split(',')) if subscription.documents else None, # Join back for export
-                'tique_x_park': subscription.tique_x_park,
-                'remote_control_number': subscription.remote_control_number,
-                'observations': subscription.observations,
-                'parking_spot': subscription.parking_spot,
-                'registration_date': subscription.registration_date,
-                'effective_date': subscription.effective_date,
-                'large_family_expiration': subscription.large_family_expiration, # Make sure this key matches
-                'created_by': subscription.created_by,
-                'modified_by': subscription.modified_by,
-                'modification_time': subscription.modification_time,
-                'owner_email': owner_email,
-                'owner_phone_number': owner_phone_number,
-                'subscription_type_name': subscription_type.name if subscription_type else None,
-                'subscription_type_parking_code': subscription_type.parking_code if subscription_type else None,
-            }
-
-            filtered_data = {k: v for k, v in subscription_data.items() if k in field_list}
-            data.append(filtered_data)
-        
-        print(f"[{datetime.now()}] Prepared {len(data)} rows for DataFrame.")
-        df = pd.DataFrame(data)
-
-        # Rename columns to Spanish
-        df.rename(columns=heading_translation, inplace=True)
-        print(f"[{datetime.now()}] DataFrame created and columns renamed.")
-
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Abonos')
-        print(f"[{datetime.now()}] Excel file written to BytesIO.")
-
-        output.seek(0)
-
-        headers = {
-            'Content-Disposition': f'attachment; filename="Abonos_export.xlsx"'
-        }
-        print(f"[{datetime.now()}] Returning StreamingResponse.")
-        return StreamingResponse(output, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                                 headers=headers)
+        id_list = parse_export_ids(ids)
+        field_list = select_export_fields(fields)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="IDs must be a comma-separated list of integers")
+
+    if export_format == 'csv':
+        # CSV is written straight to the response as the chunks are read
+        print(f"[{datetime.now()}] Streaming CSV for {len(id_list)} subscription IDs with {len(field_list)} fields.")
+        return StreamingResponse(iter_csv_export('subscriptions', id_list, field_list), media_type=EXPORT_MEDIA_TYPES['csv'],
+                                 headers={'Content-Disposition': 'attachment; filename="Abonos_export.csv"'})
+
+    path = new_export_path(export_format)
+    try:
+        write_export_file(db, 'subscriptions', export_format, id_list, field_list, path)
     except Exception as e:
         print(f"[{datetime.now()}] An unexpected error occurred in export_subscriptions: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error during export: {str(e)}")
 
+    print(f"[{datetime.now()}] Exported {len(id_list)} subscription IDs with {len(field_list)} fields.")
+    headers = {
+        'Content-Disposition': f'attachment; filename="Abonos_export.{export_format}"'
+    }
+    return StreamingResponse(iter_file_chunks(path), media_type=EXPORT_MEDIA_TYPES[export_format],
+                             headers=headers, background=BackgroundTask(os.remove, path))
+
+def subscriptions_to_response(db: Session, subscriptions: List[Subscriptions]) -> List[SubscriptionResponse]:
+    """Response items of a list page, with the work order statuses read in one query"""
+    statuses = get_work_order_statuses(db, 'subscription', [subscription.id for subscription in subscriptions])
+    responses = []
+    for subscription in subscriptions:
+        response = SubscriptionResponse.from_orm(subscription)
+        response.work_order_status = statuses.get(subscription.id)
+        responses.append(response)
+    return responses
+
+
 # FastAPI route to get subscriptions
-@router.get("/subscriptions/", response_model=List[SubscriptionResponse])
-def get_subscriptions(db: Session = Depends(get_db)):
-    subscriptions = get_subscriptions_query(db)
-    return [SubscriptionResponse.from_orm(subscription) for subscription in
-            subscriptions]  # Properly convert to Pydantic models
+@router.get("/subscriptions/", response_model=Union[Page[SubscriptionResponse], List[SubscriptionResponse]])
+def get_subscriptions(
+        request: Request,
+        owner_dni: Optional[str] = Query(None),
+        plate: Optional[str] = Query(None),
+        subscription_type_id: Optional[int] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Registration date from"),
+        date_to: Optional[datetime] = Query(None, description="Registration date to"),
+        page: PageParams = Depends(),
+        db: Session = Depends(get_db)
+):
+    if wants_ndjson(request):
+        return ndjson_response(
+            lambda session: filter_subscriptions_query(
+                session, owner_dni, plate, subscription_type_id, date_from, date_to),
+            Subscriptions.id,
+            to_items=subscriptions_to_response,
+        )
+
+    query = filter_subscriptions_query(db, owner_dni, plate, subscription_type_id, date_from, date_to)
+
+    if page.unpaginated:
+        subscriptions = query.order_by(Subscriptions.id).all()
+        return subscriptions_to_response(db, subscriptions)  # Properly convert to Pydantic models
+
+    subscriptions, next_cursor = paginate_query(query, Subscriptions.id, page.cursor, page.limit)
+    return Page[SubscriptionResponse](
+        items=subscriptions_to_response(db, subscriptions),
+        next_cursor=next_cursor,
+        limit=page.limit,
+    )
 
 
 # Delete a subscription type
@@ -1102,6 +1045,7 @@ def delete_subscription_type(id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Tipo de abono no encontrado")
 
     db.delete(subscription_type)
+    rebuild_occupancy_for_parking_lot_ids(db, [subscription_type.parking_lot_id])
     db.commit()
 
     return {"detail": "Tipo de abono borrado correctamente"}
@@ -1115,6 +1059,7 @@ def delete_subscription(id: int, db: Session = Depends(get_db)):
     if not subscription:
         raise HTTPException(status_code=404, detail="Abono no encontrado")
 
+    apply_occupancy_change(db, subscription.subscription_type_id, subscriptions=-1)
     db.delete(subscription)
     db.commit()
 
@@ -1128,14 +1073,8 @@ def check_subscription(license_plate: str, db: Session = Depends(get_db)):
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
 
-    active_subscription = db.query(Subscriptions).filter(
-        (Subscriptions.lisence_plate1 == vehicle.lisence_plate) |
-        (Subscriptions.lisence_plate2 == vehicle.lisence_plate) |
-        (Subscriptions.lisence_plate3 == vehicle.lisence_plate)
-    ).first()
-
     # Return true if there's an active subscription, false otherwise
-    return {"active": bool(active_subscription)}
+    return {"active": lookup_credential('plate', vehicle.lisence_plate) is not None}
 
 
 @router.get("/subscriptions/large-family", response_model=List[SubscriptionResponse])
@@ -1153,7 +1092,7 @@ def get_large_family_subscriptions(db: Session = Depends(get_db)):
             'lisence_plate1': subscription.lisence_plate1,
             'lisence_plate2': subscription.lisence_plate2,
             'lisence_plate3': subscription.lisence_plate3,
-            'documents': subscription.documents.split(',') if subscription.documents else [],
+            'documents': document_names(subscription.documents),
             'tique_x_park': subscription.tique_x_park,
             'remote_control_number': subscription.remote_control_number,
             'observations': subscription.observations,
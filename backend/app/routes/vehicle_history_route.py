@@ -1,21 +1,64 @@
-from typing import List
+from datetime import datetime
+from typing import List, Optional, Union
 
-from fastapi import Depends, HTTPException, APIRouter
+from fastapi import Depends, HTTPException, APIRouter, Query, Request
 from sqlalchemy.orm import Session
 
 from app.db.database import get_db
 from app.models.models import Vehicles_history
 from app.schemas.vehicle_history import VehicleHistoryResponse
-
+from app.schemas.pagination import Page
+from app.utils.pagination import PageParams, paginate_query, filter_by_date_range
+from app.utils.streaming import wants_ndjson, ndjson_response
 
 router = APIRouter()
 
-@router.get("/vehicle_histories/", response_model=List[VehicleHistoryResponse])
-async def get_all_vehicles_histories(db: Session = Depends(get_db)):
-    vehicle_histories = db.query(Vehicles_history).all()  # Get all records
 
-    # Convert SQLAlchemy objects to dictionaries or Pydantic models
-    return [VehicleHistoryResponse(**history.__dict__) for history in vehicle_histories]
+def filter_vehicle_histories_query(
+        db: Session,
+        owner_dni: Optional[str] = None,
+        plate: Optional[str] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+):
+    query = db.query(Vehicles_history)
+    if owner_dni:
+        query = query.filter(Vehicles_history.owner_id == owner_dni)
+    if plate:
+        query = query.filter(Vehicles_history.lisence_plate == plate)
+    return filter_by_date_range(query, Vehicles_history.modification_time, date_from, date_to)
+
+
+@router.get("/vehicle_histories/", response_model=Union[Page[VehicleHistoryResponse], List[VehicleHistoryResponse]])
+async def get_all_vehicles_histories(
+        request: Request,
+        owner_dni: Optional[str] = Query(None),
+        plate: Optional[str] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Modification time from"),
+        date_to: Optional[datetime] = Query(None, description="Modification time to"),
+        page: PageParams = Depends(),
+        db: Session = Depends(get_db)
+):
+    if wants_ndjson(request):
+        return ndjson_response(
+            lambda session: filter_vehicle_histories_query(session, owner_dni, plate, date_from, date_to),
+            Vehicles_history.history_id,
+            lambda history: VehicleHistoryResponse(**history.__dict__),
+        )
+
+    query = filter_vehicle_histories_query(db, owner_dni, plate, date_from, date_to)
+
+    if page.unpaginated:
+        vehicle_histories = query.order_by(Vehicles_history.history_id).all()  # Get all records
+        # Convert SQLAlchemy objects to dictionaries or Pydantic models
+        return [VehicleHistoryResponse(**history.__dict__) for history in vehicle_histories]
+
+    vehicle_histories, next_cursor = paginate_query(query, Vehicles_history.history_id, page.cursor, page.limit)
+    return Page[VehicleHistoryResponse](
+        items=[VehicleHistoryResponse(**history.__dict__) for history in vehicle_histories],
+        next_cursor=next_cursor,
+        limit=page.limit,
+    )
 
 # Get vehicle history by ID
 @router.get("/vehicle_histories/{history_id}", response_model=VehicleHistoryResponse)
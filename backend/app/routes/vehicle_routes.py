@@ -1,17 +1,26 @@
 import os
 from datetime import datetime
 
-from typing import List, Optional
+from typing import List, Optional, Union
 
-from fastapi import APIRouter, Form, File, Depends
+from fastapi import APIRouter, Form, File, Depends, Query, Request
 from fastapi import UploadFile
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
 
 from app.db.database import get_db
 from app.models.models import Owners, Vehicles, Subscriptions, Vehicles_history
-from app.queries.vehicle import add_vehicle, get_all_vehicles, get_vehicle
+from app.queries.vehicle import add_vehicle, filter_vehicles_query, vehicle_to_response
+from app.queries.document import add_document, remove_document, document_names, document_list
+from app.queries.plate import plate_filter
+from app.schemas.pagination import Page
+from app.utils.pagination import PageParams, paginate_query
+from app.utils.streaming import wants_ndjson, ndjson_response
 from app.schemas.vehicle import VehicleResponse, VehicleCreate
+from app.utils.occupancy import apply_occupancy_change
+from app.utils.uploads import check_upload_sizes
+from app.utils.document_store import stage_documents, store_staged_document, discard_staged_documents, \
+    release_document
 
 router = APIRouter()
 
@@ -22,25 +31,18 @@ os.makedirs(UPLOAD_DIR_VEHICLE, exist_ok=True)
 
 @router.get("/vehicle/{lisence_plate}", response_model=VehicleResponse)
 def get_vehicle_endpoint(lisence_plate: str, db: Session = Depends(get_db)):
-    vehicle = get_vehicle(db=db, lisence_plate=lisence_plate)
+    vehicle = db.query(Vehicles).filter(Vehicles.lisence_plate == lisence_plate).first()
 
     if vehicle is None:
         raise HTTPException(status_code=404, detail='Vehicle not found')
 
-    # Get just the filenames, not the full paths for the frontend
-    document_filenames = []
-    if vehicle.documents:
-        document_paths = vehicle.documents.split(',')
-        document_filenames = [os.path.basename(path) for path in document_paths]
-
-    # Build vehicle_data from the result of the raw SQL query
     vehicle_data = {
         'lisence_plate': vehicle.lisence_plate,
         'brand': vehicle.brand,
         'model': vehicle.model,
         'vehicle_type': vehicle.vehicle_type,
         'owner_id': vehicle.owner_id,
-        'documents': document_filenames,  # Just the filenames now
+        'documents': document_names(vehicle.documents),
         'observations': vehicle.observations,
         'registration_date': vehicle.registration_date,
         'created_by': vehicle.created_by,
@@ -70,14 +72,17 @@ async def add_vehicle_endpoint(
         raise HTTPException(status_code=404, detail="Owner not found")
 
     # Store the uploaded documents
-    document_filenames = []
-    document_paths = []
-    for document in documents:
-        file_location = f"{UPLOAD_DIR_VEHICLE}/{document.filename}"
-        with open(file_location, "wb") as file:
-            file.write(document.file.read())
-        document_paths.append(file_location)  # Store full path for database
-        document_filenames.append(document.filename)  # Store just filename for frontend
+    check_upload_sizes(documents)
+    # Every upload is read before the first write, see stage_documents
+    staged_documents = await stage_documents(documents)
+    try:
+        vehicle_documents = []
+        for document, staged in zip(documents, staged_documents):
+            file_location = f"{UPLOAD_DIR_VEHICLE}/{document.filename}"
+            size, checksum = store_staged_document(db, staged, file_location)
+            add_document(vehicle_documents, document.filename, size, checksum)
+    finally:
+        discard_staged_documents(staged_documents)
 
     # Create an instance of VehicleCreate schema
     vehicle_data = VehicleCreate(
@@ -93,8 +98,8 @@ async def add_vehicle_endpoint(
         modification_time=modification_time,
     )
 
-    # Call the add_vehicle function to save vehicle data in the DB, passing document paths
-    new_vehicle = add_vehicle(db, vehicle_data, document_paths)
+    # Call the add_vehicle function to save vehicle data in the DB with its documents
+    new_vehicle = add_vehicle(db, vehicle_data, vehicle_documents)
 
     # Track the vehicle history
     history_entery = Vehicles_history(
@@ -103,7 +108,7 @@ async def add_vehicle_endpoint(
         model=new_vehicle.model,
         vehicle_type=new_vehicle.vehicle_type,
         owner_id=new_vehicle.owner_id,
-        documents=','.join(document_paths),  # Save full paths in history
+        documents=document_list(new_vehicle.documents),
         observations=new_vehicle.observations,
         registration_date=new_vehicle.registration_date,
         created_by=new_vehicle.created_by,
@@ -118,7 +123,7 @@ async def add_vehicle_endpoint(
         model=new_vehicle.model,
         vehicle_type=new_vehicle.vehicle_type,
         owner_id=new_vehicle.owner_id,
-        documents=document_filenames,  # Return just filenames for frontend
+        documents=document_names(new_vehicle.documents),
         observations=new_vehicle.observations,
         registration_date=new_vehicle.registration_date,
         created_by=new_vehicle.created_by,
@@ -181,10 +186,10 @@ async def update_vehicle_endpoint(
         update_field('modification_time', datetime.now())
 
     # Handle document updates
-    old_documents = vehicle.documents
-    vehicle = await handle_document_updates(vehicle, new_documents, remove_documents)
-    if old_documents != vehicle.documents:
-        changes.append(('documents', old_documents, vehicle.documents))
+    old_documents = document_list(vehicle.documents)
+    vehicle = await handle_document_updates(vehicle, new_documents, remove_documents, db)
+    if old_documents != document_list(vehicle.documents):
+        changes.append(('documents', old_documents, document_list(vehicle.documents)))
 
     # If there are valid changes, log them in Vehicles_history
     if changes:
@@ -194,7 +199,7 @@ async def update_vehicle_endpoint(
             model=vehicle.model,
             vehicle_type=vehicle.vehicle_type,
             owner_id=vehicle.owner_id,
-            documents=vehicle.documents,
+            documents=document_list(vehicle.documents),
             observations=vehicle.observations,
             registration_date=vehicle.registration_date,
             created_by=vehicle.created_by,
@@ -208,19 +213,13 @@ async def update_vehicle_endpoint(
     db.commit()
     db.refresh(vehicle)
 
-    # Get just the filenames for the response
-    document_filenames = []
-    if vehicle.documents:
-        document_paths = vehicle.documents.split(',')
-        document_filenames = [os.path.basename(path) for path in document_paths]
-
     return VehicleResponse(
         lisence_plate=vehicle.lisence_plate,
         brand=vehicle.brand,
         model=vehicle.model,
         vehicle_type=vehicle.vehicle_type,
         owner_id=vehicle.owner_id,
-        documents=document_filenames,  # Return just filenames for frontend
+        documents=document_names(vehicle.documents),
         observations=vehicle.observations,
         registration_date=vehicle.registration_date,
         created_by=vehicle.created_by,
@@ -229,75 +228,75 @@ async def update_vehicle_endpoint(
     )
 
 
-async def handle_document_updates(vehicle, new_documents: List[UploadFile], remove_documents: List[str]):
-    # Get current documents
-    current_documents = vehicle.documents.split(',') if vehicle.documents else []
-
-    print(f"Current documents: {current_documents}")
-    print(f"Documents to remove: {remove_documents}")
+async def handle_document_updates(vehicle, new_documents: List[UploadFile], remove_documents: List[str], db: Session):
+    check_upload_sizes(new_documents)
+    # Every upload is read before the first write, see stage_documents
+    staged_documents = await stage_documents(new_documents)
+    try:
+        print(f"Current documents: {document_names(vehicle.documents)}")
+        print(f"Documents to remove: {remove_documents}")
 
-    # Handle document removal
-    updated_documents = []
-    for doc in current_documents:
-        doc_name = os.path.basename(doc)  # Get just the filename
-        if doc_name not in remove_documents:
-            updated_documents.append(doc)
-        else:
+        # Handle document removal
+        for doc_name in remove_documents:
+            if not remove_document(db, vehicle.documents, doc_name):
+                continue
             # Delete the file from the server
             file_path = os.path.join(UPLOAD_DIR_VEHICLE, doc_name)
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            if os.path.lexists(file_path):
+                release_document(db, file_path)
                 print(f"Removed file: {file_path}")
             else:
                 print(f"File not found for removal: {file_path}")
 
-    print(f"Documents after removal: {updated_documents}")
-
-    # Handle new document uploads
-    for document in new_documents:
-        filename = f"{vehicle.lisence_plate}_{document.filename}"  # Prefix with license plate to avoid conflicts
-        file_location = os.path.join(UPLOAD_DIR_VEHICLE, filename)
-        try:
-            with open(file_location, "wb") as file:
-                content = await document.read()
-                file.write(content)
-            updated_documents.append(file_location)  # Store the full path
-            print(f"Added new file: {file_location}")
-        except IOError:
-            raise HTTPException(status_code=500, detail=f"Could not write file: {filename}")
+        print(f"Documents after removal: {document_names(vehicle.documents)}")
 
-    # Update the vehicle's documents
-    vehicle.documents = ','.join(updated_documents) if updated_documents else None
+        # Handle new document uploads
+        for document, staged in zip(new_documents, staged_documents):
+            filename = f"{vehicle.lisence_plate}_{document.filename}"  # Prefix with license plate to avoid conflicts
+            file_location = os.path.join(UPLOAD_DIR_VEHICLE, filename)
+            try:
+                size, checksum = store_staged_document(db, staged, file_location)
+                add_document(vehicle.documents, filename, size, checksum)
+                print(f"Added new file: {file_location} ({size} bytes, sha256 {checksum})")
+            except IOError:
+                raise HTTPException(status_code=500, detail=f"Could not write file: {filename}")
+    finally:
+        discard_staged_documents(staged_documents)
 
-    print(f"Final updated documents: {vehicle.documents}")
+    print(f"Final updated documents: {document_list(vehicle.documents)}")
 
     return vehicle
 
 
-@router.get("/vehicles/", response_model=List[VehicleResponse])
-async def get_vehicles_endpoint(db: Session = Depends(get_db)):
-    vehicles = get_all_vehicles(db)
-
-    # Process each vehicle to extract just filenames from document paths
-    processed_vehicles = []
-    for vehicle in vehicles:
-        # Convert vehicle to dict if it's not already
-        if not isinstance(vehicle, dict):
-            vehicle_dict = vehicle.__dict__
-        else:
-            vehicle_dict = vehicle.copy()
+@router.get("/vehicles/", response_model=Union[Page[VehicleResponse], List[VehicleResponse]])
+async def get_vehicles_endpoint(
+        request: Request,
+        owner_dni: Optional[str] = Query(None),
+        plate: Optional[str] = Query(None),
+        date_from: Optional[datetime] = Query(None, description="Registration date from"),
+        date_to: Optional[datetime] = Query(None, description="Registration date to"),
+        page: PageParams = Depends(),
+        db: Session = Depends(get_db)
+):
+    if wants_ndjson(request):
+        return ndjson_response(
+            lambda session: filter_vehicles_query(session, owner_dni, plate, date_from, date_to),
+            Vehicles.lisence_plate,
+            vehicle_to_response,
+        )
 
-        # Extract filenames from document paths
-        if 'documents' in vehicle_dict and vehicle_dict['documents']:
-            if isinstance(vehicle_dict['documents'], str):
-                paths = vehicle_dict['documents'].split(',')
-                vehicle_dict['documents'] = [os.path.basename(path) for path in paths]
-            elif isinstance(vehicle_dict['documents'], list):
-                vehicle_dict['documents'] = [os.path.basename(path) for path in vehicle_dict['documents']]
+    query = filter_vehicles_query(db, owner_dni, plate, date_from, date_to)
 
-        processed_vehicles.append(vehicle_dict)
+    if page.unpaginated:
+        vehicles = query.order_by(Vehicles.lisence_plate).all()
+        return [vehicle_to_response(vehicle) for vehicle in vehicles]
 
-    return processed_vehicles
+    vehicles, next_cursor = paginate_query(query, Vehicles.lisence_plate, page.cursor, page.limit)
+    return Page[VehicleResponse](
+        items=[vehicle_to_response(vehicle) for vehicle in vehicles],
+        next_cursor=next_cursor,
+        limit=page.limit,
+    )
 
 @router.delete("/vehicle/{license_plate}", response_model=dict)
 async def delete_vehicle_endpoint(
@@ -317,7 +316,7 @@ async def delete_vehicle_endpoint(
         model=vehicle.model,
         vehicle_type=vehicle.vehicle_type,
         owner_id=vehicle.owner_id,
-        documents=vehicle.documents,
+        documents=document_list(vehicle.documents),
         observations=vehicle.observations,
         registration_date=vehicle.registration_date,
         created_by=vehicle.created_by,
@@ -328,25 +327,20 @@ async def delete_vehicle_endpoint(
     db.commit()  # Commit to save the history record before deletion
     print(f"Created history entry for deleted vehicle: {license_plate}")
 
-    # Delete associated documents from the server
-    if vehicle.documents:
-        current_documents = vehicle.documents.split(',')
-        for doc in current_documents:
-            file_path = os.path.join(UPLOAD_DIR_VEHICLE, doc.split('/')[-1])  # Get just the filename
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"Removed file: {file_path}")
-            else:
-                print(f"File not found for removal: {file_path}")
+    # Delete associated documents from the server (their rows are deleted with the vehicle)
+    for filename in document_names(vehicle.documents):
+        file_path = os.path.join(UPLOAD_DIR_VEHICLE, filename)
+        if os.path.lexists(file_path):
+            release_document(db, file_path)
+            print(f"Removed file: {file_path}")
+        else:
+            print(f"File not found for removal: {file_path}")
 
     # Delete associated subscriptions based on multiple license plate options
-    subscriptions = db.query(Subscriptions).filter(
-        (Subscriptions.lisence_plate1 == vehicle.lisence_plate) |
-        (Subscriptions.lisence_plate2 == vehicle.lisence_plate) |
-        (Subscriptions.lisence_plate3 == vehicle.lisence_plate)
-    ).all()
+    subscriptions = db.query(Subscriptions).filter(plate_filter(Subscriptions, vehicle.lisence_plate)).all()
 
     for subscription in subscriptions:
+        apply_occupancy_change(db, subscription.subscription_type_id, subscriptions=-1)
         db.delete(subscription)
         print(f"Deleted subscription: {subscription}")
 
@@ -0,0 +1,89 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from app.db.database import get_db
+from app.models.models import Subscriptions, Cancellations
+from app.queries.subscription import filter_subscriptions_query
+from app.routes.subscription_cancellation_route import filter_cancellations_query, build_cancellation_work_order
+from app.routes.subscription_routes import build_work_order
+from app.schemas.work_order import WorkOrderRegenerate
+from app.utils.streaming import NDJSON_MEDIA_TYPE
+from app.utils.work_order_helper import latest_work_order_ids, latest_work_order
+from app.utils.work_order_queue import attach_work_order_document
+from app.utils.work_order_regeneration import claim_regeneration, release_regeneration, start_regeneration
+
+router = APIRouter()
+
+REGENERATION_TARGETS = {
+    'subscription': (Subscriptions, filter_subscriptions_query),
+    'cancellation': (Cancellations, filter_cancellations_query),
+}
+
+
+def issue_missing_work_order(db: Session, target_type: str, target):
+    """Number and record a work order for a subscription / cancellation created before work orders were stored"""
+    if target_type == 'subscription':
+        no_plate_changes = {'lisence_plate1': None, 'lisence_plate2': None, 'lisence_plate3': None}
+        build_work_order(target, db, no_plate_changes)
+    else:
+        build_cancellation_work_order(target, db)
+    db.flush()
+    attach_work_order_document(db, latest_work_order(db, target_type, target.id))
+
+
+@router.post("/work-orders/regenerate")
+def regenerate_work_orders(regenerate_request: WorkOrderRegenerate, db: Session = Depends(get_db)):
+    """
+    Render again the latest work order of the selected subscriptions or cancellations (by ids
+    and / or filters), e.g. after a template change. Those without a stored work order are
+    reported as skipped, or get a new one (a new number and file) with issue_missing. Streams
+    NDJSON progress; the last line links to the ZIP with all the PDFs.
+    """
+    if regenerate_request.target_type not in REGENERATION_TARGETS:
+        raise HTTPException(status_code=400, detail="target_type debe ser 'subscription' o 'cancellation'")
+    if not (regenerate_request.ids or regenerate_request.owner_dni or regenerate_request.plate
+            or regenerate_request.subscription_type_id is not None):
+        raise HTTPException(status_code=400, detail="Indique los ids o un filtro")
+    # Taken before issuing new work order numbers; the stream releases it when it ends
+    if not claim_regeneration():
+        raise HTTPException(status_code=409, detail="Ya hay una regeneración de órdenes de trabajo en curso")
+
+    try:
+        model, filter_query = REGENERATION_TARGETS[regenerate_request.target_type]
+        query = filter_query(
+            db,
+            owner_dni=regenerate_request.owner_dni,
+            plate=regenerate_request.plate,
+            subscription_type_id=regenerate_request.subscription_type_id,
+        )
+        if regenerate_request.ids:
+            query = query.filter(model.id.in_(regenerate_request.ids))
+        targets = query.order_by(model.id).all()
+        if not targets:
+            raise HTTPException(status_code=404, detail="No se encontraron registros")
+
+        existing = latest_work_order_ids(db, regenerate_request.target_type, [target.id for target in targets])
+        skipped = []
+        for target in targets:
+            if target.id in existing:
+                continue
+            if not regenerate_request.issue_missing:
+                skipped.append({'target_type': regenerate_request.target_type, 'target_id': target.id, 'status': 'skipped',
+                                'error': "Sin orden de trabajo guardada (issue_missing para numerar una nueva)"})
+                continue
+            try:
+                issue_missing_work_order(db, regenerate_request.target_type, target)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                skipped.append({'target_type': regenerate_request.target_type, 'target_id': target.id, 'error': detail})
+
+        work_order_ids = list(latest_work_order_ids(db, regenerate_request.target_type,
+                                                    [target.id for target in targets]).values())
+        lines = start_regeneration(work_order_ids, skipped, regenerate_request.created_by)
+    except Exception:
+        release_regeneration()
+        raise
+    return StreamingResponse(lines, media_type=NDJSON_MEDIA_TYPE)
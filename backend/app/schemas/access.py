@@ -0,0 +1,26 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+
+class AccessCheck(BaseModel):
+    kind: str  # plate, access_card, remote_control_number or tique_x_park
+    value: str
+    direction: Optional[str] = None  # entry: also deny a subscription already inside (anti-passback)
+    parking_lot_id: Optional[int] = None  # Lot of the gate: deny subscriptions of another lot
+
+
+class AccessBatch(BaseModel):
+    checks: List[AccessCheck] = Field(..., max_length=1000)
+
+
+class AccessResult(BaseModel):
+    kind: str
+    value: str
+    authorized: bool
+    subscription_id: Optional[int] = None
+    owner_id: Optional[str] = None
+    subscription_type_id: Optional[int] = None
+    parking_lot_id: Optional[int] = None  # Lot of the subscription type, None: every lot
+    reason: Optional[str] = None  # Why it is denied: not_subscribed, wrong_parking_lot or anti_passback
+    inside_parking_lot_id: Optional[int] = None  # Where the subscription is inside, for anti_passback
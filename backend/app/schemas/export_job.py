@@ -0,0 +1,28 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class ExportJobCreate(BaseModel):
+    dataset: str  # subscriptions, owners, vehicles, cancellations, owner_histories, ...
+    export_format: str  # xlsx, csv or parquet
+    fields: Optional[List[str]] = None  # All fields of the dataset when omitted
+    ids: Optional[List[str]] = None  # Whole table when omitted
+    created_by: Optional[str] = None
+
+
+class ExportJobResponse(BaseModel):
+    id: str
+    dataset: str
+    export_format: str
+    status: str
+    row_count: Optional[int] = None
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    cached: bool = False
+    download_url: Optional[str] = None
+
+    class Config:
+        from_attributes = True
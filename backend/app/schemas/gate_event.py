@@ -0,0 +1,22 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+
+class GateEventIn(BaseModel):
+    parking_lot_id: int
+    gate: str
+    direction: str  # entry or exit
+    kind: str = 'plate'  # plate, access_card, remote_control_number or tique_x_park
+    value: str
+    occurred_at: Optional[datetime] = None  # When the gate saw it, defaults to when it is received
+
+
+class GateEventBatch(BaseModel):
+    events: List[GateEventIn] = Field(..., min_length=1, max_length=5000)
+
+
+class GateEventBatchResult(BaseModel):
+    accepted: int
+    pending: int  # Events buffered and not yet written, including these
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel, validator
 
 
@@ -37,4 +39,21 @@ class ParkingLotStats(BaseModel):
 
 
 class ParkingLotStatsResponse(BaseModel):
-    stats: ParkingLotStats
\ No newline at end of file
+    stats: ParkingLotStats
+
+class ParkingLotLiveOccupancy(BaseModel):
+    """Vehicles inside now, from the gate events (ParkingLotStats counts subscriptions)"""
+    parking_lot_id: int
+    cars_inside: int
+    total_car_spaces: int
+    free_car_spaces: int
+    motorcycles_inside: int
+    total_motorcycle_spaces: int
+    free_motorcycle_spaces: int
+
+
+class VehicleInside(BaseModel):
+    subscription_id: Optional[int] = None
+    kind: Optional[str] = None  # Credential of a visitor (no subscription)
+    value: Optional[str] = None
+    vehicle_class: str
@@ -9,6 +9,9 @@ class Subscription_Types_Create(BaseModel):
     name: str
     price: float
     parking_code: str
+    parking_lot_id: Optional[int] = None
+    vehicle_class: Optional[str] = None  # 'car' or 'motorcycle'
+    consumes_space: bool = False
 
     class Config:
         from_attributes = True
@@ -19,6 +22,9 @@ class Subscription_Types_Response(BaseModel):
     name: str
     price: float
     parking_code: str
+    parking_lot_id: Optional[int] = None
+    vehicle_class: Optional[str] = None
+    consumes_space: bool = False
 
     class Config:
         # from_attributes = True  # Enable the use of from_orm
@@ -68,11 +74,15 @@ class SubscriptionResponse(BaseModel):
     created_by: str
     modified_by: Optional[str] = None
     modification_time: Optional[datetime] = None
+    work_order_status: Optional[str] = None  # Deferred work order: pending, ready or failed
 
     @validator('documents', pre=True)
     def format_documents(cls, v):
         if isinstance(v, str):
             return [f"/subscription_files/{Path(doc.strip()).name}" for doc in v.split(',') if doc.strip()]
+        if v and not isinstance(v[0], str):
+            # Rows of the documents relationship (from_orm)
+            return [f"/subscription_files/{document.filename}" for document in v]
         return v
 
 
@@ -50,9 +50,13 @@ class CancellationResponse(BaseModel):
     modification_time: Optional[datetime]
     created_by: str
     modified_by: Optional[str] = None
+    work_order_status: Optional[str] = None  # Deferred work order: pending, ready or failed
 
     @validator('documents', pre=True)
     def format_documents(cls, v):
         if isinstance(v, str):
             return [f"/subscription_files/{Path(doc.strip()).name}" for doc in v.split(',') if doc.strip()]
+        if v and not isinstance(v[0], str):
+            # Rows of the documents relationship (from_orm)
+            return [f"/subscription_files/{document.filename}" for document in v]
         return v
@@ -0,0 +1,16 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class WorkOrderRegenerate(BaseModel):
+    target_type: str  # subscription or cancellation
+    ids: Optional[List[int]] = None  # Subscription / cancellation ids
+    # Filters, combined with the ids when both are given
+    owner_dni: Optional[str] = None
+    plate: Optional[str] = None
+    subscription_type_id: Optional[int] = None
+    created_by: Optional[str] = None
+    # Number new work orders for the records that have none stored (created before work orders
+    # were kept); otherwise they are reported as skipped
+    issue_missing: bool = False
@@ -0,0 +1,251 @@
+"""
+In-memory index of the credentials that open the barriers: the plates, access cards, remote
+controls and tique x park of every subscription, each mapped to its subscription and the
+parking lot of its type (None: a type not tied to a lot, valid in every lot).
+
+The gate cameras check a plate on every pass. Instead of a query across the three unindexed
+plate columns of subscriptions, a lookup is a dict read. The index is loaded at startup and
+kept current from the session events: the subscriptions a transaction inserted, changed or
+deleted are read again into the index once it commits (bulk ORM statements on subscriptions,
+and changes to subscription types, reload it all). Writes that bypass the ORM, or come from another process, are picked up by the
+full reload every ACCESS_INDEX_REFRESH_SECONDS.
+
+Benchmark against the query it replaces:
+    python -m app.utils.access_index --lookups 100000
+"""
+import argparse
+import os
+import re
+import threading
+import time
+from itertools import chain
+from typing import NamedTuple, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.models.models import Subscriptions, Subscription_types
+
+ACCESS_INDEX_REFRESH_SECONDS = int(os.getenv("ACCESS_INDEX_REFRESH_SECONDS", "300"))
+
+# Credential kind -> subscription columns holding it
+CREDENTIAL_COLUMNS = {
+    'plate': ['lisence_plate1', 'lisence_plate2', 'lisence_plate3'],
+    'access_card': ['access_card'],
+    'remote_control_number': ['remote_control_number'],
+    'tique_x_park': ['tique_x_park'],
+}
+
+SUBSCRIPTION_COLUMNS = [Subscriptions.id, Subscriptions.owner_id, Subscriptions.subscription_type_id,
+                        Subscription_types.parking_lot_id] + [
+    getattr(Subscriptions, column) for columns in CREDENTIAL_COLUMNS.values() for column in columns
+]
+
+
+class Authorization(NamedTuple):
+    subscription_id: int
+    owner_id: str
+    subscription_type_id: int
+    parking_lot_id: Optional[int]
+
+
+# kind -> {credential: (Authorization, ...) ordered by subscription id}. Entries are replaced, never
+# modified, so lookups read them without the lock.
+_index = {kind: {} for kind in CREDENTIAL_COLUMNS}
+# subscription id -> [(kind, credential)], to drop a subscription's entries
+_keys = {}
+_loaded = False
+_lock = threading.Lock()
+
+
+def normalize_credential(kind: str, value: str) -> str:
+    """Plates without spaces or dashes and in capitals, as the cameras read them"""
+    if kind == 'plate':
+        return re.sub(r'[^0-9A-Z]', '', value.upper())
+    return value.strip()
+
+
+def subscription_keys(row) -> list:
+    keys = []
+    for kind, columns in CREDENTIAL_COLUMNS.items():
+        for column in columns:
+            value = getattr(row, column)
+            credential = normalize_credential(kind, value) if value else None
+            if credential and (kind, credential) not in keys:
+                keys.append((kind, credential))
+    return keys
+
+
+def subscription_rows(db: Session):
+    return db.query(*SUBSCRIPTION_COLUMNS).outerjoin(
+        Subscription_types, Subscription_types.id == Subscriptions.subscription_type_id)
+
+
+def add_entries(index: dict, keys: dict, row):
+    authorization = Authorization(row.id, row.owner_id, row.subscription_type_id, row.parking_lot_id)
+    keys[row.id] = subscription_keys(row)
+    for kind, credential in keys[row.id]:
+        entries = index[kind].get(credential, ()) + (authorization,)
+        index[kind][credential] = tuple(sorted(entries))
+
+
+def remove_entries(index: dict, keys: dict, subscription_id: int):
+    for kind, credential in keys.pop(subscription_id, ()):
+        entries = tuple(entry for entry in index[kind].get(credential, ()) if entry.subscription_id != subscription_id)
+        if entries:
+            index[kind][credential] = entries
+        else:
+            index[kind].pop(credential, None)
+
+
+def load_access_index(db: Session):
+    """Build the whole index from subscriptions and swap it in"""
+    global _index, _keys, _loaded
+    # Under the lock, so a refresh of committed changes never interleaves with a stale full load
+    with _lock:
+        index = {kind: {} for kind in CREDENTIAL_COLUMNS}
+        keys = {}
+        for row in subscription_rows(db).yield_per(5000):
+            add_entries(index, keys, row)
+        _index, _keys, _loaded = index, keys, True
+    return len(keys)
+
+
+def refresh_subscriptions(db: Session, subscription_ids):
+    """Read these subscriptions into the index again (deleted ones drop out)"""
+    with _lock:
+        rows = subscription_rows(db).filter(Subscriptions.id.in_(subscription_ids)).all()
+        for subscription_id in subscription_ids:
+            remove_entries(_index, _keys, subscription_id)
+        for row in rows:
+            add_entries(_index, _keys, row)
+
+
+def lookup_credential(kind: str, value: str, parking_lot_id: Optional[int] = None) -> Optional[Authorization]:
+    """
+    Subscription (the oldest, if several) authorizing a credential, in parking_lot_id when given,
+    None if there is none
+    """
+    if not _loaded:
+        from app.db.database import SessionLocal
+
+        with SessionLocal() as db:
+            load_access_index(db)
+    for entry in _index[kind].get(normalize_credential(kind, value), ()):
+        if parking_lot_id is None or entry.parking_lot_id in (None, parking_lot_id):
+            return entry
+    return None
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_subscription_changes(session, flush_context):
+    changed = {instance.id for instance in chain(session.new, session.dirty, session.deleted)
+               if isinstance(instance, Subscriptions)}
+    if changed:
+        session.info.setdefault('changed_subscriptions', set()).update(changed)
+    # The parking lot of a type is in the entries of all its subscriptions
+    if any(isinstance(instance, Subscription_types) for instance in chain(session.new, session.dirty, session.deleted)):
+        session.info['reload_access_index'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def collect_bulk_subscription_changes(orm_execute_state):
+    if (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete) \
+            and orm_execute_state.bind_mapper in (Subscriptions.__mapper__, Subscription_types.__mapper__):
+        orm_execute_state.session.info['reload_access_index'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def refresh_committed_subscriptions(session):
+    changed = session.info.pop('changed_subscriptions', None)
+    reload = session.info.pop('reload_access_index', False)
+    if not _loaded or not (changed or reload):
+        return
+
+    from app.db.database import SessionLocal
+
+    try:
+        with SessionLocal() as db:
+            if reload:
+                load_access_index(db)
+            else:
+                refresh_subscriptions(db, changed)
+    except Exception as e:
+        # The periodic reload catches up
+        print(f"Error actualizando el índice de accesos: {str(e)}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_rolled_back_subscriptions(session):
+    session.info.pop('changed_subscriptions', None)
+    session.info.pop('reload_access_index', None)
+
+
+def initialize_access_index(db: Session):
+    """Load the index and reload it every ACCESS_INDEX_REFRESH_SECONDS in a background thread (called at startup)"""
+    print(f"Access index loaded with {load_access_index(db)} subscriptions")
+    if ACCESS_INDEX_REFRESH_SECONDS <= 0:
+        return
+
+    def reload_periodically():
+        from app.db.database import SessionLocal
+
+        while True:
+            time.sleep(ACCESS_INDEX_REFRESH_SECONDS)
+            try:
+                with SessionLocal() as session:
+                    load_access_index(session)
+            except Exception as e:
+                print(f"Error recargando el índice de accesos: {str(e)}")
+
+    threading.Thread(target=reload_periodically, name="access-index-reload", daemon=True).start()
+
+
+if __name__ == '__main__':
+    import random
+
+    from app.db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Benchmark plate authorization lookups")
+    parser.add_argument('--lookups', type=int, default=100000, help="index lookups to time")
+    parser.add_argument('--query-lookups', type=int, default=2000, help="lookups with the subscriptions query")
+    args = parser.parse_args()
+
+    def check_plate_query(session: Session, plate: str) -> bool:
+        # What check_subscription did for every call
+        return session.query(Subscriptions).filter(
+            (Subscriptions.lisence_plate1 == plate) |
+            (Subscriptions.lisence_plate2 == plate) |
+            (Subscriptions.lisence_plate3 == plate)
+        ).first() is not None
+
+    def report(name: str, latencies: list):
+        latencies.sort()
+        total = sum(latencies)
+        print(f"{name}: {len(latencies) / total:,.0f} lookups/s, "
+              f"p50 {latencies[len(latencies) // 2] * 1e6:.1f} µs, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f} µs")
+
+    with SessionLocal() as session:
+        start = time.perf_counter()
+        subscription_count = load_access_index(session)
+        print(f"Index of {subscription_count} subscriptions loaded in {time.perf_counter() - start:.2f}s")
+
+        # Known plates and as many unknown ones, like the cameras see them
+        plates = list(_index['plate']) or ['0000AAA']
+        samples = [random.choice(plates) if i % 2 else f"{random.randint(0, 9999):04d}ZZZ"
+                   for i in range(max(args.lookups, args.query_lookups))]
+
+        latencies = []
+        for plate in samples[:args.query_lookups]:
+            start = time.perf_counter()
+            check_plate_query(session, plate)
+            latencies.append(time.perf_counter() - start)
+        report("subscriptions query", latencies)
+
+        latencies = []
+        for plate in samples[:args.lookups]:
+            start = time.perf_counter()
+            lookup_credential('plate', plate)
+            latencies.append(time.perf_counter() - start)
+        report("access index", latencies)
@@ -0,0 +1,446 @@
+"""
+Sweeper for uploaded documents no record references (orphans) and documents rows whose file
+is missing (dangling).
+
+For each upload directory a sweep lists the names on disk (one scandir, no stat) and loads the
+names the database references, then takes two set differences:
+
+- referenced: the documents rows of the directory's record type, the comma-separated snapshots
+  of the history tables and approved cancellations, and the work order PDFs
+- orphans = on disk - referenced; those younger than DOCUMENT_GC_GRACE_MINUTES are left for
+  the next sweep (their upload may not have committed yet)
+- dangling = documents rows - on disk
+
+The files a cancellation carries over from its subscription stay in subscription_files (see
+queries/document.cancellation_document_path): cancellation rows count as references there, and
+are only dangling when their file is in neither directory.
+
+Sweeps are incremental. The state (document_gc/state.json) keeps, per directory, the names of the
+last listing and a cursor per reference source (row count, last id and last row). The next sweep
+only loads the rows added after the cursor, lists the directory again only if its mtime changed,
+and looks up by name the files added since the last listing; a directory where nothing changed
+is not listed or queried. Deleted rows make the directory's sweep a full one, as does --full.
+
+With quarantine, orphans are moved to document_gc/quarantine/<sweep>/<directory>/ and dangling
+upload rows are deleted and written to that sweep's dangling.json. Quarantined sweeps older than
+DOCUMENT_GC_QUARANTINE_DAYS are purged.
+
+    python -m app.utils.document_gc [--quarantine] [--full] [--purge] [--list]
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.models.models import Document, DocumentBlob, Owners_history, Vehicles_history, Subscription_history, \
+    ApprovedCancellations, WorkOrder, PendingWorkOrder
+from app.queries.document import DOCUMENT_DIRECTORIES
+from app.utils.document_store import DOCUMENT_DIRS, document_checksum, remove_blob_reference
+
+GC_DIR = Path(os.getcwd()) / "document_gc"
+STATE_PATH = GC_DIR / "state.json"
+QUARANTINE_DIR = GC_DIR / "quarantine"
+QUARANTINE_NAME_FORMAT = "%Y%m%d_%H%M%S"
+
+DOCUMENT_GC_INTERVAL_HOURS = float(os.getenv("DOCUMENT_GC_INTERVAL_HOURS", "24"))
+DOCUMENT_GC_QUARANTINE = os.getenv("DOCUMENT_GC_QUARANTINE", "false").lower() in ("1", "true", "yes")
+DOCUMENT_GC_GRACE_MINUTES = int(os.getenv("DOCUMENT_GC_GRACE_MINUTES", "60"))
+DOCUMENT_GC_QUARANTINE_DAYS = int(os.getenv("DOCUMENT_GC_QUARANTINE_DAYS", "30"))
+
+# Upload directory -> reference column of its documents rows
+DIRECTORY_REFERENCES = {directory: reference for reference, directory in DOCUMENT_DIRECTORIES.items()}
+
+# Reference column -> directories the files of its rows can be in, its own first
+ROW_DIRECTORIES = {reference: [directory] for reference, directory in DOCUMENT_DIRECTORIES.items()}
+ROW_DIRECTORIES['cancellation_id'].append(DOCUMENT_DIRECTORIES['subscription_id'])
+
+# Snapshot tables and the directories their names can be in (the frontend looks in both subscription ones)
+SNAPSHOT_DIRECTORIES = {
+    Owners_history: ['uploads'],
+    Vehicles_history: ['vehicle_uploads'],
+    Subscription_history: ['subscription_files', 'cancelled_subscription_files'],
+    ApprovedCancellations: ['subscription_files', 'cancelled_subscription_files'],
+}
+
+WORK_ORDER_MODELS = [WorkOrder, PendingWorkOrder]
+WORK_ORDER_DIRECTORIES = ['subscription_files', 'cancelled_subscription_files']
+
+# Names being written by utils/uploads and utils/document_store
+TEMP_SUFFIXES = ('.part', '.link')
+
+
+def reference_sources(directory: str) -> list:
+    """(state key, model, criteria, name column) of the tables whose rows can name a file in directory"""
+    sources = [(f"documents.{reference}", Document, [getattr(Document, reference).isnot(None)], Document.filename)
+               for reference in row_references(directory)]
+    sources += [(model.__tablename__, model, [model.documents.isnot(None)], model.documents)
+                for model, directories in SNAPSHOT_DIRECTORIES.items() if directory in directories]
+    if directory in WORK_ORDER_DIRECTORIES:
+        sources.append((WorkOrder.__tablename__, WorkOrder, [], WorkOrder.file_path))
+    return sources
+
+
+def source_cursor(db: Session, source: tuple) -> list:
+    """
+    Row count, last id and the value of the last row. Inserts move the last id; deletes lower
+    the count, or change the last row when SQLite gives its id to a new one.
+    """
+    key, model, criteria, column = source
+    primary_key = model.__mapper__.primary_key[0]
+    count, last_id = db.query(func.count(primary_key), func.max(primary_key)).filter(*criteria).one()
+    last_value = db.query(column).filter(primary_key == last_id).scalar() if last_id is not None else None
+    return [count, last_id, last_value]
+
+
+def row_directories(directory: str) -> list:
+    """Directories the files of directory's documents rows can be in, directory first"""
+    return ROW_DIRECTORIES[DIRECTORY_REFERENCES[directory]]
+
+
+def row_references(directory: str) -> list:
+    """Reference columns whose documents rows can name a file in directory"""
+    return [reference for reference, directories in ROW_DIRECTORIES.items() if directory in directories]
+
+
+def split_names(documents: Optional[str]) -> set:
+    return {Path(name.strip()).name for name in (documents or '').split(',') if name.strip()}
+
+
+def value_names(model, value: str, directory: str) -> set:
+    """Names in directory one row names: a filename, a snapshot or a work order path"""
+    if model is Document:
+        return {value}
+    if model in WORK_ORDER_MODELS:
+        return {Path(value).name} if Path(value).parent.name == directory else set()
+    return split_names(value)
+
+
+def source_names(db: Session, directory: str, source: tuple, after_id: Optional[int],
+                 last_id: Optional[int]) -> tuple[set, int]:
+    """
+    Names the rows of a source with ids in (after_id, last_id] name in directory.
+
+    Returns:
+        tuple: (set of names, number of rows)
+    """
+    key, model, criteria, column = source
+    if last_id is None:
+        return set(), 0
+    primary_key = model.__mapper__.primary_key[0]
+    query = db.query(column).filter(*criteria, primary_key <= last_id)
+    if after_id is not None:
+        query = query.filter(primary_key > after_id)
+    names = set()
+    rows = 0
+    for (value,) in query.yield_per(10000):
+        rows += 1
+        names |= value_names(model, value, directory)
+    return names, rows
+
+
+def added_references(db: Session, directory: str, sources: list, previous: dict, cursor: dict) -> Optional[dict]:
+    """
+    Names of the rows added to each source since the previous cursor, or None if rows were
+    deleted (any name may have lost its reference).
+    """
+    added = {}
+    for source in sources:
+        key, model, criteria, column = source
+        previous_count, previous_id, previous_value = previous[key]
+        primary_key = model.__mapper__.primary_key[0]
+        if previous_id is not None and db.query(column).filter(
+                primary_key == previous_id, *criteria).scalar() != previous_value:
+            return None
+        names, rows = source_names(db, directory, source, previous_id, cursor[key][1])
+        if previous_count + rows != cursor[key][0]:
+            return None
+        added[key] = names
+    return added
+
+
+def referenced_among(db: Session, directory: str, sources: list, names: set) -> set:
+    """Which of names a row of sources names, looked up by name"""
+    found = set()
+    names = sorted(names)
+    for start in range(0, len(names), 100):
+        chunk = names[start:start + 100]
+        for key, model, criteria, column in sources:
+            if model is Document:
+                condition = column.in_(chunk)
+            elif model in WORK_ORDER_MODELS:
+                condition = or_(*(column.endswith(name, autoescape=True) for name in chunk))
+            else:
+                condition = or_(*(column.contains(name, autoescape=True) for name in chunk))
+            for (value,) in db.query(column).filter(condition, *criteria):
+                found |= value_names(model, value, directory) & set(chunk)
+    return found
+
+
+def pending_work_order_names(db: Session, directory: str) -> set:
+    """Names of queued work orders (a short queue, loaded whole since its rows are deleted when done)"""
+    if directory not in WORK_ORDER_DIRECTORIES:
+        return set()
+    return {name for (file_path,) in db.query(PendingWorkOrder.file_path)
+            for name in value_names(PendingWorkOrder, file_path, directory)}
+
+
+def directory_names(directory: str) -> set:
+    """Names of the files in directory, without stat (the type comes with the listing)"""
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries
+                if not entry.name.endswith(TEMP_SUFFIXES) and not entry.is_dir(follow_symlinks=False)}
+
+
+def is_settled(path: str, cutoff: float) -> bool:
+    try:
+        return os.lstat(path).st_mtime < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def quarantine_orphans(db: Session, directory: str, orphans: list, quarantine_dir: Path) -> list:
+    """Move orphans aside (symlinks stay symlinks and keep their blob), returns those moved"""
+    referenced = or_(*(getattr(Document, reference).isnot(None) for reference in row_references(directory)))
+    target_dir = quarantine_dir / directory
+    moved = []
+    for name in orphans:
+        # Referenced since the sweep listed it (a document saved under the same name)
+        if db.query(Document.id).filter(Document.filename == name, referenced).first():
+            continue
+        target_dir.mkdir(parents=True, exist_ok=True)
+        shutil.move(os.path.join(directory, name), target_dir / name)
+        moved.append(name)
+    return moved
+
+
+def remove_dangling(db: Session, directory: str, dangling: list) -> list:
+    """Delete the upload rows of dangling names whose file is still missing, returns them as dicts"""
+    missing = [name for name in dangling
+               if not any(os.path.lexists(os.path.join(path, name)) for path in row_directories(directory))]
+    reference = getattr(Document, DIRECTORY_REFERENCES[directory])
+    documents = db.query(Document).filter(reference.isnot(None), Document.kind == 'upload',
+                                          Document.filename.in_(missing)).all() if missing else []
+    removed = []
+    for document in documents:
+        removed.append({
+            'id': document.id,
+            'directory': directory,
+            'filename': document.filename,
+            **{reference: getattr(document, reference) for reference in DOCUMENT_DIRECTORIES},
+            'size': document.size,
+            'checksum': document.checksum,
+            'created_at': document.created_at.isoformat() if document.created_at else None,
+        })
+        db.delete(document)
+    db.commit()
+    return removed
+
+
+def settled_names(directory: str, names: set) -> tuple[list, list]:
+    """Split unreferenced names into orphans and those younger than the grace period"""
+    cutoff = time.time() - DOCUMENT_GC_GRACE_MINUTES * 60
+    orphans = []
+    unsettled = []
+    for name in sorted(names):
+        if is_settled(os.path.join(directory, name), cutoff):
+            orphans.append(name)
+        else:
+            unsettled.append(name)
+    return orphans, unsettled
+
+
+def locate_missing(directory: str, names: set) -> tuple[list, list]:
+    """Split names of rows missing from directory into dangling and those in another of their directories"""
+    dangling = []
+    elsewhere = []
+    for name in sorted(names):
+        if any(os.path.lexists(os.path.join(path, name)) for path in row_directories(directory)[1:]):
+            elsewhere.append(name)
+        else:
+            dangling.append(name)
+    return dangling, elsewhere
+
+
+def sweep_directory(db: Session, directory: str, previous: Optional[dict], full: bool = False) -> dict:
+    """
+    Orphans and dangling names of one directory. After a first full sweep only the changes are
+    compared: the rows added since the cursor of each source, and the names added to or removed
+    from the directory since its last listing (it is listed again only when its mtime changed).
+    Deleted rows can leave any name unreferenced, so they make it a full sweep.
+    """
+    sources = reference_sources(directory)
+    own_key = f"documents.{DIRECTORY_REFERENCES[directory]}"
+    # mtimes before listing: names added while listing make the next sweep list again
+    result = {'mtime_ns': [os.stat(path).st_mtime_ns for path in row_directories(directory) if os.path.isdir(path)],
+              'cursor': {source[0]: source_cursor(db, source) for source in sources}}
+    pending_work_orders = pending_work_order_names(db, directory)
+    result['pending_work_orders'] = sorted(pending_work_orders)
+
+    added = None
+    if not full and previous and previous.get('cursor', {}).keys() == result['cursor'].keys():
+        if not previous['unsettled'] and previous['mtime_ns'] == result['mtime_ns'] \
+                and previous['cursor'] == result['cursor'] \
+                and previous['pending_work_orders'] == result['pending_work_orders']:
+            return {**previous, 'skipped': True, 'full': False}
+        added = added_references(db, directory, sources, previous['cursor'], result['cursor'])
+
+    if added is None:
+        on_disk = directory_names(directory)
+        references = {source[0]: source_names(db, directory, source, None, result['cursor'][source[0]][1])[0]
+                      for source in sources}
+        unreferenced = on_disk - set().union(*references.values()) - pending_work_orders
+        missing = references[own_key] - on_disk
+    else:
+        listed = set(previous['names'])
+        on_disk = directory_names(directory) if previous['mtime_ns'][0] != result['mtime_ns'][0] else listed
+        referenced = set().union(*added.values()) | pending_work_orders
+        # New names, and names only a queued work order named, may be named by older rows
+        check = (on_disk - listed) | (set(previous['pending_work_orders']) - pending_work_orders)
+        check = (check & on_disk) - referenced
+        unreferenced = ((set(previous['orphans']) | set(previous['unsettled'])) & on_disk) - referenced
+        unreferenced |= check - referenced_among(db, directory, sources, check)
+        removed = listed - on_disk
+        missing = set(previous['dangling']) | set(previous['elsewhere']) | added[own_key]
+        missing |= referenced_among(db, directory, [source for source in sources if source[0] == own_key], removed)
+        missing -= on_disk
+
+    orphans, unsettled = settled_names(directory, unreferenced)
+    dangling, elsewhere = locate_missing(directory, missing)
+    result.update(names=sorted(on_disk), orphans=orphans, unsettled=unsettled, dangling=dangling,
+                  elsewhere=elsewhere, skipped=False, full=added is None)
+    return result
+
+
+def sweep_documents(db: Session, quarantine: bool = False, full: bool = False) -> dict:
+    """
+    Sweep all upload directories, optionally quarantining what is found.
+
+    Returns:
+        dict: {directory: {'orphans': [...], 'dangling': [...], 'skipped': bool, ...}}
+    """
+    state = json.loads(STATE_PATH.read_text()) if STATE_PATH.exists() else {}
+    quarantine_dir = QUARANTINE_DIR / datetime.now().strftime(QUARANTINE_NAME_FORMAT) if quarantine else None
+    removed_rows = []
+    report = {}
+
+    for directory in DOCUMENT_DIRS:
+        if not os.path.isdir(directory):
+            continue
+        result = sweep_directory(db, directory, state.get(directory), full)
+        message = f"Document sweep {directory}: {len(result['orphans'])} orphaned, {len(result['dangling'])} dangling"
+        if result['skipped']:
+            message += " (unchanged)"
+        elif result['full']:
+            message += " (full)"
+        if quarantine and (result['orphans'] or result['dangling']):
+            quarantined = quarantine_orphans(db, directory, result['orphans'], quarantine_dir)
+            removed = remove_dangling(db, directory, result['dangling'])
+            removed_rows += removed
+            message += f", {len(quarantined)} quarantined, {len(removed)} rows removed"
+        report[directory] = result
+        print(message)
+
+    if removed_rows:
+        (quarantine_dir / "dangling.json").parent.mkdir(parents=True, exist_ok=True)
+        (quarantine_dir / "dangling.json").write_text(json.dumps(removed_rows, indent=2))
+
+    GC_DIR.mkdir(parents=True, exist_ok=True)
+    temp_path = STATE_PATH.with_name(f"{STATE_PATH.name}.part")
+    temp_path.write_text(json.dumps({directory: {key: value for key, value in result.items()
+                                                 if key not in ('skipped', 'full')}
+                                     for directory, result in report.items()}))
+    os.replace(temp_path, STATE_PATH)
+    return report
+
+
+def has_surplus_reference(db: Session, checksum: str) -> bool:
+    """
+    Whether the blob counts more references than the documents rows naming it. A quarantined
+    symlink left by a failed upload may never have been counted, so its reference is only
+    released when there is one to spare.
+    """
+    blob = db.query(DocumentBlob).filter(DocumentBlob.checksum == checksum).first()
+    if not blob:
+        return False
+    documents = db.query(func.count(Document.id)).filter(Document.checksum == checksum).scalar()
+    return blob.ref_count > documents
+
+
+def purge_quarantine(db: Session, days: int = DOCUMENT_GC_QUARANTINE_DAYS) -> int:
+    """Delete quarantined sweeps older than days, releasing their blobs. Returns the sweeps purged."""
+    if not QUARANTINE_DIR.is_dir():
+        return 0
+    cutoff = datetime.now() - timedelta(days=days)
+    purged = 0
+    for quarantine_dir in sorted(QUARANTINE_DIR.iterdir()):
+        try:
+            swept_at = datetime.strptime(quarantine_dir.name, QUARANTINE_NAME_FORMAT)
+        except ValueError:
+            continue
+        if swept_at >= cutoff:
+            continue
+        for path in quarantine_dir.rglob('*'):
+            checksum = document_checksum(path)
+            if checksum and has_surplus_reference(db, checksum):
+                remove_blob_reference(db, checksum)
+        # Blobs left without references are deleted after this commit (utils/document_store)
+        db.commit()
+        shutil.rmtree(quarantine_dir)
+        purged += 1
+    return purged
+
+
+def run_document_gc():
+    from app.db.database import SessionLocal
+
+    with SessionLocal() as db:
+        sweep_documents(db, quarantine=DOCUMENT_GC_QUARANTINE)
+        if DOCUMENT_GC_QUARANTINE:
+            purge_quarantine(db)
+
+
+def start_document_gc():
+    """Sweep every DOCUMENT_GC_INTERVAL_HOURS in a background thread (called at startup, 0 disables it)"""
+    if DOCUMENT_GC_INTERVAL_HOURS <= 0:
+        return
+
+    def sweep_periodically():
+        while True:
+            time.sleep(DOCUMENT_GC_INTERVAL_HOURS * 3600)
+            try:
+                run_document_gc()
+            except Exception as e:
+                print(f"Error en la limpieza de documentos: {str(e)}")
+
+    threading.Thread(target=sweep_periodically, name="document-gc", daemon=True).start()
+
+
+if __name__ == '__main__':
+    from app.db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Find orphaned and dangling uploaded documents")
+    parser.add_argument('--quarantine', action='store_true', help="Move orphans aside and delete dangling rows")
+    parser.add_argument('--full', action='store_true', help="Sweep every directory, even unchanged ones")
+    parser.add_argument('--purge', action='store_true',
+                        help=f"Delete quarantined sweeps older than {DOCUMENT_GC_QUARANTINE_DAYS} days")
+    parser.add_argument('--list', action='store_true', help="Print the orphaned and dangling names")
+    args = parser.parse_args()
+
+    with SessionLocal() as session:
+        sweep_report = sweep_documents(session, quarantine=args.quarantine, full=args.full)
+        if args.list:
+            for swept_directory, swept in sweep_report.items():
+                for name in swept['orphans']:
+                    print(f"orphan {swept_directory}/{name}")
+                for name in swept['dangling']:
+                    print(f"dangling {swept_directory}/{name}")
+        if args.purge:
+            print(f"{purge_quarantine(session)} quarantined sweeps purged")
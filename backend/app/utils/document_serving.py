@@ -0,0 +1,85 @@
+"""
+Downloads of uploaded documents (uploads, vehicle_uploads, subscription_files and
+cancelled_subscription_files).
+
+document_response sends a document with a strong ETag, Last-Modified and Cache-Control, answers
+If-None-Match / If-Modified-Since with 304 without opening the file, and leaves Range and
+If-Range (206 / 416) to FileResponse. Documents in the store (utils/document_store) use their
+sha256 as ETag, taken from the symlink, so the same scan has the same ETag under every name.
+
+With DOCUMENT_ACCEL_REDIRECT enabled the API only checks the request and answers with an
+X-Accel-Redirect to DOCUMENT_ACCEL_PREFIX; nginx then sends the file itself (see the
+protected_documents location in nginx/default.conf), so large downloads do not hold a worker.
+"""
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request
+from starlette.responses import FileResponse, Response
+
+from app.utils.document_store import document_checksum
+
+DOCUMENT_CACHE_MAX_AGE = int(os.getenv("DOCUMENT_CACHE_MAX_AGE", "300"))
+DOCUMENT_ACCEL_REDIRECT = os.getenv("DOCUMENT_ACCEL_REDIRECT", "false").lower() in ("1", "true", "yes")
+DOCUMENT_ACCEL_PREFIX = os.getenv("DOCUMENT_ACCEL_PREFIX", "/protected_documents")
+
+
+def document_path(directory: str, filename: str) -> Path:
+    """Path of a document of directory, 404 for missing files and names leaving the directory"""
+    if not filename or filename != os.path.basename(filename) or filename.startswith('.'):
+        raise HTTPException(status_code=404, detail="File not found")
+    path = Path(directory) / filename
+    # is_file follows the symlink into the store
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    return path
+
+
+def document_headers(path: Path, stat_result: os.stat_result) -> dict:
+    """Validators and caching headers of a document (stat_result is that of the file it points to)"""
+    checksum = document_checksum(path)
+    # Files outside the store (work orders, not migrated files) are replaced by a rename, which changes the mtime
+    etag = f'"{checksum}"' if checksum else f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+    # A name can be pointed at an older blob, so the symlink's own mtime counts too
+    modified = max(stat_result.st_mtime, path.lstat().st_mtime)
+    return {
+        "ETag": etag,
+        "Last-Modified": formatdate(modified, usegmt=True),
+        "Cache-Control": f"private, max-age={DOCUMENT_CACHE_MAX_AGE}, must-revalidate",
+        "Accept-Ranges": "bytes",
+    }
+
+
+def is_not_modified(request: Request, headers: dict) -> bool:
+    """Whether the client's copy is current (If-None-Match takes precedence over If-Modified-Since)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or headers["ETag"] in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(headers["Last-Modified"])
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def document_response(request: Request, directory: str, filename: str) -> Response:
+    """Response for a GET / HEAD of a document: 304, an X-Accel-Redirect or the file itself"""
+    path = document_path(directory, filename)
+    stat_result = path.stat()
+    headers = document_headers(path, stat_result)
+
+    if is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    if DOCUMENT_ACCEL_REDIRECT:
+        # nginx keeps Cache-Control and handles the conditional and Range headers itself
+        headers["X-Accel-Redirect"] = f"{DOCUMENT_ACCEL_PREFIX}/{directory}/{quote(filename)}"
+        return Response(headers=headers)
+
+    return FileResponse(path, headers=headers, stat_result=stat_result)
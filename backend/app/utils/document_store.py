@@ -0,0 +1,239 @@
+"""
+Content-addressed storage for uploaded documents.
+
+Each uploaded file is stored once in BLOB_DIR under its sha256 (document_blobs/ab/ab12...). The
+name the records keep (uploads/<dni>_<file>, vehicle_uploads/..., subscription_files/...,
+cancelled_subscription_files/...) is a relative symlink to that blob, so stored filenames and
+URLs do not change, but the same DNI scan uploaded for an owner, a vehicle and a subscription
+takes the disk (and backup) space of one file.
+
+document_blobs keeps a reference count per blob. Releasing a name decrements it; once the
+transaction commits, blobs left without references are deleted. That delete runs in its own
+transaction and only when the count is still zero, so a concurrent upload of the same content,
+which increments the count before looking for the blob file, either waits for the delete and
+writes the blob again or keeps it alive.
+
+Existing files are moved into the store with:
+    python -m app.utils.document_store migrate
+"""
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import UploadFile
+from sqlalchemy import event, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from app.db.database import engine
+from app.models.models import DocumentBlob, Document
+from app.utils.uploads import save_upload, UPLOAD_CHUNK_SIZE
+
+BLOB_DIR = Path(os.getcwd()) / "document_blobs"
+BLOB_TEMP_DIR = BLOB_DIR / "tmp"
+BLOB_TEMP_DIR.mkdir(parents=True, exist_ok=True)
+
+# Upload directories whose files go through the store (relative to the working directory like the routes)
+DOCUMENT_DIRS = ["uploads", "vehicle_uploads", "subscription_files", "cancelled_subscription_files"]
+
+# Generated work orders are deduplicated by the render cache (pdf_renderer), not stored as blobs
+WORK_ORDER_FILENAME = re.compile(r"^ODT(Baja)?_\d+\.pdf$")
+
+
+def blob_path(checksum: str) -> Path:
+    return BLOB_DIR / checksum[:2] / checksum
+
+
+def document_checksum(path) -> Optional[str]:
+    """sha256 of the blob a document name points to, None for a plain file"""
+    path = Path(path)
+    if not path.is_symlink():
+        return None
+    target = Path(os.readlink(path))
+    return target.name if target.parent.parent.name == BLOB_DIR.name else None
+
+
+def add_blob_reference(db: Session, checksum: str, size: int):
+    table = DocumentBlob.__table__
+    statement = sqlite_insert(table).values(checksum=checksum, size=size, ref_count=1)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.checksum],
+        set_={'ref_count': table.c.ref_count + 1},
+    )
+    db.execute(statement)
+
+
+def remove_blob_reference(db: Session, checksum: str):
+    table = DocumentBlob.__table__
+    ref_count = db.execute(
+        table.update().where(table.c.checksum == checksum)
+        .values(ref_count=table.c.ref_count - 1)
+        .returning(table.c.ref_count)
+    ).scalar()
+    if ref_count is not None and ref_count <= 0:
+        db.info.setdefault('released_blobs', set()).add(checksum)
+
+
+def store_blob(db: Session, temp_path: Path, checksum: str, size: int) -> Path:
+    """Count a reference to the content of temp_path and make sure its blob exists (temp_path is consumed)"""
+    # Count the reference first: it takes the write lock, so a concurrent delete of this blob has finished
+    add_blob_reference(db, checksum, size)
+    blob = blob_path(checksum)
+    if blob.exists():
+        temp_path.unlink()
+    else:
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(temp_path, blob)
+    return blob
+
+
+def link_document(db: Session, blob: Path, destination):
+    """Point the document name at the blob, releasing whatever the name pointed to before"""
+    destination = Path(destination)
+    if destination.is_symlink() or destination.exists():
+        release_document(db, destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    os.symlink(os.path.relpath(blob, destination.parent), destination)
+
+
+async def stage_documents(documents: List[UploadFile]) -> list:
+    """
+    Stream and hash uploads to temporary files in the store, without touching the database.
+    Called before the request's first write: storing them takes the SQLite write lock (the
+    reference count), which must not be held across an await, or every other request writing
+    meanwhile waits for it on the event loop. Returns [(temp_path, size, sha256)] in order.
+    """
+    staged = []
+    try:
+        for document in documents or []:
+            temp_path = BLOB_TEMP_DIR / uuid.uuid4().hex
+            size, checksum = await save_upload(document, temp_path)
+            staged.append((temp_path, size, checksum))
+    except BaseException:
+        discard_staged_documents(staged)
+        raise
+    return staged
+
+
+def store_staged_document(db: Session, staged: tuple, destination) -> tuple[int, str]:
+    """
+    Make destination name a staged upload. The reference count is committed with the caller's
+    transaction. Returns (size, sha256).
+    """
+    temp_path, size, checksum = staged
+    try:
+        blob = store_blob(db, temp_path, checksum, size)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    link_document(db, blob, destination)
+    return size, checksum
+
+
+def discard_staged_documents(staged: list):
+    """Remove the temporary files of uploads that were not stored (the request failed)"""
+    for temp_path, _, _ in staged:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+async def save_document(db: Session, document: UploadFile, destination) -> tuple[int, str]:
+    """Stage and store a single upload, for a request with no other write before it. Returns (size, sha256)."""
+    staged = await stage_documents([document])
+    return store_staged_document(db, staged[0], destination)
+
+
+def release_document(db: Session, path):
+    """Remove a document name; its blob is deleted after the commit if nothing else references it"""
+    path = Path(path)
+    checksum = document_checksum(path)
+    if path.is_symlink() or path.exists():
+        path.unlink()
+    if checksum:
+        remove_blob_reference(db, checksum)
+
+
+def delete_unreferenced_blob(checksum: str):
+    with engine.begin() as connection:
+        deleted = connection.execute(
+            text("DELETE FROM document_blobs WHERE checksum = :checksum AND ref_count <= 0"),
+            {"checksum": checksum}
+        ).rowcount
+        # Removed before the commit releases the write lock, see the module docstring
+        if deleted and blob_path(checksum).exists():
+            blob_path(checksum).unlink()
+
+
+@event.listens_for(Session, 'after_commit')
+def delete_released_blobs(session):
+    for checksum in session.info.pop('released_blobs', ()):
+        delete_unreferenced_blob(checksum)
+
+
+@event.listens_for(Session, 'after_rollback')
+def keep_released_blobs(session):
+    session.info.pop('released_blobs', None)
+
+
+def migrate_document_dirs(db: Session) -> tuple[int, int, int]:
+    """
+    Move the plain files of DOCUMENT_DIRS into the store, replacing each by a symlink, and
+    record their checksum on the documents rows naming them.
+
+    Returns:
+        tuple: (files migrated, blobs created, bytes saved by deduplication)
+    """
+    from app.queries.document import DOCUMENT_DIRECTORIES
+
+    migrated = created = saved = 0
+    for directory in DOCUMENT_DIRS:
+        if not os.path.isdir(directory):
+            continue
+        reference = next(column for column, path in DOCUMENT_DIRECTORIES.items() if path == directory)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False) or entry.name.endswith(('.part', '.link')) \
+                        or WORK_ORDER_FILENAME.match(entry.name):
+                    continue
+
+                digest = hashlib.sha256()
+                with open(entry.path, "rb") as f:
+                    while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                checksum = digest.hexdigest()
+                size = entry.stat().st_size
+
+                if blob_path(checksum).exists():
+                    saved += size
+                else:
+                    created += 1
+                temp_path = BLOB_TEMP_DIR / uuid.uuid4().hex
+                shutil.copyfile(entry.path, temp_path)
+                blob = store_blob(db, temp_path, checksum, size)
+                db.execute(update(Document).where(
+                    Document.filename == entry.name, getattr(Document, reference).isnot(None)
+                ).values(checksum=checksum, size=size))
+                # Swap the file for the symlink in one rename, the document never goes missing
+                link_path = f"{entry.path}.link"
+                os.symlink(os.path.relpath(blob, directory), link_path)
+                os.replace(link_path, entry.path)
+                db.commit()
+                migrated += 1
+    return migrated, created, saved
+
+
+if __name__ == '__main__':
+    from app.db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Content-addressed document store")
+    parser.add_argument('command', choices=['migrate'])
+    args = parser.parse_args()
+
+    with SessionLocal() as session:
+        files, blobs, saved_bytes = migrate_document_dirs(session)
+    print(f"{files} documents moved into {blobs} new blobs, {saved_bytes / 1024 / 1024:.1f} MB saved by deduplication")
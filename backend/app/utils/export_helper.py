@@ -0,0 +1,343 @@
+"""
+Export helpers for subscriptions and the other exportable tables (EXPORT_DATASETS).
+
+Rows come from a single query per chunk that selects only the requested columns (joining
+owners / subscription types only when one of their columns is requested) and are written
+chunk by chunk, so exporting tens of thousands of rows does not hold them all in memory.
+Supported formats are xlsx, csv (streamed) and parquet (needs pyarrow).
+"""
+import csv
+import io
+import os
+import tempfile
+from datetime import datetime
+from typing import Optional
+
+from openpyxl import Workbook
+from sqlalchemy import select, func, String
+from sqlalchemy.orm import Session
+
+from app.db.database import SessionLocal
+from app.models.models import Subscriptions, Owners, Subscription_types, Vehicles, Cancellations, Owners_history, \
+    Vehicles_history, Subscription_history, Document
+
+# Rows per query (and ids per IN (...) clause, well below SQLite's bound parameter limit)
+EXPORT_CHUNK_SIZE = 500
+
+
+
+def document_list_column(reference):
+    """Comma-separated filenames of each row's documents (reference: join condition on the documents table)"""
+    filenames = func.group_concat(Document.filename, ',', type_=String)
+    return select(filenames).where(reference).scalar_subquery().label('documents')
+
+
+# Exportable fields in column order, with the SQL expression each one is read from
+EXPORT_COLUMNS = {
+    'id': Subscriptions.id,
+    'owner_id': Subscriptions.owner_id,
+    'access_card': Subscriptions.access_card,
+    'lisence_plate1': Subscriptions.lisence_plate1,
+    'lisence_plate2': Subscriptions.lisence_plate2,
+    'lisence_plate3': Subscriptions.lisence_plate3,
+    'documents': document_list_column(Document.subscription_id == Subscriptions.id),
+    'tique_x_park': Subscriptions.tique_x_park,
+    'remote_control_number': Subscriptions.remote_control_number,
+    'observations': Subscriptions.observations,
+    'parking_spot': Subscriptions.parking_spot,
+    'registration_date': Subscriptions.registration_date,
+    'effective_date': Subscriptions.effective_date,
+    'large_family_expiration': Subscriptions.large_family_expiration,
+    'created_by': Subscriptions.created_by,
+    'modified_by': Subscriptions.modified_by,
+    'modification_time': Subscriptions.modification_time,
+    'owner_email': Owners.email,
+    'owner_phone_number': Owners.phone_number,
+    'subscription_type_name': Subscription_types.name,
+    'subscription_type_parking_code': Subscription_types.parking_code,
+}
+
+EXPORT_FORMATS = ['xlsx', 'csv', 'parquet']
+
+EXPORT_MEDIA_TYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+    'zip': 'application/zip',  # Bulk work order regeneration
+}
+
+heading_translation = {
+    'id': 'ID',
+    'owner_id': 'DNI',
+    'access_card': 'Tarjeta de Acceso',
+    'lisence_plate1': 'Matrícula 1',
+    'lisence_plate2': 'Matrícula 2',
+    'lisence_plate3': 'Matrícula 3',
+    'documents': 'Documentos',
+    'tique_x_park': 'TiqueXPark',
+    'remote_control_number': 'Número del mando',
+    'observations': 'Observaciones',
+    'parking_spot': 'Plaza de aparcamiento',
+    'registration_date': 'Fecha de Registro',
+    'effective_date': 'Fecha de Efecto',
+    'created_by': 'Creado Por',
+    'modified_by': 'Modificado Por',
+    'modification_time': 'Hora de Modificación',
+    'owner_email': 'Correo Electrónico del Propietario',
+    'owner_phone_number': 'Número de Teléfono del Propietario',
+    'subscription_type_name': 'Tipo de Suscripción',
+    'subscription_type_parking_code': 'Código',
+    'large_family_expiration': 'Vencimiento familia numerosa',
+    'dni': 'DNI',
+    'first_name': 'Nombre',
+    'last_name': 'Apellidos',
+    'email': 'Correo Electrónico',
+    'phone_number': 'Número de Teléfono',
+    'bank_account_number': 'Número de Cuenta',
+    'sage_client_number': 'Número de Cliente Sage',
+    'reduced_mobility_expiration': 'Vencimiento movilidad reducida',
+    'lisence_plate': 'Matrícula',
+    'brand': 'Marca',
+    'model': 'Modelo',
+    'vehicle_type': 'Tipo de Vehículo',
+    'subscription_type_id': 'ID Tipo de Abono',
+    'subscription_id': 'ID Abono',
+    'effective_cancellation_date': 'Fecha de Baja',
+}
+
+
+def model_columns(model) -> dict:
+    return {column.name: column for column in model.__table__.columns}
+
+
+# Exportable tables: model, unique key the rows are ordered / chunked by, fields, the joins
+# needed by fields that live in other tables and the documents reference of the documents field
+EXPORT_DATASETS = {
+    'subscriptions': {
+        'model': Subscriptions,
+        'key': Subscriptions.id,
+        'columns': EXPORT_COLUMNS,
+        'joins': [
+            (Owners, Owners.dni == Subscriptions.owner_id),
+            (Subscription_types, Subscription_types.id == Subscriptions.subscription_type_id),
+        ],
+        'document_reference': Document.subscription_id,
+        'title': 'Abonos',
+    },
+    'owners': {'model': Owners, 'key': Owners.dni,
+               'columns': {**model_columns(Owners),
+                           'documents': document_list_column(Document.owner_dni == Owners.dni)},
+               'joins': [], 'document_reference': Document.owner_dni, 'title': 'Propietarios'},
+    'vehicles': {'model': Vehicles, 'key': Vehicles.lisence_plate,
+                 'columns': {**model_columns(Vehicles),
+                             'documents': document_list_column(Document.vehicle_plate == Vehicles.lisence_plate)},
+                 'joins': [], 'document_reference': Document.vehicle_plate, 'title': 'Vehiculos'},
+    'cancellations': {'model': Cancellations, 'key': Cancellations.id,
+                      'columns': {**model_columns(Cancellations),
+                                  'documents': document_list_column(Document.cancellation_id == Cancellations.id)},
+                      'joins': [], 'document_reference': Document.cancellation_id, 'title': 'Bajas'},
+    'owner_histories': {'model': Owners_history, 'key': Owners_history.history_id,
+                        'columns': model_columns(Owners_history), 'joins': [], 'title': 'Historial_propietarios'},
+    'vehicle_histories': {'model': Vehicles_history, 'key': Vehicles_history.history_id,
+                          'columns': model_columns(Vehicles_history), 'joins': [], 'title': 'Historial_vehiculos'},
+    'subscription_histories': {'model': Subscription_history, 'key': Subscription_history.history_id,
+                               'columns': model_columns(Subscription_history), 'joins': [],
+                               'title': 'Historial_abonos'},
+}
+
+
+def get_export_dataset(dataset_name: str) -> dict:
+    if dataset_name not in EXPORT_DATASETS:
+        raise ValueError(f"Unknown export dataset: {dataset_name}")
+    return EXPORT_DATASETS[dataset_name]
+
+
+def parse_export_ids(ids, dataset_name: str = 'subscriptions') -> list:
+    """
+    Parse a comma-separated string (or a list) of keys of the dataset, converted to the
+    key column's type. Raises ValueError for keys of the wrong type.
+    """
+    key_type = get_export_dataset(dataset_name)['key'].type.python_type
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    return sorted({key_type(str(id_str).strip()) for id_str in ids if str(id_str).strip()})
+
+
+def select_export_fields(fields, dataset_name: str = 'subscriptions') -> list[str]:
+    """Requested fields (comma-separated string or list) in export column order; unknown fields are ignored"""
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    requested = {field.strip() for field in fields}
+    return [field for field in get_export_dataset(dataset_name)['columns'] if field in requested]
+
+
+def build_export_query(db: Session, dataset_name: str, field_list: list[str]):
+    """Select the dataset key plus the requested columns, joining other tables only when needed"""
+    dataset = get_export_dataset(dataset_name)
+    columns = [dataset['columns'][field] for field in field_list]
+    tables = {column.table for column in columns}
+
+    query = db.query(dataset['key'], *columns).select_from(dataset['model'])
+    for model, on_clause in dataset['joins']:
+        if model.__table__ in tables:
+            query = query.outerjoin(model, on_clause)
+    return query
+
+
+def iter_export_chunks(db: Session, dataset_name: str, id_list: Optional[list], field_list: list[str]):
+    """
+    Yield lists of row tuples (values of field_list) ordered by the dataset key, one list per
+    chunk. With an id list the chunks are slices of it; with None the whole table is read by
+    keyset pagination on the key.
+    """
+    if not field_list:
+        return
+    key = get_export_dataset(dataset_name)['key']
+
+    if id_list is not None:
+        for start in range(0, len(id_list), EXPORT_CHUNK_SIZE):
+            chunk = id_list[start:start + EXPORT_CHUNK_SIZE]
+            rows = build_export_query(db, dataset_name, field_list).filter(key.in_(chunk)).order_by(key).all()
+            if rows:
+                yield [tuple(row)[1:] for row in rows]
+        return
+
+    last_key = None
+    while True:
+        query = build_export_query(db, dataset_name, field_list)
+        if last_key is not None:
+            query = query.filter(key > last_key)
+        rows = query.order_by(key).limit(EXPORT_CHUNK_SIZE).all()
+        if not rows:
+            return
+        last_key = rows[-1][0]
+        yield [tuple(row)[1:] for row in rows]
+
+
+def export_headings(field_list: list[str]) -> list[str]:
+    return [heading_translation.get(field, field) for field in field_list]
+
+
+def new_export_path(export_format: str) -> str:
+    fd, path = tempfile.mkstemp(suffix=f'.{export_format}')
+    os.close(fd)
+    return path
+
+
+def write_xlsx_export(db: Session, dataset_name: str, id_list: Optional[list], field_list: list[str],
+                      path: str) -> int:
+    """
+    Write the export to path with a write-only workbook (rows are flushed to disk as they
+    are appended). Returns the number of rows written.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(get_export_dataset(dataset_name)['title'])
+    sheet.append(export_headings(field_list))
+    row_count = 0
+    for rows in iter_export_chunks(db, dataset_name, id_list, field_list):
+        for row in rows:
+            sheet.append(row)
+        row_count += len(rows)
+    workbook.save(path)
+    return row_count
+
+
+def iter_csv_chunks(db: Session, dataset_name: str, id_list: Optional[list], field_list: list[str]):
+    """Yield the export as CSV text, one chunk of rows at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export_headings(field_list))
+    for rows in iter_export_chunks(db, dataset_name, id_list, field_list):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_csv_export(dataset_name: str, id_list: Optional[list], field_list: list[str]):
+    """
+    Streaming variant of iter_csv_chunks. Opens its own session because the response
+    keeps streaming after the endpoint has returned.
+    """
+    db = SessionLocal()
+    try:
+        yield from iter_csv_chunks(db, dataset_name, id_list, field_list)
+    finally:
+        db.close()
+
+
+def write_csv_export(db: Session, dataset_name: str, id_list: Optional[list], field_list: list[str],
+                     path: str) -> int:
+    row_count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(export_headings(field_list))
+        for rows in iter_export_chunks(db, dataset_name, id_list, field_list):
+            writer.writerows(rows)
+            row_count += len(rows)
+    return row_count
+
+
+def parquet_type(column):
+    import pyarrow as pa
+
+    python_type = column.type.python_type
+    if python_type is int:
+        return pa.int64()
+    if python_type is datetime:
+        return pa.timestamp('us')
+    if python_type is bool:
+        return pa.bool_()
+    return pa.string()
+
+
+def write_parquet_export(db: Session, dataset_name: str, id_list: Optional[list], field_list: list[str],
+                         path: str) -> int:
+    """Write the export to path as snappy-compressed parquet, one row group per chunk"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires the pyarrow package")
+
+    columns = get_export_dataset(dataset_name)['columns']
+    schema = pa.schema([
+        (heading, parquet_type(columns[field]))
+        for field, heading in zip(field_list, export_headings(field_list))
+    ])
+
+    row_count = 0
+    with pq.ParquetWriter(path, schema, compression='snappy') as writer:
+        for rows in iter_export_chunks(db, dataset_name, id_list, field_list):
+            values_by_column = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(values_by_column, schema)],
+                schema=schema,
+            ))
+            row_count += len(rows)
+    return row_count
+
+
+EXPORT_WRITERS = {
+    'xlsx': write_xlsx_export,
+    'csv': write_csv_export,
+    'parquet': write_parquet_export,
+}
+
+
+def write_export_file(db: Session, dataset_name: str, export_format: str, id_list: Optional[list],
+                      field_list: list[str], path: str) -> int:
+    """Write an export in any supported format to path; removes the partial file on failure"""
+    try:
+        return EXPORT_WRITERS[export_format](db, dataset_name, id_list, field_list, path)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def iter_file_chunks(path: str, chunk_size: int = 64 * 1024):
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
@@ -0,0 +1,186 @@
+"""
+Background export jobs.
+
+Submitting a job returns immediately; a small thread pool writes the file into EXPORT_DIR
+and clients poll the job until it is done, then download the file. Each job stores a cache
+key built from the request and a fingerprint of the tables it reads, so an identical request
+against unchanged data is answered with the file of the previous job instead of a new export.
+"""
+import hashlib
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import PosixPath
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.db.database import SessionLocal
+from app.models.models import ExportJob, Document
+from app.schemas.export_job import ExportJobCreate
+from app.utils.export_helper import EXPORT_FORMATS, get_export_dataset, select_export_fields, parse_export_ids, \
+    write_export_file
+
+base_path = os.getcwd()
+EXPORT_DIR = PosixPath(base_path) / "export_files"
+EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+EXPORT_JOB_TTL_HOURS = int(os.getenv("EXPORT_JOB_TTL_HOURS", "24"))
+
+executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export-job")
+
+
+def table_fingerprint(db: Session, model) -> list:
+    """
+    Cheap summary that changes when rows are added, removed or modified: row count, max key
+    and latest modification time. Tables without a modification time are small lookup tables
+    (subscription types), so their rows are hashed instead.
+    """
+    table = model.__table__
+    key = list(table.primary_key.columns)[0]
+    if 'modification_time' in table.c:
+        return list(db.query(func.count(), func.max(key), func.max(table.c.modification_time)).select_from(table).one())
+
+    digest = hashlib.sha256()
+    for row in db.query(table).order_by(key).yield_per(1000):
+        digest.update(repr(tuple(row)).encode())
+    return [digest.hexdigest()]
+
+
+def documents_fingerprint(db: Session, reference) -> list:
+    """
+    Row count and max id of the documents rows of one record type. Their filenames, the only
+    thing exported, change by inserting or deleting rows, which the records' modification
+    time does not follow (work orders attached later, rows removed by the document sweep).
+    """
+    return list(db.query(func.count(Document.id), func.max(Document.id)).filter(reference.isnot(None)).one())
+
+
+def export_cache_key(db: Session, dataset_name: str, export_format: str, field_list: list, id_list) -> str:
+    dataset = get_export_dataset(dataset_name)
+    tables = {dataset['columns'][field].table for field in field_list}
+    models = [dataset['model']] + [model for model, _ in dataset['joins'] if model.__table__ in tables]
+
+    payload = {
+        'dataset': dataset_name,
+        'export_format': export_format,
+        'fields': field_list,
+        'ids': id_list,
+        'data': [table_fingerprint(db, model) for model in models],
+    }
+    if 'documents' in field_list and 'document_reference' in dataset:
+        payload['documents'] = documents_fingerprint(db, dataset['document_reference'])
+    return hashlib.sha256(json.dumps(payload, default=str, sort_keys=True).encode()).hexdigest()
+
+
+def export_file_exists(job: ExportJob) -> bool:
+    return bool(job.file_path) and os.path.exists(job.file_path)
+
+
+def submit_export_job(db: Session, job_request: ExportJobCreate) -> tuple[ExportJob, bool]:
+    """
+    Queue an export, or reuse an earlier job for the same request and data.
+    Raises ValueError for an unknown dataset / format or malformed ids.
+
+    Returns:
+        tuple: (job, cached) where cached is True when a finished file is being reused
+    """
+    dataset = get_export_dataset(job_request.dataset)
+    if job_request.export_format not in EXPORT_FORMATS:
+        raise ValueError("Export format must be one of: " + ", ".join(EXPORT_FORMATS))
+
+    if job_request.fields:
+        field_list = select_export_fields(job_request.fields, job_request.dataset)
+    else:
+        field_list = list(dataset['columns'])
+    if not field_list:
+        raise ValueError("None of the requested fields can be exported")
+    id_list = parse_export_ids(job_request.ids, job_request.dataset) if job_request.ids is not None else None
+
+    expire_export_jobs(db)
+    cache_key = export_cache_key(db, job_request.dataset, job_request.export_format, field_list, id_list)
+
+    existing_job = db.query(ExportJob).filter(
+        ExportJob.cache_key == cache_key,
+        ExportJob.status.in_(['pending', 'running', 'done'])
+    ).order_by(ExportJob.created_at.desc()).first()
+    if existing_job:
+        if existing_job.status != 'done':
+            # The same export is already being produced
+            return existing_job, False
+        if export_file_exists(existing_job):
+            return existing_job, True
+        existing_job.status = 'expired'
+
+    job = ExportJob(
+        id=uuid.uuid4().hex,
+        dataset=job_request.dataset,
+        export_format=job_request.export_format,
+        parameters=json.dumps({'fields': field_list, 'ids': id_list}),
+        cache_key=cache_key,
+        status='pending',
+        created_by=job_request.created_by,
+        created_at=datetime.now(),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+
+    executor.submit(run_export_job, job.id)
+    return job, False
+
+
+def run_export_job(job_id: str):
+    """Worker: write the file of a pending job and record the outcome"""
+    with SessionLocal() as db:
+        job = db.query(ExportJob).filter(ExportJob.id == job_id).first()
+        if not job or job.status != 'pending':
+            return
+        job.status = 'running'
+        db.commit()
+
+        parameters = json.loads(job.parameters)
+        path = EXPORT_DIR / f"{job.id}.{job.export_format}"
+        try:
+            row_count = write_export_file(db, job.dataset, job.export_format, parameters['ids'],
+                                          parameters['fields'], str(path))
+        except Exception as e:
+            db.rollback()
+            print(f"[{datetime.now()}] Export job {job_id} failed: {e}")
+            job.status = 'failed'
+            job.error = str(e)
+            job.finished_at = datetime.now()
+            db.commit()
+            return
+
+        job.status = 'done'
+        job.file_path = str(path)
+        job.row_count = row_count
+        job.finished_at = datetime.now()
+        db.commit()
+        print(f"[{datetime.now()}] Export job {job_id} finished: {row_count} {job.dataset} rows")
+
+
+def expire_export_jobs(db: Session):
+    """Delete the files of jobs finished more than EXPORT_JOB_TTL_HOURS ago"""
+    cutoff = datetime.now() - timedelta(hours=EXPORT_JOB_TTL_HOURS)
+    expired_jobs = db.query(ExportJob).filter(ExportJob.status == 'done', ExportJob.finished_at < cutoff).all()
+    for job in expired_jobs:
+        if export_file_exists(job):
+            os.remove(job.file_path)
+        job.status = 'expired'
+    if expired_jobs:
+        db.commit()
+
+
+def fail_interrupted_export_jobs(db: Session):
+    """Jobs that were pending or running when the server stopped will never finish; mark them failed"""
+    interrupted = db.query(ExportJob).filter(ExportJob.status.in_(['pending', 'running'])).update(
+        {ExportJob.status: 'failed', ExportJob.error: 'Interrupted by a server restart'},
+        synchronize_session=False
+    )
+    db.commit()
+    return interrupted
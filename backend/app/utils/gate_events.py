@@ -0,0 +1,175 @@
+"""
+Ingestion of the gate entry/exit events into the append-only gate_events table.
+
+The gates post their events in batches. A batch is only validated and appended to an
+in-memory buffer; one writer thread inserts what the buffer holds into gate_events, up to
+GATE_EVENT_BATCH_SIZE rows in a single transaction (one executemany, one commit and so one
+sync of the SQLite file for thousands of rows, instead of one per event). The writer runs
+when a full batch is waiting or GATE_EVENT_FLUSH_SECONDS after the oldest waiting event.
+
+Rows leave the buffer only once they are committed, so a failed write is retried and the
+events being written still count against GATE_EVENT_BUFFER_SIZE. When the buffer is full the
+whole batch is refused with 429 and Retry-After, and the gate sends it again later. Events
+accepted but not yet written are lost if the process is killed; on shutdown the writer
+empties the buffer first (stop_gate_event_writer). Accepted events update the presence
+state (utils/presence) right away, without waiting for the writer.
+
+Benchmark the writer:
+    python -m app.utils.gate_events --events 100000
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import insert
+
+from app.models.models import GateEvent
+from app.utils.presence import apply_gate_events, ensure_presence_loaded
+
+GATE_EVENT_BUFFER_SIZE = int(os.getenv("GATE_EVENT_BUFFER_SIZE", "50000"))
+GATE_EVENT_BATCH_SIZE = int(os.getenv("GATE_EVENT_BATCH_SIZE", "5000"))
+GATE_EVENT_FLUSH_SECONDS = float(os.getenv("GATE_EVENT_FLUSH_SECONDS", "0.5"))
+GATE_EVENT_RETRY_SECONDS = 1
+
+DIRECTIONS = ('entry', 'exit')
+
+# Rows waiting for the writer, oldest first. Requests append at the end, only the writer
+# removes from the front (after the rows are committed).
+_buffer = []
+_condition = threading.Condition()
+_writer = None
+_stopping = False
+
+
+def enqueue_gate_events(rows: list):
+    """Buffer the rows for the writer, all or none: 429 if they do not fit"""
+    ensure_presence_loaded()
+    with _condition:
+        if len(_buffer) + len(rows) > GATE_EVENT_BUFFER_SIZE:
+            raise HTTPException(
+                status_code=429,
+                detail="Demasiados eventos pendientes de guardar, inténtelo de nuevo en unos segundos",
+                headers={"Retry-After": str(GATE_EVENT_RETRY_SECONDS)},
+            )
+        was_empty = not _buffer
+        _buffer.extend(rows)
+        # Under the buffer lock, so presence sees the events in the order they get their ids
+        apply_gate_events(rows)
+        # The first waiting events start the flush interval, a full batch is written right away
+        if was_empty or len(_buffer) >= GATE_EVENT_BATCH_SIZE:
+            _condition.notify()
+    start_gate_event_writer()
+
+
+def pending_gate_events() -> int:
+    with _condition:
+        return len(_buffer)
+
+
+def write_gate_events(rows: list):
+    """Insert rows into gate_events in one transaction"""
+    from app.db.database import engine
+
+    with engine.begin() as connection:
+        connection.execute(insert(GateEvent.__table__), rows)
+
+
+def next_batch() -> list:
+    """Wait for a full batch, the flush interval or shutdown, and return the rows to write"""
+    with _condition:
+        deadline = None
+        while not _stopping and len(_buffer) < GATE_EVENT_BATCH_SIZE:
+            if _buffer and deadline is None:
+                deadline = time.monotonic() + GATE_EVENT_FLUSH_SECONDS
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            _condition.wait(timeout)
+        return _buffer[:GATE_EVENT_BATCH_SIZE]
+
+
+def run_gate_event_writer():
+    while True:
+        batch = next_batch()
+        if not batch:
+            if _stopping:
+                return
+            continue
+        try:
+            write_gate_events(batch)
+        except Exception as e:
+            # The rows stay buffered and are written with the next try
+            print(f"Error guardando {len(batch)} eventos de acceso: {str(e)}")
+            if _stopping:
+                return
+            time.sleep(GATE_EVENT_RETRY_SECONDS)
+            continue
+        with _condition:
+            del _buffer[:len(batch)]
+
+
+def start_gate_event_writer():
+    """Start the writer thread if it is not running (on the first events)"""
+    global _writer
+    with _condition:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=run_gate_event_writer, name="gate-event-writer", daemon=True)
+            _writer.start()
+
+
+def stop_gate_event_writer(timeout: float = 30):
+    """Write what is still buffered and stop the writer (called on shutdown)"""
+    global _stopping
+    with _condition:
+        _stopping = True
+        _condition.notify()
+        writer = _writer
+    if writer is not None:
+        writer.join(timeout)
+    if _buffer:
+        print(f"{len(_buffer)} eventos de acceso sin guardar al cerrar")
+
+
+if __name__ == '__main__':
+    from sqlalchemy import delete
+
+    from app.db.database import SessionLocal, engine
+    from app.models.models import Base, ParkingLot
+
+    parser = argparse.ArgumentParser(description="Benchmark gate event ingestion")
+    parser.add_argument('--events', type=int, default=100000, help="events to ingest")
+    parser.add_argument('--request-size', type=int, default=500, help="events per enqueue, like one POST")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine, tables=[GateEvent.__table__])
+    with SessionLocal() as session:
+        parking_lot_id = session.query(ParkingLot.id).limit(1).scalar()
+    if parking_lot_id is None:
+        raise SystemExit("Create a parking lot first")
+
+    now = datetime.now()
+    rows = [dict(parking_lot_id=parking_lot_id, gate='bench', direction=DIRECTIONS[i % 2],
+                 credential_kind='plate', credential=f"{i % 10000:04d}BEN", subscription_id=None,
+                 vehicle_class='car', occurred_at=now, received_at=now) for i in range(args.events)]
+
+    start = time.perf_counter()
+    refused = 0
+    for offset in range(0, len(rows), args.request_size):
+        while True:
+            try:
+                enqueue_gate_events(rows[offset:offset + args.request_size])
+                break
+            except HTTPException:
+                refused += 1
+                time.sleep(0.01)
+    stop_gate_event_writer()
+    elapsed = time.perf_counter() - start
+    print(f"{args.events} events written in {elapsed:.2f}s ({args.events / elapsed:,.0f} events/s), "
+          f"{refused} requests refused while the buffer was full")
+
+    # Not real passes
+    with engine.begin() as connection:
+        connection.execute(delete(GateEvent).where(GateEvent.gate == 'bench'))
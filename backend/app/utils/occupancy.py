@@ -0,0 +1,224 @@
+"""
+Helpers for the incrementally maintained parking lot occupancy counters.
+
+The subscription, cancellation and delete endpoints call `apply_occupancy_change` inside
+their own transaction, so `/parking-lot-stats` only has to read one counter row per lot.
+
+Run `python -m app.utils.occupancy verify` to report drift between the counters and the
+subscription/cancellation tables, or `python -m app.utils.occupancy rebuild` to fix it.
+"""
+import argparse
+import sys
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models.models import ParkingLot, ParkingLotOccupancy, Subscription_types, Subscriptions, Cancellations
+
+VEHICLE_CLASSES = ['car', 'motorcycle']
+
+COUNTER_FIELDS = [
+    'occupied_car_spaces',
+    'occupied_motorcycle_spaces',
+    'cancelled_car_spaces',
+    'cancelled_motorcycle_spaces',
+    'cancellation_count',
+]
+
+
+def classify_subscription_type_name(subscription_type_name: str) -> tuple[str, bool]:
+    """
+    Derive (vehicle_class, consumes_space) from a subscription type name following the
+    "24H" / "24H MOTOS" naming convention. Used to backfill types created before the
+    classification columns existed and when a new type is created without them.
+    """
+    name = subscription_type_name.upper()
+    if "MOTOS" in name:
+        return 'motorcycle', "24H MOTOS" in name
+    return 'car', "24H" in name
+
+
+def find_parking_lot_for_subscription_type_name(parking_lots, subscription_type_name: str) -> Optional[ParkingLot]:
+    """The parking lot whose name prefixes the type name (longest match wins)"""
+    matches = [lot for lot in parking_lots if subscription_type_name.startswith(lot.name)]
+    return max(matches, key=lambda lot: len(lot.name)) if matches else None
+
+
+def classify_subscription_types(db: Session):
+    """
+    Fill parking_lot_id / vehicle_class of subscription types that do not have them yet,
+    deriving them from the type name. Returns the number of values set; does not commit.
+    """
+    subscription_types = db.query(Subscription_types).filter(
+        (Subscription_types.parking_lot_id.is_(None)) | (Subscription_types.vehicle_class.is_(None))
+    ).all()
+    if not subscription_types:
+        return 0
+
+    parking_lots = db.query(ParkingLot).all()
+    classified = 0
+    for subscription_type in subscription_types:
+        if subscription_type.vehicle_class is None:
+            vehicle_class, consumes_space = classify_subscription_type_name(subscription_type.name)
+            subscription_type.vehicle_class = vehicle_class
+            subscription_type.consumes_space = consumes_space
+            classified += 1
+        if subscription_type.parking_lot_id is None:
+            parking_lot = find_parking_lot_for_subscription_type_name(parking_lots, subscription_type.name)
+            if parking_lot:
+                subscription_type.parking_lot_id = parking_lot.id
+                classified += 1
+    return classified
+
+
+def get_space_class(subscription_type: Subscription_types) -> Optional[str]:
+    """Return 'car' or 'motorcycle' for subscription types that take a space, None otherwise"""
+    return subscription_type.vehicle_class if subscription_type.consumes_space else None
+
+
+def compute_lot_occupancy(db: Session, parking_lot: ParkingLot) -> dict:
+    """Recompute the counters of a parking lot from the subscription and cancellation tables"""
+    counters = {field: 0 for field in COUNTER_FIELDS}
+
+    def count_by_space_class(model):
+        return db.query(Subscription_types.vehicle_class, Subscription_types.consumes_space, func.count()).join(
+            model, model.subscription_type_id == Subscription_types.id
+        ).filter(
+            Subscription_types.parking_lot_id == parking_lot.id
+        ).group_by(Subscription_types.vehicle_class, Subscription_types.consumes_space).all()
+
+    for vehicle_class, consumes_space, count in count_by_space_class(Subscriptions):
+        if consumes_space and vehicle_class:
+            counters[f'occupied_{vehicle_class}_spaces'] += count
+
+    for vehicle_class, consumes_space, count in count_by_space_class(Cancellations):
+        counters['cancellation_count'] += count
+        if consumes_space and vehicle_class:
+            counters[f'cancelled_{vehicle_class}_spaces'] += count
+
+    return counters
+
+
+def rebuild_lot_occupancy(db: Session, parking_lot: ParkingLot) -> ParkingLotOccupancy:
+    """Overwrite the counters of a parking lot with freshly computed values (no commit)"""
+    db.flush()
+    counters = compute_lot_occupancy(db, parking_lot)
+
+    occupancy = db.query(ParkingLotOccupancy).filter(
+        ParkingLotOccupancy.parking_lot_id == parking_lot.id
+    ).first()
+    if not occupancy:
+        occupancy = ParkingLotOccupancy(parking_lot_id=parking_lot.id)
+        db.add(occupancy)
+
+    for field, value in counters.items():
+        setattr(occupancy, field, value)
+    return occupancy
+
+
+def rebuild_occupancy_for_parking_lot_ids(db: Session, parking_lot_ids):
+    """Rebuild the given lots, e.g. after a subscription type was reclassified or deleted"""
+    ids = {parking_lot_id for parking_lot_id in parking_lot_ids if parking_lot_id is not None}
+    if not ids:
+        return
+    for parking_lot in db.query(ParkingLot).filter(ParkingLot.id.in_(ids)).all():
+        rebuild_lot_occupancy(db, parking_lot)
+
+
+def apply_occupancy_change(db: Session, subscription_type_id: int, subscriptions: int = 0, cancellations: int = 0):
+    """
+    Adjust the counters of the lot a subscription type belongs to.
+    Must be called in the same transaction as the change it accounts for; the caller commits.
+
+    Args:
+        db: Database session
+        subscription_type_id: Subscription type of the added/removed rows
+        subscriptions: Change in the number of active subscriptions (e.g. 1 or -1)
+        cancellations: Change in the number of pending cancellations (e.g. 1 or -1)
+    """
+    if not subscriptions and not cancellations:
+        return
+
+    subscription_type = db.query(Subscription_types).filter(Subscription_types.id == subscription_type_id).first()
+    if not subscription_type or subscription_type.parking_lot_id is None:
+        return
+
+    space_class = get_space_class(subscription_type)
+    changes = {}
+    if cancellations:
+        changes[ParkingLotOccupancy.cancellation_count] = ParkingLotOccupancy.cancellation_count + cancellations
+    if space_class and subscriptions:
+        column = getattr(ParkingLotOccupancy, f'occupied_{space_class}_spaces')
+        changes[column] = column + subscriptions
+    if space_class and cancellations:
+        column = getattr(ParkingLotOccupancy, f'cancelled_{space_class}_spaces')
+        changes[column] = column + cancellations
+    if not changes:
+        return
+
+    # Relative UPDATE so concurrent requests cannot overwrite each other's changes
+    updated = db.query(ParkingLotOccupancy).filter(
+        ParkingLotOccupancy.parking_lot_id == subscription_type.parking_lot_id
+    ).update(changes, synchronize_session=False)
+    if not updated:
+        print(f"No occupancy counters for parking lot {subscription_type.parking_lot_id}, run the rebuild command")
+
+
+def verify_occupancy(db: Session, fix: bool = False) -> list:
+    """
+    Compare the stored counters of every parking lot against a full recount.
+    Returns a list of {parking_lot, field, stored, actual} entries for every mismatch.
+    When fix is True the counters are overwritten with the recomputed values and committed.
+    """
+    drift = []
+    for parking_lot in db.query(ParkingLot).order_by(ParkingLot.id).all():
+        counters = compute_lot_occupancy(db, parking_lot)
+        occupancy = db.query(ParkingLotOccupancy).filter(
+            ParkingLotOccupancy.parking_lot_id == parking_lot.id
+        ).first()
+
+        for field, actual in counters.items():
+            stored = getattr(occupancy, field) if occupancy else None
+            if stored != actual:
+                drift.append({
+                    'parking_lot': parking_lot.name,
+                    'field': field,
+                    'stored': stored,
+                    'actual': actual,
+                })
+
+        if fix:
+            rebuild_lot_occupancy(db, parking_lot)
+
+    if fix:
+        db.commit()
+    return drift
+
+
+def initialize_occupancy(db: Session):
+    """Create counters for parking lots that do not have them yet (e.g. on first startup)"""
+    existing_ids = {lot_id for (lot_id,) in db.query(ParkingLotOccupancy.parking_lot_id).all()}
+    for parking_lot in db.query(ParkingLot).all():
+        if parking_lot.id not in existing_ids:
+            rebuild_lot_occupancy(db, parking_lot)
+    db.commit()
+
+
+if __name__ == '__main__':
+    from app.db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Verify or rebuild the parking lot occupancy counters")
+    parser.add_argument('command', choices=['verify', 'rebuild'])
+    args = parser.parse_args()
+
+    with SessionLocal() as session:
+        results = verify_occupancy(session, fix=args.command == 'rebuild')
+
+    for entry in results:
+        print(f"{entry['parking_lot']}: {entry['field']} stored={entry['stored']} actual={entry['actual']}")
+    if args.command == 'rebuild':
+        print(f"Occupancy counters rebuilt ({len(results)} drifted values corrected)")
+    else:
+        print("No drift found" if not results else f"{len(results)} drifted values found")
+        sys.exit(1 if results else 0)
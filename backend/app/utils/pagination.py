@@ -0,0 +1,76 @@
+"""
+Keyset (cursor) pagination and shared list filters for the list endpoints.
+
+Pages are ordered by a unique, stable key (the primary key) and the cursor is the
+key of the last row of the previous page, so fetching page N costs the same as page 1.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException, Query
+
+from app.queries.plate import plate_filter
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+class PageParams:
+    """Query parameters shared by the paginated list endpoints"""
+
+    def __init__(
+            self,
+            cursor: Optional[str] = Query(None, description="Cursor returned as next_cursor by the previous page"),
+            limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+            unpaginated: bool = Query(False, alias="all", description="Return every row as a plain list (legacy)"),
+    ):
+        self.cursor = cursor
+        self.limit = limit
+        self.unpaginated = unpaginated
+
+
+def encode_cursor(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))[0]
+    except (ValueError, TypeError, IndexError):
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+
+
+def paginate_query(query, key_column, cursor: Optional[str], limit: int):
+    """
+    Apply keyset pagination to a query.
+
+    Returns:
+        tuple: (rows of this page, next_cursor or None on the last page)
+    """
+    if cursor:
+        query = query.filter(key_column > decode_cursor(cursor))
+
+    # Fetch one extra row to know whether there is a next page
+    rows = query.order_by(key_column).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(getattr(rows[-1], key_column.key))
+
+
+def filter_by_plate(query, model, plate: Optional[str]):
+    """Rows where any of the three license plate columns matches (through subscription_plates)"""
+    if not plate:
+        return query
+    return query.filter(plate_filter(model, plate))
+
+
+def filter_by_date_range(query, column, date_from: Optional[datetime], date_to: Optional[datetime]):
+    if date_from:
+        query = query.filter(column >= date_from)
+    if date_to:
+        query = query.filter(column <= date_to)
+    return query
@@ -0,0 +1,295 @@
+"""
+Work order PDF rendering in a process pool.
+
+WeasyPrint layout is CPU bound and takes hundreds of milliseconds per PDF, so it must not run
+on the event loop. The endpoints build the template data (a plain dict) and hand it to a pool
+of PDF_WORKERS processes. At most PDF_QUEUE_LIMIT renders may be queued or running at once;
+beyond that a reprint fails fast with 503 instead of piling up behind the pool, and the work
+order of a new or edited record is left to a background task (see utils/work_order_queue).
+
+Each worker compiles the work order templates and the stylesheet once, when it starts, and
+keeps a single WeasyPrint font configuration, so a render only pays for the layout itself.
+Jinja recompiles a template only when its file changes on disk.
+warm_up_pdf_workers runs at startup so the first work order does not pay for font discovery.
+
+Rendered PDFs are kept in WORK_ORDER_CACHE_DIR under a hash of the template (name and source)
+and data and hard linked into place, so rendering the same input again (a retried deferred work
+order, a reprint of a file that was removed) reuses the file instead of running WeasyPrint.
+
+Benchmark (per-PDF latency, rebuilding templates / CSS per call vs the cached worker state):
+    python -m app.utils.pdf_renderer --runs 20
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from fastapi import HTTPException
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+PDF_QUEUE_LIMIT = int(os.getenv("PDF_QUEUE_LIMIT", "16"))
+PDF_WARM_UP = os.getenv("PDF_WARM_UP", "true").lower() in ("1", "true", "yes")
+
+WORK_ORDER_CACHE_DIR = Path(os.getcwd()) / "work_order_cache"
+WORK_ORDER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# Get the absolute path to the templates directory
+TEMPLATE_DIR = os.path.join(os.getcwd(), "templates")
+if not os.path.exists(TEMPLATE_DIR):
+    # Then try with app directory
+    TEMPLATE_DIR = os.path.join(os.getcwd(), "app", "templates")
+    if not os.path.exists(TEMPLATE_DIR):
+        # Finally try with backend/app
+        TEMPLATE_DIR = os.path.join(os.getcwd(), "backend", "app", "templates")
+
+# Shared by the subscription, modification and cancellation work orders
+WORK_ORDER_CSS = '''
+    @page {
+        size: letter;
+        margin: 1cm;
+    }
+    body {
+        font-family: Helvetica, Arial, sans-serif;
+    }
+    h1 {
+        text-align: center;
+    }
+    .checkbox {
+        display: inline-block;
+        width: 10px;
+        height: 10px;
+        border: 1px solid black;
+        margin-right: 5px;
+    }
+    .checked {
+        background-color: black;
+    }
+'''
+
+WORK_ORDER_TEMPLATES = [
+    'work_order_template.html',
+    'modification_work_order_template.html',
+    'cancellation_work_order_template.html',
+]
+
+# Sample data covering the variables of the three templates, used for the warm-up and the benchmark
+SAMPLE_WORK_ORDER_DATA = {
+    'order_no': '1/25',
+    'date': '01/01/2025',
+    'vehicle_type': 'COCHE',
+    'effective_date': '01/01/2025',
+    'effective_cancellation_date': '31/01/2025',
+    'name_surname': 'Nombre Apellido',
+    'phone': '600000000',
+    'email': 'correo@ejemplo.es',
+    'parking_spot': '1',
+    'card': '0001',
+    'remote': '0001',
+    'license_plate1': '0000AAA',
+    'license_plate2': '0000BBB',
+    'license_plate3': '',
+    'old_license_plate1': '0000CCC',
+    'old_license_plate2': '',
+    'new_license_plate1': '0000AAA',
+    'new_license_plate2': '0000BBB',
+    'observations': '',
+    'subscription_type_name': 'CENTRO - 24H',
+}
+
+env = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=select_autoescape(['html', 'xml']),
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+_render_slots = threading.BoundedSemaphore(PDF_QUEUE_LIMIT)
+
+# Per worker process state, filled by init_pdf_worker
+_stylesheets = None
+_font_config = None
+
+
+def init_pdf_worker():
+    """Pool initializer: compile the templates and the stylesheet once per worker process"""
+    global _stylesheets, _font_config
+    from weasyprint import CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    _font_config = FontConfiguration()
+    _stylesheets = [CSS(string=WORK_ORDER_CSS, font_config=_font_config)]
+    for template_name in WORK_ORDER_TEMPLATES:
+        # Compiled once and kept in the Jinja environment cache
+        env.get_template(template_name)
+
+
+def render_pdf(template_name: str, template_data: dict) -> bytes:
+    """Render a work order template to PDF bytes. Runs inside a pool worker process."""
+    from weasyprint import HTML
+
+    if _stylesheets is None:
+        init_pdf_worker()
+    html_content = env.get_template(template_name).render(template_data)
+    return HTML(string=html_content).write_pdf(stylesheets=_stylesheets, font_config=_font_config)
+
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, initializer=init_pdf_worker)
+        return _executor
+
+
+def warm_up_pdf_workers():
+    """
+    Start the pool and render every template once per worker, so font discovery and the
+    layout engine setup happen at startup rather than on the first work order.
+    """
+    if not PDF_WARM_UP:
+        return
+    start = time.perf_counter()
+    executor = get_pdf_executor()
+    futures = [executor.submit(render_pdf, template_name, SAMPLE_WORK_ORDER_DATA)
+               for _ in range(PDF_WORKERS) for template_name in WORK_ORDER_TEMPLATES]
+    try:
+        for future in futures:
+            future.result()
+    except Exception as e:
+        # Rendering still works, the first work orders are just slower
+        print(f"Work order PDF warm-up failed: {str(e)}")
+        return
+    print(f"Work order PDF workers warmed up in {time.perf_counter() - start:.2f}s")
+
+
+def shutdown_pdf_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+class RenderSlotsBusy(Exception):
+    """PDF_QUEUE_LIMIT renders are already queued or running"""
+
+
+def acquire_render_slot():
+    if not _render_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiadas órdenes de trabajo en proceso, inténtelo de nuevo en unos segundos",
+            headers={"Retry-After": "5"},
+        )
+
+
+def write_pdf_file(file_path: Path, pdf: bytes):
+    file_path = Path(file_path)
+    # Ensure the directory exists
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write next to the target and rename, so a crash never leaves a truncated PDF in the cache
+    temp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(pdf)
+    os.replace(temp_path, file_path)
+
+
+def work_order_input_hash(template_name: str, template_data: dict) -> str:
+    # The template source and stylesheet are part of the key, so editing a template invalidates the cache
+    source, _, _ = env.loader.get_source(env, template_name)
+    payload = json.dumps({'template': template_name, 'source': source, 'css': WORK_ORDER_CSS, 'data': template_data},
+                         default=str, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cached_pdf_path(template_name: str, template_data: dict) -> Path:
+    return WORK_ORDER_CACHE_DIR / f"{work_order_input_hash(template_name, template_data)}.pdf"
+
+
+def link_cached_pdf(cache_path: Path, file_path: Path):
+    """Put the cached PDF at file_path; a hard link costs no space, copy across file systems"""
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    if file_path.exists():
+        if os.path.samefile(cache_path, file_path):
+            return
+        file_path.unlink()
+    try:
+        os.link(cache_path, file_path)
+    except OSError:
+        shutil.copyfile(cache_path, file_path)
+
+
+def store_rendered_pdf(template_name: str, template_data: dict, pdf: bytes, file_path: Path):
+    """Save a PDF rendered outside render_work_order_pdf (bulk regeneration) in the cache and at file_path"""
+    cache_path = cached_pdf_path(template_name, template_data)
+    write_pdf_file(cache_path, pdf)
+    link_cached_pdf(cache_path, file_path)
+
+
+async def render_work_order_pdf(template_name: str, template_data: dict, file_path: Path):
+    """Render a work order in the process pool without blocking the event loop and save it to file_path"""
+    cache_path = cached_pdf_path(template_name, template_data)
+    if not cache_path.exists():
+        acquire_render_slot()
+        try:
+            loop = asyncio.get_running_loop()
+            pdf = await loop.run_in_executor(get_pdf_executor(), render_pdf, template_name, template_data)
+        finally:
+            _render_slots.release()
+        write_pdf_file(cache_path, pdf)
+    link_cached_pdf(cache_path, file_path)
+
+
+def render_work_order_pdf_sync(template_name: str, template_data: dict, file_path: Path, wait: bool = True):
+    """
+    Same as render_work_order_pdf for worker and background threads. With wait these wait for a
+    free slot instead of failing, since nobody is waiting on the response; without it
+    RenderSlotsBusy is raised when every slot is taken.
+    """
+    cache_path = cached_pdf_path(template_name, template_data)
+    if not cache_path.exists():
+        if not _render_slots.acquire(blocking=wait):
+            raise RenderSlotsBusy()
+        try:
+            pdf = get_pdf_executor().submit(render_pdf, template_name, template_data).result()
+        finally:
+            _render_slots.release()
+        write_pdf_file(cache_path, pdf)
+    link_cached_pdf(cache_path, file_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark work order PDF rendering")
+    parser.add_argument('--runs', type=int, default=20, help="renders per template")
+    args = parser.parse_args()
+
+    def render_pdf_uncached(template_name: str, template_data: dict) -> bytes:
+        # What every render did before: fetch the template and parse the stylesheet each time
+        from weasyprint import HTML, CSS
+
+        html_content = env.get_template(template_name).render(template_data)
+        return HTML(string=html_content).write_pdf(stylesheets=[CSS(string=WORK_ORDER_CSS)])
+
+    def time_render(render, template_name: str) -> float:
+        start = time.perf_counter()
+        render(template_name, SAMPLE_WORK_ORDER_DATA)
+        return (time.perf_counter() - start) * 1000
+
+    # The first render in a fresh process includes font discovery and layout engine setup
+    cold = time_render(render_pdf_uncached, WORK_ORDER_TEMPLATES[0])
+    print(f"first render in a cold process: {cold:.1f} ms")
+    init_pdf_worker()
+
+    for template_name in WORK_ORDER_TEMPLATES:
+        before = sorted(time_render(render_pdf_uncached, template_name) for _ in range(args.runs))
+        after = sorted(time_render(render_pdf, template_name) for _ in range(args.runs))
+        print(f"{template_name}: per call {before[len(before) // 2]:.1f} ms median, {before[-1]:.1f} ms max; "
+              f"cached {after[len(after) // 2]:.1f} ms median, {after[-1]:.1f} ms max")
@@ -0,0 +1,226 @@
+"""
+Who is inside each parking lot right now, from the gate entry/exit events.
+
+The state is in memory: every vehicle inside (a subscription, or the credential of a visitor)
+with its lot and vehicle class, and per lot the number of cars and motorcycles inside, so
+reading the occupancy of a lot is a dict read. It is updated by enqueue_gate_events with
+every accepted batch, in the order the rows are written (and so get their ids).
+
+The state is persisted as a snapshot: gate_presence holds one row per vehicle inside and
+gate_presence_checkpoint the last event included. Every PRESENCE_SNAPSHOT_SECONDS a background
+thread reads the snapshot, replays the events written since and stores it again, without
+touching the live state. At startup the state is the snapshot plus the events after its
+checkpoint, so a restart replays at most a few minutes of events instead of the whole log.
+
+Anti-passback: a subscription covers one vehicle inside at a time, whichever of its plates or
+cards it uses. An entry check (check_credential with direction 'entry') of a subscription that
+is already inside is denied from this state, without a query. A missed exit is cleared with an
+exit event for the subscription (e.g. posted from the gate with gate 'manual').
+
+An entry of a vehicle already inside moves it to that lot; an exit of a vehicle that is not
+inside is ignored (missed entry). Visitors count as cars: nothing at the gate tells their
+vehicle class.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from app.models.models import GateEvent, GatePresence, GatePresenceCheckpoint, Subscription_types
+from app.utils.occupancy import VEHICLE_CLASSES
+
+PRESENCE_SNAPSHOT_SECONDS = int(os.getenv("PRESENCE_SNAPSHOT_SECONDS", "60"))
+ANTI_PASSBACK = os.getenv("ANTI_PASSBACK", "true").lower() in ("1", "true", "yes")
+
+DEFAULT_VEHICLE_CLASS = 'car'
+
+EVENT_COLUMNS = [GateEvent.parking_lot_id, GateEvent.direction, GateEvent.credential_kind, GateEvent.credential,
+                 GateEvent.subscription_id, GateEvent.vehicle_class]
+
+# presence key -> (parking lot id, vehicle class). The key is the subscription id, or
+# (kind, credential) for visitors, so a subscription entering with its plate and leaving
+# with its card is one vehicle.
+_inside = {}
+# parking lot id -> {vehicle class: vehicles inside}
+_counts = {}
+_loaded = False
+_lock = threading.RLock()
+
+# subscription type id -> vehicle class
+_vehicle_classes = {}
+
+
+def presence_key(row):
+    if row['subscription_id'] is not None:
+        return row['subscription_id']
+    return row['credential_kind'], row['credential']
+
+
+def vehicle_class_for(db: Session, subscription_type_id: Optional[int]) -> str:
+    """Vehicle class of a subscription type, DEFAULT_VEHICLE_CLASS for visitors"""
+    global _vehicle_classes
+    if subscription_type_id is None:
+        return DEFAULT_VEHICLE_CLASS
+    if subscription_type_id not in _vehicle_classes:
+        # New type since the last read
+        _vehicle_classes = {row.id: row.vehicle_class for row in
+                            db.query(Subscription_types.id, Subscription_types.vehicle_class)}
+    return _vehicle_classes.get(subscription_type_id) or DEFAULT_VEHICLE_CLASS
+
+
+def apply_event(inside: dict, counts: dict, row):
+    key = presence_key(row)
+    previous = inside.pop(key, None)
+    if previous is not None:
+        lot_counts = counts[previous[0]]
+        lot_counts[previous[1]] -= 1
+    if row['direction'] == 'entry':
+        vehicle_class = row['vehicle_class'] or DEFAULT_VEHICLE_CLASS
+        inside[key] = (row['parking_lot_id'], vehicle_class)
+        lot_counts = counts.setdefault(row['parking_lot_id'], {name: 0 for name in VEHICLE_CLASSES})
+        lot_counts[vehicle_class] += 1
+
+
+def apply_gate_events(rows: list):
+    """Update the state with accepted events, in the order they are written"""
+    with _lock:
+        for row in rows:
+            apply_event(_inside, _counts, row)
+
+
+def read_snapshot(connection):
+    """(inside, counts, last event id) of the stored snapshot, an empty state and 0 if there is none"""
+    inside, counts = {}, {}
+    for row in connection.execute(select(GatePresence)).mappings():
+        apply_event(inside, counts, dict(row, direction='entry'))
+    last_event_id = connection.execute(select(GatePresenceCheckpoint.last_event_id)).scalar()
+    return inside, counts, last_event_id or 0
+
+
+def replay_events(connection, inside: dict, counts: dict, after_id: int) -> int:
+    """Apply the events after after_id in id order, returns the last event id applied"""
+    last_event_id = after_id
+    result = connection.execution_options(yield_per=10000).execute(
+        select(GateEvent.id, *EVENT_COLUMNS).where(GateEvent.id > after_id).order_by(GateEvent.id)
+    )
+    for row in result.mappings():
+        apply_event(inside, counts, row)
+        last_event_id = row['id']
+    return last_event_id
+
+
+def save_snapshot(connection, inside: dict, last_event_id: int):
+    rows = []
+    for key, (parking_lot_id, vehicle_class) in inside.items():
+        subscription_id, (kind, credential) = (None, key) if isinstance(key, tuple) else (key, (None, None))
+        rows.append(dict(subscription_id=subscription_id, credential_kind=kind, credential=credential,
+                         parking_lot_id=parking_lot_id, vehicle_class=vehicle_class))
+    connection.execute(delete(GatePresence))
+    if rows:
+        connection.execute(insert(GatePresence.__table__), rows)
+    connection.execute(delete(GatePresenceCheckpoint))
+    connection.execute(insert(GatePresenceCheckpoint.__table__),
+                       [dict(id=1, last_event_id=last_event_id, created_at=datetime.now())])
+
+
+def take_presence_snapshot(rebuild: bool = False) -> int:
+    """Bring the stored snapshot up to the last written event, returns the events replayed"""
+    from app.db.database import engine
+
+    with engine.begin() as connection:
+        inside, counts, last_event_id = ({}, {}, 0) if rebuild else read_snapshot(connection)
+        new_last_event_id = replay_events(connection, inside, counts, last_event_id)
+        if rebuild or new_last_event_id != last_event_id:
+            save_snapshot(connection, inside, new_last_event_id)
+    return new_last_event_id - last_event_id
+
+
+def load_presence(connection) -> int:
+    """Snapshot plus the events after it into a new state, swapped in"""
+    global _inside, _counts, _loaded
+    with _lock:
+        inside, counts, last_event_id = read_snapshot(connection)
+        replayed = replay_events(connection, inside, counts, last_event_id) - last_event_id
+        _inside, _counts, _loaded = inside, counts, True
+    print(f"Presence loaded: {len(inside)} vehicles inside, {replayed} events replayed after the snapshot")
+    return len(inside)
+
+
+def ensure_presence_loaded():
+    if not _loaded:
+        from app.db.database import engine
+
+        with _lock, engine.connect() as connection:
+            # Another thread may have loaded it meanwhile, and applied events since
+            if not _loaded:
+                load_presence(connection)
+
+
+def lot_presence(parking_lot_id: int) -> dict:
+    """{vehicle class: vehicles inside} of a parking lot"""
+    ensure_presence_loaded()
+    return dict(_counts.get(parking_lot_id) or {name: 0 for name in VEHICLE_CLASSES})
+
+
+def vehicles_inside(parking_lot_id: int) -> list:
+    """Subscription ids and (kind, credential) of visitors inside a parking lot, with their vehicle class"""
+    ensure_presence_loaded()
+    with _lock:
+        return [(key, vehicle_class) for key, (lot_id, vehicle_class) in _inside.items() if lot_id == parking_lot_id]
+
+
+def subscription_inside(subscription_id: int) -> Optional[int]:
+    """Parking lot the subscription is inside, None if it is not"""
+    ensure_presence_loaded()
+    entry = _inside.get(subscription_id)
+    return entry[0] if entry else None
+
+
+def initialize_presence(db: Session):
+    """Load the state and keep the snapshot current in a background thread (called at startup)"""
+    load_presence(db.connection())
+    if PRESENCE_SNAPSHOT_SECONDS <= 0:
+        return
+
+    def snapshot_periodically():
+        while True:
+            time.sleep(PRESENCE_SNAPSHOT_SECONDS)
+            try:
+                take_presence_snapshot()
+            except Exception as e:
+                print(f"Error guardando la presencia en los parkings: {str(e)}")
+
+    threading.Thread(target=snapshot_periodically, name="presence-snapshot", daemon=True).start()
+
+
+if __name__ == '__main__':
+    from app.db.database import engine
+
+    parser = argparse.ArgumentParser(description="Update, rebuild or verify the presence snapshot")
+    parser.add_argument('command', choices=['snapshot', 'rebuild', 'verify'])
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        # Snapshot plus the events after it against a replay of the whole log
+        with engine.connect() as connection:
+            inside, counts, last_event_id = read_snapshot(connection)
+            replay_events(connection, inside, counts, last_event_id)
+            full_inside, full_counts = {}, {}
+            replay_events(connection, full_inside, full_counts, 0)
+        drift = {key for key in inside.keys() | full_inside.keys() if inside.get(key) != full_inside.get(key)}
+        for key in sorted(drift, key=str):
+            print(f"{key}: snapshot={inside.get(key)} log={full_inside.get(key)}")
+        print("No drift found" if not drift else f"{len(drift)} vehicles differ, run the rebuild command")
+        sys.exit(1 if drift else 0)
+
+    start = time.perf_counter()
+    replayed = take_presence_snapshot(rebuild=args.command == 'rebuild')
+    with engine.connect() as connection:
+        vehicles = connection.execute(select(func.count()).select_from(GatePresence)).scalar()
+    print(f"Snapshot of {vehicles} vehicles inside, {replayed} events replayed in {time.perf_counter() - start:.2f}s")
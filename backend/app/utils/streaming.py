@@ -0,0 +1,68 @@
+"""
+Opt-in NDJSON streaming for the list endpoints.
+
+A client that sends `Accept: application/x-ndjson` gets every matching row as one JSON
+document per line. Rows are read from the database cursor in batches (`yield_per`) and
+written to the response as they are serialized, so memory stays flat however big the table is.
+"""
+import json
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+from app.db.database import SessionLocal
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 500
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def stream_query_rows(build_query, key_column, to_item=None, batch_size: int = STREAM_BATCH_SIZE, to_items=None):
+    """
+    Yield one NDJSON line per row of the query returned by build_query(db).
+
+    The generator opens its own session because it keeps reading after the endpoint
+    has returned (and its request-scoped session has been closed).
+    """
+    if to_items is None:
+        def to_items(_, rows):
+            return [to_item(row) for row in rows]
+    db = SessionLocal()
+    try:
+        query = build_query(db).order_by(key_column).yield_per(batch_size)
+        batch = []
+        for row in query:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield from serialize_batch(db, batch, to_items)
+                batch = []
+        yield from serialize_batch(db, batch, to_items)
+    finally:
+        db.close()
+
+
+def serialize_batch(db, rows: list, to_items):
+    for item in to_items(db, rows):
+        yield json.dumps(jsonable_encoder(item)) + "\n"
+    # Drop rows already sent so the identity map does not grow with the table
+    for row in rows:
+        db.expunge(row)
+
+
+def ndjson_response(build_query, key_column, to_item=None, to_items=None) -> StreamingResponse:
+    """
+    Args:
+        build_query: Callable taking a session and returning the filtered query
+        key_column: Unique column to order the stream by
+        to_item: Converts an ORM row to the endpoint's response item
+        to_items: Instead of to_item, converts a batch of rows with the session, for items
+            that need a lookup (one per batch rather than one per row)
+    """
+    return StreamingResponse(
+        stream_query_rows(build_query, key_column, to_item, to_items=to_items),
+        media_type=NDJSON_MEDIA_TYPE,
+    )
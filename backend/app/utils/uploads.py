@@ -0,0 +1,76 @@
+"""
+Shared handling of uploaded documents.
+
+Starlette spools each uploaded file to a temporary file while parsing the form. Instead of
+reading it whole into memory (`await document.read()`) and writing it with a blocking
+`open().write()` on the event loop, save_upload copies it to its destination in
+UPLOAD_CHUNK_SIZE chunks in a worker thread, hashing it on the way. Files over
+MAX_UPLOAD_FILE_SIZE and requests over MAX_UPLOAD_REQUEST_SIZE are rejected with 413.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import List
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+MB = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1 * MB
+MAX_UPLOAD_FILE_SIZE = int(os.getenv("MAX_UPLOAD_FILE_SIZE_MB", "50")) * MB
+MAX_UPLOAD_REQUEST_SIZE = int(os.getenv("MAX_UPLOAD_REQUEST_SIZE_MB", "200")) * MB
+
+
+def upload_too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+
+def file_too_large(filename: str) -> HTTPException:
+    return upload_too_large(f"El archivo {filename} supera el tamaño máximo de {MAX_UPLOAD_FILE_SIZE // MB} MB")
+
+
+def check_upload_sizes(documents: List[UploadFile]):
+    """Reject oversized files or requests (413) before anything is written"""
+    total_size = 0
+    for document in documents or []:
+        if document.size is None:
+            continue
+        if document.size > MAX_UPLOAD_FILE_SIZE:
+            raise file_too_large(document.filename)
+        total_size += document.size
+    if total_size > MAX_UPLOAD_REQUEST_SIZE:
+        raise upload_too_large(f"Los archivos superan el tamaño máximo de {MAX_UPLOAD_REQUEST_SIZE // MB} MB por envío")
+
+
+def write_upload(source, destination: Path, filename: str, max_size: int = MAX_UPLOAD_FILE_SIZE) -> tuple[int, str]:
+    """
+    Copy an uploaded file object to destination chunk by chunk. Blocking, runs in a worker thread.
+    The file is written under a temporary name and renamed, so a failed upload leaves nothing behind.
+
+    Returns:
+        tuple: (size in bytes, sha256 hex digest)
+    """
+    destination = Path(destination)
+    temp_path = destination.with_name(f"{destination.name}.part")
+    digest = hashlib.sha256()
+    size = 0
+    source.seek(0)
+    try:
+        with open(temp_path, "wb") as target:
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise file_too_large(filename)
+                digest.update(chunk)
+                target.write(chunk)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+    return size, digest.hexdigest()
+
+
+async def save_upload(document: UploadFile, destination) -> tuple[int, str]:
+    """Stream an uploaded document to destination off the event loop. Returns (size, sha256)."""
+    return await run_in_threadpool(write_upload, document.file, destination, document.filename)
@@ -2,10 +2,109 @@
 Helper functions for managing work order numbers
 Add this to a new file: app/utils/work_order_helper.py
 """
+import hashlib
+import json
+import os
+import threading
 from datetime import datetime
+from pathlib import Path
+from typing import Optional
+from sqlalchemy import case, event, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from app.models.models import WorkOrderCounter
+from app.models.models import WorkOrderCounter, WorkOrder
+from app.utils.pdf_renderer import work_order_input_hash, render_work_order_pdf
+
+# Numbers a process takes from the counter at once. With 1 (the default) every work order updates
+# the counter inside its own transaction: numbers are consecutive and a rolled back request gives
+# its number back. With larger blocks each process reserves WORK_ORDER_BLOCK_SIZE numbers in one
+# update and hands them out from memory; numbers stay unique but are only increasing per process,
+# and numbers of a request that fails after taking one, or left in a block when the process stops,
+# are skipped (gaps), never reused.
+WORK_ORDER_BLOCK_SIZE = int(os.getenv("WORK_ORDER_BLOCK_SIZE", "1"))
+
+# Template fields describing the subscription itself. The number, the date and the old / new plate
+# columns are left out: they differ between two work orders that print the same subscription data.
+WORK_ORDER_CONTENT_FIELDS = [
+    'vehicle_type', 'effective_date', 'effective_cancellation_date', 'name_surname', 'phone', 'email',
+    'parking_spot', 'card', 'remote', 'license_plate1', 'license_plate2', 'license_plate3', 'observations',
+    'subscription_type_name',
+]
+
+# Committed, not yet used blocks of this process: counter_type -> list of [year, next, last]
+_reserved_blocks = {}
+_reserved_blocks_lock = threading.Lock()
+
+
+def reserve_work_order_numbers(db: Session, counter_type: str, count: int, year: int) -> int:
+    """
+    Atomically add count to the counter in a single INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+    statement, restarting it from zero when the year has changed. SQLite ignores SELECT ... FOR UPDATE,
+    so reading the counter and writing it back could hand the same number to two requests.
+
+    Returns:
+        int: the last reserved number (the block is last - count + 1 .. last)
+    """
+    table = WorkOrderCounter.__table__
+    statement = sqlite_insert(table).values(counter_type=counter_type, current_number=count, year=year)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.counter_type],
+        set_={
+            'current_number': case(
+                (table.c.year == statement.excluded.year, table.c.current_number + count),
+                else_=count
+            ),
+            'year': statement.excluded.year,
+        },
+    ).returning(table.c.current_number)
+    return db.execute(statement).scalar_one()
+
+
+def take_from_block(block: list, year: int):
+    """Next number of a [year, next, last] block, None if it is used up or from another year"""
+    if not block or block[0] != year or block[1] > block[2]:
+        return None
+    number = block[1]
+    block[1] += 1
+    return number
+
+
+def take_block_number(db: Session, counter_type: str, year: int) -> int:
+    # A block reserved by this session is kept on the session until its transaction commits
+    session_blocks = db.info.setdefault('work_order_blocks', {})
+    number = take_from_block(session_blocks.get(counter_type), year)
+    if number is not None:
+        return number
+
+    with _reserved_blocks_lock:
+        for block in _reserved_blocks.get(counter_type, []):
+            number = take_from_block(block, year)
+            if number is not None:
+                return number
+        _reserved_blocks.pop(counter_type, None)
+
+    last = reserve_work_order_numbers(db, counter_type, WORK_ORDER_BLOCK_SIZE, year)
+    block = [year, last - WORK_ORDER_BLOCK_SIZE + 1, last]
+    session_blocks[counter_type] = block
+    return take_from_block(block, year)
+
+
+@event.listens_for(Session, 'after_commit')
+def share_committed_blocks(session):
+    """The rest of a block reserved by a committed transaction can be used by any request"""
+    blocks = session.info.pop('work_order_blocks', None)
+    if not blocks:
+        return
+    with _reserved_blocks_lock:
+        for counter_type, block in blocks.items():
+            if block[1] <= block[2]:
+                _reserved_blocks.setdefault(counter_type, []).append(block)
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_rolled_back_blocks(session):
+    """A rolled back reservation never happened; the counter will hand those numbers out again"""
+    session.info.pop('work_order_blocks', None)
 
 
 def get_next_work_order_number(db: Session, counter_type: str = 'subscription') -> tuple[int, str]:
@@ -22,32 +121,71 @@ def get_next_work_order_number(db: Session, counter_type: str = 'subscription')
     """
     current_year = datetime.now().year % 100  # Get last 2 digits (e.g., 25 for 2025)
 
-    # Try to get existing counter for this type and year
-    counter = db.query(WorkOrderCounter).filter(
-        WorkOrderCounter.counter_type == counter_type,
-        WorkOrderCounter.year == current_year
-    ).with_for_update().first()  # Lock row for update to prevent race conditions
-
-    if counter:
-        # Increment existing counter
-        counter.current_number += 1
-        next_number = counter.current_number
+    if WORK_ORDER_BLOCK_SIZE > 1:
+        next_number = take_block_number(db, counter_type, current_year)
     else:
-        # Create new counter for this type and year
-        next_number = 1
-        counter = WorkOrderCounter(
-            counter_type=counter_type,
-            current_number=next_number,
-            year=current_year
-        )
-        db.add(counter)
-
-    db.flush()  # Ensure the counter is updated in DB
+        next_number = reserve_work_order_numbers(db, counter_type, 1, current_year)
 
     formatted_number = f"{next_number}/{current_year}"
     return next_number, formatted_number
 
 
+def work_order_content_hash(template_data: dict) -> str:
+    content = {field: template_data.get(field) for field in WORK_ORDER_CONTENT_FIELDS}
+    return hashlib.sha256(json.dumps(content, default=str, sort_keys=True).encode()).hexdigest()
+
+
+def latest_work_order(db: Session, target_type: str, target_id: int) -> Optional[WorkOrder]:
+    return db.query(WorkOrder).filter(
+        WorkOrder.target_type == target_type,
+        WorkOrder.target_id == target_id
+    ).order_by(WorkOrder.id.desc()).first()
+
+
+def latest_work_order_ids(db: Session, target_type: str, target_ids: list) -> dict:
+    """Id of the latest work order of each subscription / cancellation that has one: {target_id: work_order_id}"""
+    rows = db.query(WorkOrder.target_id, func.max(WorkOrder.id)).filter(
+        WorkOrder.target_type == target_type,
+        WorkOrder.target_id.in_(target_ids)
+    ).group_by(WorkOrder.target_id).all()
+    return dict(rows)
+
+
+def work_order_unchanged(db: Session, target_type: str, target_id: int, template_data: dict) -> bool:
+    """True when the last work order of the subscription / cancellation already prints this data"""
+    last_work_order = latest_work_order(db, target_type, target_id)
+    return last_work_order is not None and last_work_order.content_hash == work_order_content_hash(template_data)
+
+
+def record_work_order(db: Session, target_type: str, target_id: int, template_name: str, template_data: dict,
+                      file_path: Path) -> WorkOrder:
+    """Store a numbered work order (committed together with the caller's transaction)"""
+    work_order = WorkOrder(
+        target_type=target_type,
+        target_id=target_id,
+        order_no=template_data['order_no'],
+        template_name=template_name,
+        template_data=json.dumps(template_data, default=str),
+        input_hash=work_order_input_hash(template_name, template_data),
+        content_hash=work_order_content_hash(template_data),
+        file_path=str(file_path),
+        created_at=datetime.now(),
+    )
+    db.add(work_order)
+    return work_order
+
+
+async def restore_work_order_file(work_order: WorkOrder) -> Path:
+    """
+    Path of a work order PDF for reprinting. A file that was removed is linked back from the
+    render cache; it is only rendered again when the cached copy is gone as well.
+    """
+    file_path = Path(work_order.file_path)
+    if not file_path.exists():
+        await render_work_order_pdf(work_order.template_name, json.loads(work_order.template_data), file_path)
+    return file_path
+
+
 def generate_work_order_filename(work_order_number: int, order_type: str = 'subscription') -> str:
     """
     Generate a unique filename for a work order PDF.
@@ -89,4 +227,64 @@ def initialize_counters(db: Session):
             db.add(counter)
 
     db.commit()
-    print(f"Work order counters initialized for year {current_year}")
\ No newline at end of file
+    print(f"Work order counters initialized for year {current_year}")
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import sys
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = argparse.ArgumentParser(description="Stress test work order number allocation on a scratch SQLite database")
+    parser.add_argument('--processes', type=int, default=4, help="server processes to simulate")
+    parser.add_argument('--threads', type=int, default=8, help="concurrent requests per process")
+    parser.add_argument('--requests', type=int, default=50, help="work orders per thread")
+    parser.add_argument('--block-size', type=int, default=WORK_ORDER_BLOCK_SIZE)
+    parser.add_argument('--rollback-rate', type=float, default=0.1, help="share of requests that fail and roll back")
+    args = parser.parse_args()
+    WORK_ORDER_BLOCK_SIZE = args.block_size
+
+    database_fd, database_path = tempfile.mkstemp(suffix='.db')
+    os.close(database_fd)
+    stress_engine = create_engine(f"sqlite:///{database_path}", connect_args={"timeout": 30})
+    WorkOrderCounter.__table__.create(stress_engine)
+    StressSession = sessionmaker(autocommit=False, autoflush=False, bind=stress_engine)
+
+    # Leave a counter from last year behind to check that numbering restarts
+    with StressSession() as session:
+        session.add(WorkOrderCounter(counter_type='subscription', current_number=500,
+                                     year=datetime.now().year % 100 - 1))
+        session.commit()
+
+    def run_requests(_) -> list:
+        committed = []
+        for _ in range(args.requests):
+            with StressSession() as session:
+                number, _ = get_next_work_order_number(session, 'subscription')
+                if random.random() < args.rollback_rate:
+                    session.rollback()
+                else:
+                    session.commit()
+                    committed.append(number)
+        return committed
+
+    def run_process(_) -> list:
+        stress_engine.dispose(close=False)
+        with ThreadPoolExecutor(max_workers=args.threads) as threads:
+            return [number for numbers in threads.map(run_requests, range(args.threads)) for number in numbers]
+
+    with ProcessPoolExecutor(max_workers=args.processes) as processes:
+        numbers = [number for numbers in processes.map(run_process, range(args.processes)) for number in numbers]
+    os.remove(database_path)
+
+    duplicates = len(numbers) - len(set(numbers))
+    gaps = max(numbers) - len(set(numbers)) if numbers else 0
+    print(f"block size {args.block_size}: {len(numbers)} work orders committed, numbers {min(numbers)}..{max(numbers)}, "
+          f"{duplicates} duplicates, {gaps} skipped numbers")
+    if duplicates or min(numbers) != 1 or (args.block_size == 1 and gaps):
+        # Without blocks a rolled back number is handed out again, so there must be no gaps either
+        sys.exit(1)
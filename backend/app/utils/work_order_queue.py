@@ -0,0 +1,141 @@
+"""
+Work order PDFs, rendered once the record they belong to is committed.
+
+The subscription and cancellation endpoints commit the record together with a PendingWorkOrder
+(the work order number and template data are fixed in that transaction). The PDF is rendered
+afterwards, in a worker thread with its own session, and its filename attached to the
+subscription / cancellation documents. So no request keeps the SQLite write lock while a PDF
+renders: the number is reserved, the record written and committed without awaiting anything.
+
+With WORK_ORDER_DEFERRED enabled the endpoints respond at once and render in a background
+task. Otherwise they wait for the PDF before responding, unless every render slot is taken:
+then it is left to a background task as well rather than failing a write that already
+succeeded. work_order_status ('pending', 'ready' or 'failed') is returned by the subscription
+and cancellation endpoints so the frontend can poll.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from fastapi import BackgroundTasks
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.db.database import SessionLocal
+from app.models.models import PendingWorkOrder, Subscriptions, Cancellations
+from app.queries.document import add_document
+from app.utils.pdf_renderer import RenderSlotsBusy, render_work_order_pdf_sync
+
+WORK_ORDER_DEFERRED = os.getenv("WORK_ORDER_DEFERRED", "false").lower() in ("1", "true", "yes")
+
+WORK_ORDER_TARGETS = {
+    'subscription': Subscriptions,
+    'cancellation': Cancellations,
+}
+
+
+def queue_work_order(db: Session, target_type: str, target_id: int, template_name: str, template_data: dict,
+                     file_path: Path) -> PendingWorkOrder:
+    """Record a work order to render once the caller commits (flushes, does not commit)"""
+    pending_work_order = PendingWorkOrder(
+        target_type=target_type,
+        target_id=target_id,
+        template_name=template_name,
+        template_data=json.dumps(template_data),
+        file_path=str(file_path),
+        status='pending',
+        created_at=datetime.now(),
+    )
+    db.add(pending_work_order)
+    db.flush()
+    return pending_work_order
+
+
+def attach_work_order_document(db: Session, work_order):
+    """Append the filename of a work order (pending or issued) to the documents of its subscription / cancellation"""
+    model = WORK_ORDER_TARGETS[work_order.target_type]
+    target = db.query(model).filter(model.id == work_order.target_id).first()
+    if not target:
+        # e.g. the subscription was deleted in the meantime; the PDF stays on disk
+        return
+
+    add_document(target.documents, Path(work_order.file_path).name, kind='work_order', path=work_order.file_path)
+
+
+def process_pending_work_order(pending_work_order_id: int, wait: bool = True) -> bool:
+    """
+    Render a pending work order and attach it. Runs in a worker or background thread.
+    Without wait, returns False and leaves it pending when every render slot is taken.
+    """
+    with SessionLocal() as db:
+        pending_work_order = db.query(PendingWorkOrder).filter(PendingWorkOrder.id == pending_work_order_id).first()
+        if not pending_work_order or pending_work_order.status != 'pending':
+            return True
+
+        try:
+            render_work_order_pdf_sync(pending_work_order.template_name,
+                                       json.loads(pending_work_order.template_data),
+                                       Path(pending_work_order.file_path), wait=wait)
+            attach_work_order_document(db, pending_work_order)
+            pending_work_order.status = 'ready'
+        except RenderSlotsBusy:
+            return False
+        except Exception as e:
+            db.rollback()
+            print(f"Error generando la orden de trabajo {pending_work_order.file_path}: {str(e)}")
+            pending_work_order.status = 'failed'
+            pending_work_order.error = str(e)
+
+        pending_work_order.finished_at = datetime.now()
+        db.commit()
+        return True
+
+
+async def schedule_work_order(background_tasks: BackgroundTasks, pending_work_order_id: int):
+    """
+    Render a committed pending work order: in the background with WORK_ORDER_DEFERRED, else
+    before the response (in a worker thread, the event loop keeps serving). The caller
+    refreshes the record to see the attached work order.
+    """
+    if WORK_ORDER_DEFERRED or not await run_in_threadpool(process_pending_work_order, pending_work_order_id, False):
+        background_tasks.add_task(process_pending_work_order, pending_work_order_id)
+
+
+def resume_pending_work_orders(db: Session):
+    """Render work orders left pending by a previous run (called at startup)"""
+    pending_ids = [pending_id for (pending_id,) in db.query(PendingWorkOrder.id).filter(
+        PendingWorkOrder.status == 'pending'
+    ).order_by(PendingWorkOrder.id).all()]
+    if not pending_ids:
+        return
+
+    def resume():
+        for pending_id in pending_ids:
+            process_pending_work_order(pending_id)
+
+    print(f"Resuming {len(pending_ids)} pending work orders")
+    threading.Thread(target=resume, name="work-order-resume", daemon=True).start()
+
+
+def get_work_order_status(db: Session, target_type: str, target_id: int) -> Optional[str]:
+    """Status of the latest deferred work order of a subscription / cancellation, None if there is none"""
+    pending_work_order = db.query(PendingWorkOrder.status).filter(
+        PendingWorkOrder.target_type == target_type,
+        PendingWorkOrder.target_id == target_id
+    ).order_by(PendingWorkOrder.id.desc()).first()
+    return pending_work_order.status if pending_work_order else None
+
+
+def get_work_order_statuses(db: Session, target_type: str, target_ids: list) -> dict:
+    """get_work_order_status of many subscriptions / cancellations (a list page) in one query, {target_id: status}"""
+    statuses = {}
+    for target_id, status in db.query(PendingWorkOrder.target_id, PendingWorkOrder.status).filter(
+            PendingWorkOrder.target_type == target_type,
+            PendingWorkOrder.target_id.in_(target_ids)
+    ).order_by(PendingWorkOrder.id):
+        # The latest one wins
+        statuses[target_id] = status
+    return statuses
@@ -0,0 +1,159 @@
+"""
+Bulk work order regeneration, e.g. after changing a work order template.
+
+The latest work order of every selected subscription / cancellation is rendered again from its
+stored data, keeping its number and filename. Rendering uses a separate pool of BULK_PDF_WORKERS
+processes (one per CPU by default) so the work orders of the endpoints keep their own workers.
+Progress is streamed as NDJSON, one line per work order, and the PDFs are collected in a ZIP
+that is registered as an export job and downloaded from /export-jobs/{id}/download.
+"""
+import json
+import os
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from app.db.database import SessionLocal
+from app.models.models import ExportJob, WorkOrder
+from app.utils.export_jobs import EXPORT_DIR
+from app.utils.pdf_renderer import init_pdf_worker, render_pdf, cached_pdf_path, link_cached_pdf, store_rendered_pdf
+
+BULK_PDF_WORKERS = int(os.getenv("BULK_PDF_WORKERS", str(os.cpu_count() or 2)))
+
+# One regeneration at a time: each one already uses every core. The endpoint takes it before
+# issuing missing work orders and the stream releases it when it ends
+_regeneration_lock = threading.Lock()
+
+
+def claim_regeneration() -> bool:
+    return _regeneration_lock.acquire(blocking=False)
+
+
+def release_regeneration():
+    _regeneration_lock.release()
+
+
+def start_regeneration(work_order_ids: list, skipped: list, created_by: str = None):
+    """
+    Return the progress stream of iter_regenerate_work_orders for a regeneration claimed with
+    claim_regeneration. The stream is started here so that it releases the lock when it ends,
+    also when the response never reads it (the client went away before streaming).
+    """
+    lines = iter_regenerate_work_orders(work_order_ids, skipped, created_by)
+    next(lines)
+    return lines
+
+
+def iter_regenerate_work_orders(work_order_ids: list, skipped: list, created_by: str = None):
+    """
+    Render the work orders and yield NDJSON progress lines, then a summary line with the ZIP
+    download. skipped holds the progress lines of targets that could not get a work order:
+    status 'failed', or 'skipped' for those left out on purpose.
+    Opens its own session since it runs after the endpoint has returned. The caller holds the
+    regeneration lock and hands it over; use start_regeneration.
+    """
+    db = SessionLocal()
+    job = None
+    try:
+        # start_regeneration stops here, from now on closing the stream releases the lock
+        yield ""
+
+        total = len(work_order_ids) + len(skipped)
+        done = 0
+        failed = 0
+        left_out = 0
+        for progress in skipped:
+            done += 1
+            progress = {'status': 'failed', **progress, 'done': done, 'total': total}
+            if progress['status'] == 'failed':
+                failed += 1
+            else:
+                left_out += 1
+            yield json.dumps(progress) + "\n"
+
+        job_id = uuid.uuid4().hex
+        zip_path = EXPORT_DIR / f"{job_id}.zip"
+        job = ExportJob(
+            id=job_id,
+            dataset='work_orders',
+            export_format='zip',
+            parameters=json.dumps({'work_order_ids': work_order_ids}),
+            cache_key=job_id,  # Never reused for another request
+            status='running',
+            created_by=created_by,
+            created_at=datetime.now(),
+        )
+        db.add(job)
+        db.commit()
+
+        work_orders = db.query(WorkOrder).filter(WorkOrder.id.in_(work_order_ids)).order_by(WorkOrder.id).all()
+        with zipfile.ZipFile(zip_path, 'w') as archive, \
+                ProcessPoolExecutor(max_workers=BULK_PDF_WORKERS, initializer=init_pdf_worker) as executor:
+            futures = {}
+            for work_order in work_orders:
+                template_data = json.loads(work_order.template_data)
+                cache_path = cached_pdf_path(work_order.template_name, template_data)
+                if cache_path.exists():
+                    # Already rendered with the current template
+                    link_cached_pdf(cache_path, Path(work_order.file_path))
+                    archive.write(cache_path, Path(work_order.file_path).name)
+                    done += 1
+                    yield json.dumps(work_order_progress(work_order, 'cached', done, total)) + "\n"
+                    continue
+                future = executor.submit(render_pdf, work_order.template_name, template_data)
+                futures[future] = (work_order, template_data)
+
+            for future in as_completed(futures):
+                work_order, template_data = futures[future]
+                done += 1
+                try:
+                    pdf = future.result()
+                    store_rendered_pdf(work_order.template_name, template_data, pdf, Path(work_order.file_path))
+                    archive.writestr(Path(work_order.file_path).name, pdf)
+                    progress = work_order_progress(work_order, 'rendered', done, total)
+                except Exception as e:
+                    failed += 1
+                    print(f"Error regenerando la orden de trabajo {work_order.order_no}: {str(e)}")
+                    progress = work_order_progress(work_order, 'failed', done, total)
+                    progress['error'] = str(e)
+                yield json.dumps(progress) + "\n"
+
+        job.status = 'done'
+        job.file_path = str(zip_path)
+        job.row_count = total - failed - left_out
+        job.finished_at = datetime.now()
+        db.commit()
+        yield json.dumps({
+            'done': done,
+            'total': total,
+            'failed': failed,
+            'skipped': left_out,
+            'job_id': job_id,
+            'download_url': f"/export-jobs/{job_id}/download",
+        }) + "\n"
+    finally:
+        if job is not None and job.status == 'running':
+            # The client went away or rendering broke off; the ZIP is incomplete
+            job.status = 'failed'
+            job.error = 'Interrupted'
+            job.finished_at = datetime.now()
+            db.commit()
+            if zip_path.exists():
+                os.remove(zip_path)
+        db.close()
+        release_regeneration()
+
+
+def work_order_progress(work_order: WorkOrder, status: str, done: int, total: int) -> dict:
+    return {
+        'target_type': work_order.target_type,
+        'target_id': work_order.target_id,
+        'order_no': work_order.order_no,
+        'filename': Path(work_order.file_path).name,
+        'status': status,
+        'done': done,
+        'total': total,
+    }
@@ -0,0 +1,58 @@
+"""
+ZIP archives streamed to the response while they are built.
+
+zipfile can write to a target it cannot seek: each entry's CRC and sizes then follow its data
+in a data descriptor. iter_zip gives it a target that only collects what is written, reads
+each file in UPLOAD_CHUNK_SIZE chunks and yields the collected bytes after every chunk, so no
+more than a chunk of the archive is ever in memory. Entries are stored, not deflated: scans
+and PDFs are already compressed.
+"""
+import io
+import zipfile
+from typing import Iterable, Iterator, Tuple
+
+from app.utils.uploads import UPLOAD_CHUNK_SIZE
+
+ZIP_MEDIA_TYPE = "application/zip"
+
+
+class ZipOutput(io.RawIOBase):
+    """Write-only, unseekable target keeping what zipfile writes until it is taken"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_zip(files: Iterable[Tuple[str, str]]) -> Iterator[bytes]:
+    """Yield a ZIP of files, given as (path on disk, name in the archive). Missing files are left out."""
+    output = ZipOutput()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for path, arcname in files:
+            try:
+                source = open(path, 'rb')
+            except FileNotFoundError:
+                print(f"Documento no encontrado, no se incluye en el ZIP: {path}")
+                continue
+            with source:
+                info = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+                with archive.open(info, 'w') as entry:
+                    while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                        entry.write(chunk)
+                        yield output.take()
+            # Data descriptor of the entry
+            yield output.take()
+    # Central directory
+    yield output.take()
@@ -30,7 +30,7 @@ export const approveCancellation = async (cancellationId, data) => {
  */
 export const getApprovedCancellations = async () => {
     try {
-        const response = await axios.get(`${BASE_URL}/api/approved-cancellations`);
+        const response = await axios.get(`${BASE_URL}/api/approved-cancellations`, { params: { all: true } });
         console.log('API Response in service:', response.data);
         return response.data; // Should contain { approved_cancellations: [...] }
     } catch (error) {
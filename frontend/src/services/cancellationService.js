@@ -31,7 +31,7 @@ export const getAllCancellations = async () => {
     const fullUrl = `${API_URL}/subscriptions/cancellations/`;
     console.log('Calling URL:', fullUrl); // Debug the full URL
 
-    const response = await axios.get(fullUrl);
+    const response = await axios.get(fullUrl, { params: { all: true } });
     console.log('API Response:', response.data); // For debugging
 
     // Your backend returns an array directly, so return it as-is
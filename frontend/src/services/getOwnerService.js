@@ -5,7 +5,7 @@ const API_URL = process.env.REACT_APP_BASE_URL;
 // Function to fetch all owners
 export const fetchAllOwners = async () => {
     try {
-        const response = await axios.get(`${API_URL}/owners/`);
+        const response = await axios.get(`${API_URL}/owners/`, { params: { all: true } });
         return response.data;
     } catch (error) {
         console.error('Error fetching owners:', error);
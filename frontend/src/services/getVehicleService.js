@@ -4,7 +4,7 @@ const API_URL = process.env.REACT_APP_BASE_URL;
 
 export const fetchAllVehicles = async () => {
     try {
-        const response = await axios.get(`${API_URL}/vehicles/`);
+        const response = await axios.get(`${API_URL}/vehicles/`, { params: { all: true } });
         return response.data;
     } catch (error) {
         console.error('Error fetching vehicles', error);
@@ -27,7 +27,7 @@ export const fetchVehicleByLisencePlate = async (lisence_plate) => {
 export const fetchVehiclesByOwnerId = async (ownerId) => {
     try {
         // Step 1: Fetch all vehicles from the API
-        const response = await axios.get(`${API_URL}/vehicles/`);
+        const response = await axios.get(`${API_URL}/vehicles/`, { params: { all: true } });
 
         // Step 2: Filter the vehicles by owner_id
         const filteredVehicles = response.data.filter(vehicle => vehicle.owner_id === ownerId);
@@ -5,7 +5,7 @@ const API_URL = process.env.REACT_APP_BASE_URL;
 export const fetchOwnerHistories = async () => {
     try {
         // Add the trailing slash to match your backend endpoint
-        const response = await axios.get(`${API_URL}/owner_histories/`);
+        const response = await axios.get(`${API_URL}/owner_histories/`, { params: { all: true } });
         console.log('Owner histories API response:', response.data);
         return response.data;
     } catch (error) {
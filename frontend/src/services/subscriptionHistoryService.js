@@ -12,7 +12,7 @@ if (!API_URL) {
 
 export const fetchSubscriptionHistories = async () => {
     try {
-        const response = await axios.get(`${API_URL}/subscription_histories/`);
+        const response = await axios.get(`${API_URL}/subscription_histories/`, { params: { all: true } });
         console.log("Fetched subscription histories:", response.data);
 
         if (!Array.isArray(response.data)) {
@@ -103,7 +103,7 @@ export const getSubscriptionTypeById = async (id) => {
 // Fetch all subscriptions
 export const getSubscriptions = async () => {
     try {
-        const response = await axios.get(`${API_URL}/subscriptions/`);
+        const response = await axios.get(`${API_URL}/subscriptions/`, { params: { all: true } });
         return response.data;
     } catch (error) {
         handleAxiosError(error, 'fetching subscriptions');
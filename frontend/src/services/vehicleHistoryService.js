@@ -7,7 +7,7 @@ const API_URL = process.env.REACT_APP_BASE_URL;
 
 export const fetchVehicleHistories = async () => {
     try {
-        const response = await axios.get(`${API_URL}/vehicle_histories/`);
+        const response = await axios.get(`${API_URL}/vehicle_histories/`, { params: { all: true } });
         return response.data;
     } catch (error) {
         throw new Error('Error fetching vehicle histories: ' + error.message);